@@ -1,28 +1,180 @@
 import os
-import faiss
+import asyncio
+import hashlib
+import hmac
+import importlib
+import json
+import queue
+import threading
+import time
 import pickle
 import numpy as np
-from fastapi import FastAPI
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
-import torch
-import textwrap
 from typing import List, Dict, Any, Optional
 
-# Set a consistent random seed for reproducibility
-np.random.seed(42)
-torch.manual_seed(42)
+# The encoder backend (torch/sentence-transformers or onnxruntime) and faiss are imported
+# lazily by load_resources() so the process can serve /healthz while they load.
 
 # --- CONFIG ---
 EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
-FAISS_INDEX_PATH = "data/faiss_index.bin"
+# The FAISS index, chunk store and BM25 index are read from the version named by
+# data/indexes/CURRENT, or from data/ when there is none (see index_versions.py)
 CHUNKS_PATH = "data/chunks.pkl"
 LEARNED_MODEL_PATH = "data/learned_reranker.pkl"
+# Number of /ask pipelines (embedding, FAISS, BM25, rerank) allowed to run at once
+MAX_CONCURRENCY = int(os.environ.get("RAG_MAX_CONCURRENCY", 4))
+# Requests allowed to wait for a free pipeline slot before new ones get a 503
+MAX_QUEUE = int(os.environ.get("RAG_MAX_QUEUE", 32))
+# Query embeddings from concurrent requests are coalesced into one encode() call
+EMBED_BATCH_MAX_SIZE = int(os.environ.get("RAG_EMBED_BATCH_MAX_SIZE", 32))
+EMBED_BATCH_WAIT_MS = float(os.environ.get("RAG_EMBED_BATCH_WAIT_MS", 5))
+# Query-embedding and full-response caches (TTL in seconds, 0 disables expiry)
+EMBED_CACHE_SIZE = int(os.environ.get("RAG_EMBED_CACHE_SIZE", 4096))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RAG_RESPONSE_CACHE_SIZE", 1024))
+CACHE_TTL_S = float(os.environ.get("RAG_CACHE_TTL_S", 0)) or None
+# Retrieve-then-rerank: each request reranks a pool of candidates (vector hits plus BM25
+# hits, for modes that use BM25) and returns the top k of them
+CANDIDATE_POOL_SIZE = int(os.environ.get("RAG_CANDIDATE_POOL_SIZE", 20))
+MAX_CANDIDATE_POOL_SIZE = int(os.environ.get("RAG_MAX_CANDIDATE_POOL_SIZE", 200))
+MODES = ("baseline", "hybrid", "learned")
+# Seconds between checks of data/indexes/CURRENT for a new version to load (0 disables)
+INDEX_WATCH_INTERVAL_S = float(os.environ.get("RAG_INDEX_WATCH_INTERVAL_S", 5))
+# Seconds after which a retired index version still held by requests is reported (it is
+# closed when the last of them finishes)
+INDEX_DRAIN_TIMEOUT_S = float(os.environ.get("RAG_INDEX_DRAIN_TIMEOUT_S", 60))
+# /admin endpoints require this value in the X-Admin-Token header; they are disabled when it is unset
+ADMIN_TOKEN = os.environ.get("RAG_ADMIN_TOKEN")
 
 # --- RAG Components (local imports) ---
-from rerank_hybrid import hybrid_rerank, get_bm25_scores, build_whoosh_index
-from rerank_learned import learned_rerank
+from rerank_hybrid import BM25_BACKEND, hybrid_rerank, load_bm25_engine
+from fusion import FUSION_METHODS, align_scores
+from diversity import collapse_duplicates, mmr
+from rerank_learned import learned_rerank, load_learned_reranker
+from cache import LRUCache, normalize_query
+from chunk_store import ChunkStore, write_chunk_store
+from index_versions import IndexManager, LoadedIndex, artifact_paths, current_version, list_versions, set_current
+from encoders import ENCODER_BACKEND, ENCODER_THREADS, check_agreement, load_encoder, load_reference
+import metrics
+from metrics import REQUEST_LATENCY, observe_stages, stage_timer, timings_ms
+
+PROCESS_START = time.perf_counter()
+
+# --- Query Embedding Service ---
+class BatchingEmbedder:
+    """
+    Coalesces query embeddings from concurrent requests into batched encode() calls.
+
+    A single background thread collects queries for up to max_wait_ms (or until
+    max_batch_size are waiting), encodes them together and hands each embedding back to
+    its caller. The request handlers submit() from the event loop once they hold a pipeline
+    slot, so batches are bounded by admitted requests (MAX_CONCURRENCY + MAX_QUEUE) rather
+    than by pipeline threads; encode() blocks the calling thread instead.
+    """
+
+    DELAY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250)
+
+    def __init__(self, encoder, max_batch_size=EMBED_BATCH_MAX_SIZE, max_wait_ms=EMBED_BATCH_WAIT_MS):
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = {}
+        self._delay_buckets = [0] * (len(self.DELAY_BUCKETS_MS) + 1)
+        self._delay_total = 0.0
+        self._delay_count = 0
+        self._delay_max = 0.0
+        self._thread = threading.Thread(target=self._run, name="embedder", daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        """Queues one query; the future resolves to its float32 embedding."""
+        future = Future()
+        self._queue.put((text, time.perf_counter(), future))
+        return future
+
+    def encode(self, text: str) -> np.ndarray:
+        """Returns the float32 embedding for one query, batched with concurrent callers."""
+        return self.submit(text).result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first):
+        """
+        Takes everything already queued, then keeps waiting for more until max_wait has
+        passed since the oldest query arrived or the batch is full.
+        """
+        batch = [first]
+        deadline = first[1] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if item is None:
+                # Re-queue the shutdown marker so the loop exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            started = time.perf_counter()
+            self._record(len(batch), [(started - enqueued) * 1000 for _, enqueued, _ in batch])
+            try:
+                embeddings = self.encoder.encode([text for text, _, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for i, (_, _, future) in enumerate(batch):
+                future.set_result(embeddings[i])
+
+    def _record(self, batch_size, delays_ms):
+        with self._stats_lock:
+            self._batch_sizes[batch_size] = self._batch_sizes.get(batch_size, 0) + 1
+            for delay in delays_ms:
+                bucket = next((i for i, bound in enumerate(self.DELAY_BUCKETS_MS) if delay <= bound), len(self.DELAY_BUCKETS_MS))
+                self._delay_buckets[bucket] += 1
+                self._delay_total += delay
+                self._delay_count += 1
+                self._delay_max = max(self._delay_max, delay)
+
+    def stats(self) -> Dict[str, Any]:
+        """Batch-size distribution and per-request queueing delay."""
+        with self._stats_lock:
+            bounds = [str(b) for b in self.DELAY_BUCKETS_MS] + ["+Inf"]
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "queue_depth": self._queue.qsize(),
+                "batches": sum(self._batch_sizes.values()),
+                "batch_size_distribution": dict(sorted(self._batch_sizes.items())),
+                "queue_delay_ms": {
+                    "count": self._delay_count,
+                    "mean": self._delay_total / self._delay_count if self._delay_count else 0.0,
+                    "max": self._delay_max,
+                    "buckets": dict(zip(bounds, self._delay_buckets)),
+                },
+            }
 
 # --- Load components at startup ---
 app = FastAPI(title="Mini RAG Service")
@@ -34,29 +186,268 @@ app.add_middleware(
     allow_headers=["*"], # Allows all headers
 )
 
+def index_version(paths):
+    """
+    Identifies the on-disk index artifacts by their size and modification time.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:12]
+
+def open_index_version(version=None) -> LoadedIndex:
+    """
+    Loads one index version (None: the working index in data/) without serving it:
+    the FAISS index and its metadata, the chunk store and a BM25 engine over its index.
+    """
+    import faiss
+
+    paths = artifact_paths(version)
+    # read_index handles every index type embed_index.py can build (Flat, HNSW, IVF-Flat, IVF-PQ)
+    index = faiss.read_index(paths["faiss_index"])
+    meta = {"index_type": "flat", "params": {}}
+    if os.path.exists(paths["index_meta"]):
+        with open(paths["index_meta"], 'r') as f:
+            meta = json.load(f)
+    if meta["index_type"].startswith("ivf"):
+        # Lets reconstruct() look vectors up by id, to score BM25-only candidates
+        faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.Hashtable)
+    if version is None and not ChunkStore.exists(paths["chunk_store"]):
+        # One-off migration for data built before the chunk store existed
+        print(f"No chunk store found; building {paths['chunk_store']} from {CHUNKS_PATH}...")
+        with open(CHUNKS_PATH, 'rb') as f:
+            write_chunk_store(pickle.load(f), paths["chunk_store"])
+    store = ChunkStore(paths["chunk_store"])
+    # The Whoosh engine opens its files on first search, so forked workers get their own handles
+    bm25 = load_bm25_engine(index_dir=paths["bm25_index" if BM25_BACKEND == "sparse" else "whoosh_index"])
+
+    if version is None:
+        version = index_version([paths[name] for name in ("faiss_index", "index_meta") if os.path.exists(paths[name])]
+                                + [os.path.join(paths["chunk_store"], "meta.json")])
+    print(f"Loaded index version {version}: {meta['index_type']} index with {index.ntotal} vectors.")
+    return LoadedIndex(version, paths, index, meta, store, bm25)
+
+def load_indices(version=None) -> LoadedIndex:
+    """
+    Loads an index version and checks the query encoder against it. Returns it unserved.
+    """
+    served = open_index_version(version)
+    try:
+        check_encoder_agreement(served)
+    except Exception:
+        served.close()
+        raise
+    return served
+
+def check_encoder_agreement(served: LoadedIndex):
+    """
+    Refuses to query an index with a different encoder backend than the one that built it
+    unless the query encoder agrees with PyTorch on the reference chunks saved by
+    embed_index.py. Raises RuntimeError if it does not.
+    """
+    build_backend = served.meta.get("encoder_backend", "torch")
+    backend = app.state.encoder.backend
+    app.state.encoder_agreement = None
+    if build_backend == backend:
+        return
+    reference_path = served.paths["encoder_reference"]
+    reference = load_reference(reference_path)
+    if reference is None:
+        raise RuntimeError(f"Index was built with the {build_backend} encoder and {reference_path} is missing, "
+                           f"so the {backend} encoder cannot be checked against it. Re-run embed_index.py.")
+    report = check_agreement(app.state.encoder, *reference)
+    app.state.encoder_agreement = report
+    print(f"Encoder agreement ({backend} vs PyTorch): min cosine {report['min_cosine']}, mean cosine {report['mean_cosine']}")
+    if not report["passed"]:
+        raise RuntimeError(f"The {backend} encoder does not agree with the {build_backend} encoder the index was built with.")
+
+def reload_index(version=None, force=False):
+    """
+    Loads `version` (default: the one CURRENT names) in the calling thread while the old
+    version keeps serving, then swaps it in. The old version is closed once its in-flight
+    requests drain. Does nothing if the version is already served, unless force=True.
+    """
+    manager = app.state.indices
+    version = version or current_version()
+    old = manager.reload(load_indices, version, force=force)
+    if old is None:
+        return
+    # Cached responses are keyed on the index version, so the old ones can never be hit again
+    app.state.response_cache.clear()
+    manager.retire(old, INDEX_DRAIN_TIMEOUT_S)
+
+def reload_index_in_background(version=None, force=False):
+    try:
+        reload_index(version, force=force)
+    except Exception as e:
+        print(f"Failed to load index version {version}: {e}")
+
+def watch_current_version():
+    """
+    Reloads whenever data/indexes/CURRENT names a new version. Every worker runs this, so
+    workers forked by serve.py all follow a switch made through one of them.
+    """
+    last = current_version()
+    while True:
+        time.sleep(INDEX_WATCH_INTERVAL_S)
+        version = current_version()
+        if version is not None and version != last:
+            print(f"CURRENT changed to {version}; loading it.")
+            # A version that fails to load is not retried until CURRENT changes again
+            last = version
+            reload_index_in_background(version)
+
+def preload_shared_resources():
+    """
+    Loads the read-only resources that forked workers can share copy-on-write: the FAISS
+    index, chunk store, BM25 engine, learned reranker and, for the torch backend, the
+    encoder weights. serve.py calls this before forking.
+
+    Nothing here starts a thread or runs inference, since neither survives a fork. The
+    ONNX Runtime encoder starts its thread pool when it is created, so workers load it.
+    """
+    timings = {}
+    with stage_timer(timings, "import_faiss"):
+        importlib.import_module("faiss")
+
+    if ENCODER_BACKEND == "torch":
+        with stage_timer(timings, "load_encoder"):
+            app.state.encoder = load_encoder(ENCODER_BACKEND, EMBEDDING_MODEL_NAME, threads=ENCODER_THREADS)
+    # Workers check the encoder against the index themselves, since that runs inference
+    with stage_timer(timings, "load_indices"):
+        app.state.indices = IndexManager(open_index_version(current_version()))
+    with stage_timer(timings, "load_learned_reranker"):
+        app.state.learned_reranker = load_learned_reranker(LEARNED_MODEL_PATH)
+    app.state.preload_timings = timings = {stage: round(seconds, 3) for stage, seconds in timings.items()}
+    print("Preload time breakdown (s): " + ", ".join(f"{stage}={seconds}" for stage, seconds in timings.items()))
+
+def load_resources():
+    """
+    Imports the heavy libraries and loads the model, indexes and BM25 engine, recording
+    how long each step takes. Marks the app ready when done.
+
+    In a worker forked by serve.py, whatever preload_shared_resources() already loaded is
+    kept; only the per-process parts (encoder warmup, batcher thread, caches) are set up.
+    """
+    preloaded = getattr(app.state, "preload_timings", {})
+    timings = {f"preload_{stage}": seconds for stage, seconds in preloaded.items()}
+    with stage_timer(timings, "import_faiss"):
+        importlib.import_module("faiss")
+
+    # Set a consistent random seed for reproducibility
+    np.random.seed(42)
+
+    # Load the query encoder (CPU); the torch backend imports torch here
+    if not hasattr(app.state, "encoder"):
+        with stage_timer(timings, "load_encoder"):
+            app.state.encoder = load_encoder(ENCODER_BACKEND, EMBEDDING_MODEL_NAME, threads=ENCODER_THREADS)
+    with stage_timer(timings, "warmup_encode"):
+        # The first encode() pays one-off initialization; do it before taking traffic
+        app.state.encoder.encode(["warmup"])
+    app.state.embedder = BatchingEmbedder(app.state.encoder)
+
+    app.state.embedding_cache = LRUCache(EMBED_CACHE_SIZE, ttl=CACHE_TTL_S)
+    app.state.response_cache = LRUCache(RESPONSE_CACHE_SIZE, ttl=CACHE_TTL_S)
+
+    # Load the FAISS index, chunk data and BM25 engine (backend chosen by BM25_BACKEND)
+    if preloaded:
+        check_encoder_agreement(app.state.indices.current)
+    else:
+        with stage_timer(timings, "load_indices"):
+            app.state.indices = IndexManager(load_indices(current_version()))
+
+        # Trained offline by `python rerank_learned.py --train`; mode=learned needs it
+        with stage_timer(timings, "load_learned_reranker"):
+            app.state.learned_reranker = load_learned_reranker(LEARNED_MODEL_PATH)
+
+    timings["total"] = time.perf_counter() - app.state.process_start
+    app.state.startup_timings = timings = {stage: round(seconds, 3) for stage, seconds in timings.items()}
+    app.state.ready = True
+    print("Startup time breakdown (s): " + ", ".join(f"{stage}={seconds}" for stage, seconds in timings.items()))
+    print("API is ready.")
+    if INDEX_WATCH_INTERVAL_S > 0:
+        threading.Thread(target=watch_current_version, name="index-watcher", daemon=True).start()
+
+def load_resources_in_background():
+    try:
+        load_resources()
+    except Exception as e:
+        app.state.startup_error = repr(e)
+        print(f"Failed to load resources: {e}")
+
 @app.on_event("startup")
 async def startup_event():
-    global model, index, chunks_data, chunks_dict
-    
     print("Loading resources for API...")
-    
-    # Load embedding model
-    device = "cpu"
-    app.state.model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
-    
-    # Load FAISS index and chunk data
-    app.state.index = faiss.read_index(FAISS_INDEX_PATH)
-    with open(CHUNKS_PATH, 'rb') as f:
-        app.state.chunks_data = pickle.load(f)
-    app.state.chunks_dict = {c['id']: c for c in app.state.chunks_data}
+    app.state.process_start = PROCESS_START
+    app.state.ready = False
+    app.state.startup_error = None
 
-    print("API is ready.")
+    # CPU-bound retrieval runs on a bounded pool so it never blocks the event loop
+    app.state.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="rag")
+    app.state.pending = 0
+
+    # Load in the background so /healthz answers immediately; /readyz reports when done
+    threading.Thread(target=load_resources_in_background, name="startup", daemon=True).start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.executor.shutdown(wait=True)
+    if hasattr(app.state, "embedder"):
+        app.state.embedder.close()
+    if hasattr(app.state, "indices"):
+        app.state.indices.current.close()
+
+def require_ready():
+    if not app.state.ready:
+        raise HTTPException(status_code=503, detail="Service is still starting up.", headers={"Retry-After": "1"})
+
+def validate_mode(mode):
+    if mode not in MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(MODES)}.")
+
+def validate_request(request):
+    validate_mode(request.mode)
+    if not 1 <= request.k <= MAX_CANDIDATE_POOL_SIZE:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {MAX_CANDIDATE_POOL_SIZE}.")
+    if request.candidates is not None and request.candidates < 1:
+        raise HTTPException(status_code=400, detail="candidates must be at least 1.")
+    if request.fusion not in FUSION_METHODS:
+        raise HTTPException(status_code=400, detail=f"fusion must be one of {', '.join(FUSION_METHODS)}.")
+    if request.mmr_lambda is not None and not 0 <= request.mmr_lambda <= 1:
+        raise HTTPException(status_code=400, detail="mmr_lambda must be between 0 and 1.")
 
 # --- Models for API Request/Response ---
+# pydantic 2 renamed copy() and json(); the old names are deprecated there
+PYDANTIC_V2 = hasattr(BaseModel, "model_copy")
+
+def copy_model(model: BaseModel, **update):
+    return model.model_copy(update=update) if PYDANTIC_V2 else model.copy(update=update)
+
+def dump_json(model: BaseModel) -> str:
+    return model.model_dump_json() if PYDANTIC_V2 else model.json()
+
 class AskRequest(BaseModel):
     q: str
     k: int = 5
     mode: str = "hybrid"
+    # Per-request ANN search knobs; ignored by index types they do not apply to
+    ef_search: Optional[int] = None
+    nprobe: Optional[int] = None
+    # Candidates to rerank before cutting to k; defaults to CANDIDATE_POOL_SIZE
+    candidates: Optional[int] = None
+    # How hybrid mode fuses vector and BM25 scores: "weighted", "rrf" or "zscore"
+    fusion: str = "weighted"
+    # Return per-stage timings (ms) for this request in the response's debug_timings
+    debug_timings: bool = False
+    # Restrict retrieval to these sources / leave these out; a source is named by its file
+    # name, title or URL (see /sources)
+    sources: Optional[List[str]] = None
+    exclude_sources: Optional[List[str]] = None
+    # Keep only the best-ranked chunk of each near-duplicate cluster found at index time
+    collapse_duplicates: bool = False
+    # Reorder the reranked candidates by MMR with this relevance weight (0-1; lower is more diverse)
+    mmr_lambda: Optional[float] = None
 
 class Context(BaseModel):
     chunk_id: str
@@ -70,27 +461,315 @@ class AskResponse(BaseModel):
     abstained: bool
     contexts: List[Context]
     reranker_used: str
+    # Index version the answer came from; changes when a new index is swapped in
+    index_version: Optional[str] = None
+    # Only set when the request asked for debug_timings
+    debug_timings: Optional[Dict[str, float]] = None
+
+class ReloadRequest(BaseModel):
+    # Published version to serve; defaults to the one data/indexes/CURRENT names
+    version: Optional[str] = None
+    # Also point CURRENT at `version`, so every worker's watcher switches to it
+    activate: bool = True
+    # Reload even if the version is already served, e.g. after rebuilding data/ in place
+    force: bool = False
+
+class AskBatchRequest(BaseModel):
+    items: List[AskRequest]
+    # When set, every item is answered with each of these modes on shared retrieval results
+    modes: Optional[List[str]] = None
+
+class AskBatchResponse(BaseModel):
+    # In input order; with `modes`, each item contributes one response per mode, in mode order
+    results: List[AskResponse]
 
 # --- Core RAG Logic ---
-def vector_search(query: str, k: int):
-    """Performs a basic vector search and returns ranked chunks."""
-    query_embedding = app.state.model.encode([query], convert_to_tensor=False).astype('float32')
-    
-    # Perform the search
-    distances, indices = app.state.index.search(query_embedding, k)
-    
-    results = []
-    for i, idx in enumerate(indices[0]):
-        chunk = app.state.chunks_data[idx]
-        results.append({
-            "chunk_id": chunk['id'],
-            "source_title": chunk['source_title'],
-            "source_url": chunk['source_url'],
-            "text_snippet": chunk['chunk_text'],
-            "scores": {"vector": float(distances[0][i])}
-        })
+def embed_query(query: str) -> np.ndarray:
+    """Returns the query embedding, served from the embedding cache when possible."""
+    key = normalize_query(query)
+    embedding = app.state.embedding_cache.get(key)
+    if embedding is None:
+        embedding = app.state.embedder.encode(query)
+        embedding.flags.writeable = False
+        app.state.embedding_cache.put(key, embedding)
+    return embedding
+
+async def embed_query_async(query: str) -> np.ndarray:
+    """
+    embed_query() for the event loop: waits for the batcher without holding a thread, so
+    every request in flight can join the same batch.
+    """
+    key = normalize_query(query)
+    embedding = app.state.embedding_cache.get(key)
+    if embedding is None:
+        embedding = await asyncio.wrap_future(app.state.embedder.submit(query))
+        embedding.flags.writeable = False
+        app.state.embedding_cache.put(key, embedding)
+    return embedding
+
+def embed_queries(queries: List[str]) -> np.ndarray:
+    """
+    Returns a float32 matrix of query embeddings. Cache misses are encoded together in
+    one encode() call, bypassing the per-request batcher.
+    """
+    keys = [normalize_query(q) for q in queries]
+    embeddings = [app.state.embedding_cache.get(key) for key in keys]
+    missing = [i for i, emb in enumerate(embeddings) if emb is None]
+    if missing:
+        encoded = app.state.encoder.encode([queries[i] for i in missing])
+        for row, i in enumerate(missing):
+            embedding = encoded[row].copy()
+            embedding.flags.writeable = False
+            app.state.embedding_cache.put(keys[i], embedding)
+            embeddings[i] = embedding
+    return np.vstack(embeddings)
+
+def source_filter(served: LoadedIndex, request: AskRequest):
+    """
+    Resolves a request's sources/exclude_sources against the served chunk store. Returns
+    None when the request is unfiltered, else a dict with the included and excluded source
+    file names (for BM25) and the matching vec_id bitmap (for FAISS).
+    """
+    if request.sources is None and not request.exclude_sources:
+        return None
+    store = served.store
+    include, unknown = store.find_sources(request.sources) if request.sources is not None else (None, [])
+    exclude, unknown_excluded = store.find_sources(request.exclude_sources or [])
+    unknown += unknown_excluded
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown sources: {', '.join(unknown)}. See /sources.")
+    files = lambda sources: sorted({store.source_files[i] for i in sources})
+    return {
+        "sources": None if include is None else files(include),
+        "exclude_sources": files(exclude),
+        "bitmap": store.vec_id_bitmap(include, exclude),
+    }
+
+def filter_key(request: AskRequest):
+    """Hashable form of a request's source filter, for cache keys and batch grouping."""
+    return (None if request.sources is None else tuple(sorted(request.sources)), tuple(sorted(request.exclude_sources or ())))
+
+def search_params(served: LoadedIndex, ef_search: Optional[int] = None, nprobe: Optional[int] = None, bitmap: Optional[np.ndarray] = None):
+    """
+    Builds FAISS search parameters for the served index type, or None to use its defaults.
+    With a vec_id bitmap, the search only visits the vectors whose bit is set.
+    """
+    import faiss
+
+    index_type = served.meta["index_type"]
+    if bitmap is None:
+        if index_type == "hnsw" and ef_search:
+            return faiss.SearchParametersHNSW(efSearch=ef_search)
+        if index_type in ("ivf_flat", "ivf_pq") and nprobe:
+            return faiss.SearchParametersIVF(nprobe=nprobe)
+        return None
+
+    selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+    # Parameter objects carry their own defaults, so the index's build-time settings are
+    # passed explicitly when the request does not override them
+    built = served.meta.get("params", {})
+    if index_type == "hnsw":
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search or built.get("efSearch", 16))
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe or built.get("nprobe", 1))
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    # The selector only points at the bitmap; keep both alive as long as the parameters
+    params.referenced_objects = [selector, bitmap]
+    return params
+
+def context_for_row(store: ChunkStore, row, vector_score) -> Dict[str, Any]:
+    source_title, source_url = store.source(row)
+    return {
+        "chunk_id": store.chunk_id(row),
+        "source_title": source_title,
+        "source_url": source_url,
+        "text_snippet": store.text(row),
+        "scores": {"vector": float(vector_score)}
+    }
+
+def build_contexts(served: LoadedIndex, distances, indices):
+    """
+    Turns one row of FAISS search output into context dicts, read from the chunk store.
+    Returns the contexts and their chunk-store rows.
+    """
+    rows = served.store.rows_for_vec_ids(indices)
+    # Approximate indices return -1 when fewer than k neighbours were found
+    valid = (np.asarray(indices) >= 0) & (rows >= 0)
+    return [context_for_row(served.store, row, distance) for row, distance in zip(rows[valid], np.asarray(distances)[valid])], rows[valid]
+
+def vector_search(served: LoadedIndex, query_embedding: np.ndarray, k: int, ef_search: Optional[int] = None, nprobe: Optional[int] = None,
+                  bitmap: Optional[np.ndarray] = None):
+    """
+    Searches FAISS with one query embedding, restricted to the vec_ids set in `bitmap` when
+    given; returns ranked chunks and their chunk-store rows.
+    """
+    params = search_params(served, ef_search, nprobe, bitmap)
+    distances, indices = served.index.search(query_embedding.reshape(1, -1), k, params=params)
+    return build_contexts(served, distances[0], indices[0])
+
+def candidate_pool_size(request: AskRequest) -> int:
+    """Candidates to retrieve for a request: never fewer than it returns, never more than the cap."""
+    return min(max(request.candidates or CANDIDATE_POOL_SIZE, request.k), MAX_CANDIDATE_POOL_SIZE)
+
+def add_keyword_candidates(served: LoadedIndex, contexts, rows, query_embedding: np.ndarray, bm25_scores: Dict[str, float]):
+    """
+    Union step: appends the BM25 hits that are not among the vector hits, scored against
+    the query with their stored vectors so every candidate has a vector score. Returns the
+    candidates and their BM25 scores aligned to them (NaN where BM25 missed a candidate).
+
+    BM25 hits are mapped from chunk IDs to integer chunk-store rows once, here; the
+    rerankers only see arrays aligned by row.
+    """
+    store = served.store
+    hit_rows = np.array([store.row_for_chunk_id(chunk_id) for chunk_id in bm25_scores], dtype=np.int64)
+    hit_scores = np.fromiter(bm25_scores.values(), dtype=np.float64, count=len(bm25_scores))
+    known = hit_rows >= 0
+    hit_rows, hit_scores = hit_rows[known], hit_scores[known]
+    extra = hit_rows[~np.isin(hit_rows, rows)]
+    if len(extra):
+        vectors = served.index.reconstruct_batch(np.asarray(store.vec_ids[extra], dtype='int64'))
+        for row, score in zip(extra, vectors @ query_embedding):
+            contexts.append(context_for_row(store, row, score))
+        rows = np.concatenate([rows, extra])
+    return contexts, align_scores(rows, hit_rows, hit_scores)
+
+def retrieve_candidates(served: LoadedIndex, request: AskRequest, query_embedding: np.ndarray, contexts, rows, modes: List[str],
+                        filters=None, timings=None):
+    """
+    Completes the candidate pool for `request` from its vector hits. Unless every mode is
+    the vector-only baseline, BM25 is searched to the same depth, under the same source
+    filter, and its hits are merged in. Returns (candidates, BM25 scores aligned to the
+    candidates).
+    """
+    if all(mode == "baseline" for mode in modes):
+        return contexts, np.full(len(contexts), np.nan)
+    with stage_timer(timings, "bm25"):
+        if filters is None:
+            bm25_scores = served.bm25.search(request.q, k=candidate_pool_size(request))
+        else:
+            bm25_scores = served.bm25.search(request.q, k=candidate_pool_size(request),
+                                             sources=filters["sources"], exclude_sources=filters["exclude_sources"])
+    with stage_timer(timings, "merge_candidates"):
+        return add_keyword_candidates(served, contexts, rows, query_embedding, bm25_scores)
+
+def vector_retrieve(served: LoadedIndex, request: AskRequest, timings=None, query_embedding: Optional[np.ndarray] = None):
+    """
+    Vector half of the retrieve step: embeds the query (unless its embedding is given)
+    and searches FAISS. Returns the query embedding, the ranked vector hits, their
+    chunk-store rows and the request's resolved source filter, for retrieve_candidates().
+    """
+    filters = source_filter(served, request)
+    if query_embedding is None:
+        with stage_timer(timings, "embed"):
+            query_embedding = embed_query(request.q)
+    with stage_timer(timings, "vector_search"):
+        bitmap = None if filters is None else filters["bitmap"]
+        contexts, rows = vector_search(served, query_embedding, candidate_pool_size(request), request.ef_search, request.nprobe, bitmap)
+    return query_embedding, contexts, rows, filters
+
+def retrieve(served: LoadedIndex, request: AskRequest, timings=None, query_embedding: Optional[np.ndarray] = None):
+    """
+    Retrieve step for one request against the served index version: the candidates to
+    rerank and their BM25 scores. Stage durations are added to `timings` when it is given.
+    """
+    query_embedding, contexts, rows, filters = vector_retrieve(served, request, timings, query_embedding)
+    return retrieve_candidates(served, request, query_embedding, contexts, rows, [request.mode], filters, timings)
+
+def retrieve_batch(served: LoadedIndex, requests: List[AskRequest], modes: List[List[str]], timings=None):
+    """
+    Retrieve step for many requests: one encode() call, and one multi-query FAISS search
+    per distinct ANN search setting and source filter. Returns a (candidates, BM25 scores)
+    pair per request. Stage durations, summed over the whole batch, are added to `timings`
+    when it is given.
+    """
+    # Resolved first so an unknown source fails the batch before any work is done
+    filters = [source_filter(served, req) for req in requests]
+    with stage_timer(timings, "embed"):
+        embeddings = embed_queries([req.q for req in requests])
+    groups = {}
+    for i, req in enumerate(requests):
+        groups.setdefault((req.ef_search, req.nprobe, filter_key(req)), []).append(i)
+
+    results = [None] * len(requests)
+    for (ef_search, nprobe, _), rows in groups.items():
+        # Search the group's largest pool once; hits are ranked, so smaller pools are prefixes
+        k = max(candidate_pool_size(requests[i]) for i in rows)
+        bitmap = None if filters[rows[0]] is None else filters[rows[0]]["bitmap"]
+        with stage_timer(timings, "vector_search"):
+            distances, indices = served.index.search(embeddings[rows], k, params=search_params(served, ef_search, nprobe, bitmap))
+        for j, i in enumerate(rows):
+            pool = candidate_pool_size(requests[i])
+            with stage_timer(timings, "vector_search"):
+                contexts, store_rows = build_contexts(served, distances[j][:pool], indices[j][:pool])
+            results[i] = retrieve_candidates(served, requests[i], embeddings[i], contexts, store_rows, modes[i], filters[i], timings)
     return results
 
+def rerank(retrieved_contexts, query: str, mode: str, keyword_scores: np.ndarray, fusion: str = "weighted"):
+    """Applies the reranker for `mode` to the retrieved candidates and their aligned BM25 scores."""
+    if mode == "hybrid":
+        return hybrid_rerank(retrieved_contexts, query, keyword_scores=keyword_scores, fusion=fusion)
+    if mode == "learned":
+        if app.state.learned_reranker is None:
+            raise HTTPException(status_code=503, detail="Learned reranker is not trained. Run `python rerank_learned.py --train`.")
+        return learned_rerank(retrieved_contexts, query, keyword_scores, app.state.learned_reranker)
+    # baseline
+    final_contexts = sorted(retrieved_contexts, key=lambda x: x['scores']['vector'], reverse=True)
+    for ctx in final_contexts:
+        ctx['scores']['final'] = ctx['scores']['vector']
+    return final_contexts
+
+def diversify(served: LoadedIndex, ranked_contexts, request: AskRequest):
+    """
+    Optional diversity step after reranking: collapses near-duplicate chunks onto their
+    best-ranked member, then reorders the rest by MMR over the candidates' stored vectors.
+    """
+    store = served.store
+    rows = np.array([store.row_for_chunk_id(ctx['chunk_id']) for ctx in ranked_contexts], dtype=np.int64)
+    keep = np.arange(len(ranked_contexts))
+    if request.collapse_duplicates:
+        keep = collapse_duplicates(store.canonical[rows])
+    if request.mmr_lambda is not None and len(keep):
+        vectors = served.index.reconstruct_batch(np.asarray(store.vec_ids[rows[keep]], dtype='int64'))
+        relevance = [ranked_contexts[i]['scores']['final'] for i in keep]
+        keep = keep[mmr(relevance, vectors, request.k, request.mmr_lambda)]
+    return [ranked_contexts[i] for i in keep]
+
+def rank(served: LoadedIndex, candidates, request: AskRequest, keyword_scores: np.ndarray, timings=None):
+    """Rerank step, then the diversity step if the request asked for it; returns the top k."""
+    with stage_timer(timings, "rerank"):
+        final_contexts = rerank(candidates, request.q, request.mode, keyword_scores, request.fusion)
+    if request.collapse_duplicates or request.mmr_lambda is not None:
+        with stage_timer(timings, "diversify"):
+            final_contexts = diversify(served, final_contexts, request)
+    return final_contexts[:request.k]
+
+def needs_wider_pool(request: AskRequest, final_contexts, hits: int) -> bool:
+    """
+    True when collapsing near-duplicates left fewer than k candidates and a bigger pool
+    could add more: the search filled the pool and the pool is below the cap.
+    """
+    pool = candidate_pool_size(request)
+    return request.collapse_duplicates and len(final_contexts) < request.k and hits >= pool and pool < MAX_CANDIDATE_POOL_SIZE
+
+def widen_pool(request: AskRequest) -> AskRequest:
+    return copy_model(request, candidates=min(candidate_pool_size(request) * 2, MAX_CANDIDATE_POOL_SIZE))
+
+def complete_and_rank(served: LoadedIndex, request: AskRequest, query_embedding: np.ndarray, contexts, rows, filters, timings=None):
+    """
+    Keyword half of the retrieve step for vector_retrieve()'s hits, then rank(). When
+    collapsing near-duplicates leaves fewer than k candidates, the pool is doubled and
+    searched again until k distinct clusters remain or the pool is exhausted.
+    """
+    while True:
+        # add_keyword_candidates() appends to `contexts`; `rows` stays the vector hits
+        candidates, keyword_scores = retrieve_candidates(served, request, query_embedding, contexts, rows, [request.mode], filters, timings)
+        final_contexts = rank(served, candidates, request, keyword_scores, timings)
+        if not needs_wider_pool(request, final_contexts, len(rows)):
+            return final_contexts
+        request = widen_pool(request)
+        _, contexts, rows, _ = vector_retrieve(served, request, timings, query_embedding)
+
 def extractive_answer(contexts: List[Dict[str, Any]]) -> str:
     """
     Generates an extractive answer from the top ranked contexts.
@@ -139,35 +818,385 @@ def should_abstain(contexts: List[Dict[str, Any]]) -> bool:
     
     return False
 
+# --- Request Pipeline ---
+def response_cache_key(request: AskRequest, version: str):
+    return (normalize_query(request.q), request.k, candidate_pool_size(request), request.mode, request.fusion,
+            request.ef_search, request.nprobe, filter_key(request), request.collapse_duplicates, request.mmr_lambda, version)
+
+def answer_question(served: LoadedIndex, request: AskRequest, query_embedding: Optional[np.ndarray] = None):
+    """
+    Runs retrieval, reranking and answer extraction for one question.
+    This is CPU-bound and must be called from the executor, not the event loop.
+    Returns the response and the duration of each stage.
+    """
+    timings = {}
+    retrieved = vector_retrieve(served, request, timings, query_embedding)
+    final_contexts = complete_and_rank(served, request, *retrieved, timings)
+    response = build_response(final_contexts, request.mode, served.version, timings)
+    app.state.response_cache.put(response_cache_key(request, served.version), response)
+    return response, timings
+
+def build_response(final_contexts, reranker_used: str, index_version: str, timings=None) -> AskResponse:
+    with stage_timer(timings, "abstain"):
+        abstained = should_abstain(final_contexts)
+    if abstained:
+        answer = "I'm sorry, I couldn't find a confident answer in the documents."
+    else:
+        with stage_timer(timings, "answer"):
+            answer = extractive_answer(final_contexts)
+
+    with stage_timer(timings, "validate"):
+        return AskResponse(
+            answer=answer,
+            abstained=abstained,
+            contexts=final_contexts,
+            reranker_used=reranker_used,
+            index_version=index_version
+        )
+
+def with_debug_timings(response: AskResponse, timings) -> AskResponse:
+    """A copy of a (possibly cached) response carrying this request's stage timings."""
+    return copy_model(response, debug_timings=timings_ms(timings))
+
+def answer_batch(served: LoadedIndex, batch: AskBatchRequest):
+    """
+    Answers many questions with shared retrieval: one encode() call, one multi-query
+    FAISS search, and one candidate pool (and BM25 search) per question shared by every
+    requested mode.
+
+    Returns the response and the timings of the shared retrieval stages. Rerank and answer
+    stages are recorded per item under the item's mode; items that asked for
+    debug_timings get the shared stages (for the whole batch) plus their own. Items served
+    from the response cache only report their own response_cache lookup, as /ask does.
+    """
+    jobs = []
+    for item in batch.items:
+        modes = batch.modes or [item.mode]
+        jobs.append([copy_model(item, mode=mode) for mode in modes])
+
+    shared = {}
+    responses = []
+    for reqs in jobs:
+        responses.append([])
+        for req in reqs:
+            lookup = {}
+            with stage_timer(lookup, "response_cache"):
+                cached = app.state.response_cache.get(response_cache_key(req, served.version))
+            shared["response_cache"] = shared.get("response_cache", 0.0) + lookup["response_cache"]
+            if cached is not None and req.debug_timings:
+                cached = with_debug_timings(cached, lookup)
+            responses[-1].append(cached)
+    todo = [i for i, cached in enumerate(responses) if any(r is None for r in cached)]
+
+    if todo:
+        retrieved = retrieve_batch(served, [batch.items[i] for i in todo], [[req.mode for req in jobs[i]] for i in todo], shared)
+        for i, (candidates, keyword_scores) in zip(todo, retrieved):
+            for j, req in enumerate(jobs[i]):
+                if responses[i][j] is not None:
+                    continue
+                timings = {}
+                # Rerankers write their scores into the contexts, so each mode gets its own copy
+                contexts = [{**ctx, "scores": dict(ctx["scores"])} for ctx in candidates]
+                final_contexts = rank(served, contexts, req, keyword_scores, timings)
+                if needs_wider_pool(req, final_contexts, len(candidates)):
+                    # Too few clusters left after collapsing; redo this item on its own with a bigger pool
+                    wider = widen_pool(req)
+                    final_contexts = complete_and_rank(served, wider, *vector_retrieve(served, wider, timings), timings)
+                response = build_response(final_contexts, req.mode, served.version, timings)
+                app.state.response_cache.put(response_cache_key(req, served.version), response)
+                observe_stages(timings, req.mode)
+                if req.debug_timings:
+                    response = with_debug_timings(response, {**shared, **timings})
+                responses[i][j] = response
+
+    return AskBatchResponse(results=[r for per_item in responses for r in per_item]), shared
+
+def json_response(model: BaseModel, timings, index_version: str) -> Response:
+    """
+    Serializes a response model ourselves so the time it takes is recorded as the
+    "serialize" stage; FastAPI passes a Response through without re-validating it.
+    The index version is also sent as a header, for HTTP caches to vary on.
+    """
+    with stage_timer(timings, "serialize"):
+        body = dump_json(model)
+    return Response(content=body, media_type="application/json", headers={"X-Index-Version": index_version})
+
+@contextmanager
+def pipeline_slot():
+    """
+    Admission control: counts the request against MAX_CONCURRENCY + MAX_QUEUE while it
+    holds the slot, and rejects it with a 503 when none is free so clients can back off
+    instead of piling up on the worker.
+    """
+    if app.state.pending >= MAX_CONCURRENCY + MAX_QUEUE:
+        raise HTTPException(status_code=503, detail="Server is busy, please retry.", headers={"Retry-After": "1"})
+    # Only touched from the event loop thread, so no lock is needed
+    app.state.pending += 1
+    try:
+        yield
+    finally:
+        app.state.pending -= 1
+
+async def run_in_pipeline(func, *args):
+    """
+    Runs func on the bounded executor. Up to MAX_CONCURRENCY calls run at once and up to
+    MAX_QUEUE more wait in the executor's queue; beyond that the request is rejected.
+    """
+    with pipeline_slot():
+        return await asyncio.get_running_loop().run_in_executor(app.state.executor, func, *args)
+
+async def run_with_query_embedding(query: str, timings, func, *args):
+    """
+    run_in_pipeline(func, *args, query_embedding). The query is embedded from the event
+    loop first (the "embed" stage) so it can join a batch with every request in flight,
+    but only once the request holds its pipeline slot: a rejected request is never encoded.
+    """
+    with pipeline_slot():
+        with stage_timer(timings, "embed"):
+            query_embedding = await embed_query_async(query)
+        return await asyncio.get_running_loop().run_in_executor(app.state.executor, func, *args, query_embedding)
+
 # --- API Endpoint ---
 @app.post("/ask", response_model=AskResponse)
 async def ask_question(request: AskRequest):
     """
     Processes a question using the specified reranking mode.
+    Repeated questions are answered from the response cache without entering the pipeline.
     """
-    reranker_used = request.mode
-    
-    retrieved_contexts = vector_search(request.q, k=10)
-    
-    if request.mode == "hybrid":
-        final_contexts = hybrid_rerank(retrieved_contexts, request.q)
-    elif request.mode == "learned":
-        final_contexts = learned_rerank(retrieved_contexts, request.q, app.state.chunks_data, vector_search, get_bm25_scores)
-    else: # baseline
-        final_contexts = sorted(retrieved_contexts, key=lambda x: x['scores']['vector'], reverse=True)
-        for ctx in final_contexts:
-            ctx['scores']['final'] = ctx['scores']['vector']
-            
-    if should_abstain(final_contexts):
-        answer = "I'm sorry, I couldn't find a confident answer in the documents."
-        abstained = True
-    else:
-        answer = extractive_answer(final_contexts)
-        abstained = False
-            
-    return AskResponse(
-        answer=answer,
-        abstained=abstained,
-        contexts=final_contexts,
-        reranker_used=reranker_used
-    )
\ No newline at end of file
+    start = time.perf_counter()
+    require_ready()
+    validate_request(request)
+    timings = {}
+    # The request is answered entirely from the index version served when it arrived
+    served = app.state.indices.acquire()
+    try:
+        with stage_timer(timings, "response_cache"):
+            response = app.state.response_cache.get(response_cache_key(request, served.version))
+        if response is None:
+            response, pipeline_timings = await run_with_query_embedding(request.q, timings, answer_question, served, request)
+            timings.update(pipeline_timings)
+    finally:
+        served.release()
+    if request.debug_timings:
+        # Serialization is still to come, so it is only reported in /metrics
+        response = with_debug_timings(response, timings)
+    result = json_response(response, timings, served.version)
+    observe_stages(timings, request.mode)
+    REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint="/ask", mode=request.mode)
+    return result
+
+@app.post("/ask/batch", response_model=AskBatchResponse)
+async def ask_batch(batch: AskBatchRequest):
+    """
+    Processes many questions in one call, sharing embedding and FAISS work across them.
+    """
+    start = time.perf_counter()
+    require_ready()
+    for item in batch.items:
+        validate_request(item)
+    for mode in batch.modes or []:
+        validate_mode(mode)
+    served = app.state.indices.acquire()
+    try:
+        response, timings = await run_in_pipeline(answer_batch, served, batch)
+    finally:
+        served.release()
+    result = json_response(response, timings, served.version)
+    observe_stages(timings, "batch")
+    REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint="/ask/batch", mode="batch")
+    return result
+
+def format_event(event: str, data: Dict[str, Any], stream_format: str) -> str:
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps({"event": event, **data}) + "\n"
+
+@app.post("/ask/stream")
+async def ask_stream(request: AskRequest, format: str = "ndjson"):
+    """
+    Streams the answer in stages as NDJSON (default) or server-sent events (?format=sse):
+    `retrieved` with the baseline vector hits as soon as FAISS returns, `reranked` with the
+    reranked contexts, then `answer` with the abstain decision and extractive answer.
+    Clients can disconnect after any stage; the remaining stages are then not computed.
+    """
+    start = time.perf_counter()
+    require_ready()
+    validate_request(request)
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'sse'.")
+
+    # The embedding and vector search run before the response starts so an overloaded
+    # server can still answer 503; BM25, the merge and reranking run after the first event is sent
+    timings = {}
+    # Held until the stream ends; released early only if retrieval fails
+    served = app.state.indices.acquire()
+    try:
+        query_embedding, vector_hits, rows, filters = await run_with_query_embedding(request.q, timings, vector_retrieve, served, request, timings)
+    except BaseException:
+        served.release()
+        raise
+
+    async def events():
+        try:
+            # The vector hits are in rank order, so their head is the baseline top k
+            yield format_event("retrieved", {"contexts": vector_hits[:request.k]}, format)
+            try:
+                # The hits were serialized above, so the merge and rerankers may update them in place
+                final_contexts = await run_in_pipeline(
+                    complete_and_rank, served, request, query_embedding, vector_hits, rows, filters, timings)
+            except HTTPException as e:
+                yield format_event("error", {"status": e.status_code, "detail": e.detail}, format)
+                return
+            yield format_event("reranked", {"contexts": final_contexts, "reranker_used": request.mode}, format)
+
+            response = build_response(final_contexts, request.mode, served.version, timings)
+            app.state.response_cache.put(response_cache_key(request, served.version), response)
+            answer = {"answer": response.answer, "abstained": response.abstained, "index_version": served.version}
+            if request.debug_timings:
+                answer["debug_timings"] = timings_ms(timings)
+            yield format_event("answer", answer, format)
+            observe_stages(timings, request.mode)
+            REQUEST_LATENCY.observe(time.perf_counter() - start, endpoint="/ask/stream", mode=request.mode)
+        finally:
+            served.release()
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type, headers={"X-Index-Version": served.version})
+
+@app.get("/stats")
+async def stats():
+    """
+    Returns runtime metrics for the query embedding batcher, encoder, caches and the request pipeline.
+    """
+    require_ready()
+    return {
+        "embedder": app.state.embedder.stats(),
+        "encoder": {
+            "backend": app.state.encoder.backend,
+            "index_backend": app.state.indices.current.meta.get("encoder_backend", "torch"),
+            "threads": ENCODER_THREADS or None,
+            "agreement": app.state.encoder_agreement,
+        },
+        "cache": {
+            "index_version": app.state.indices.current.version,
+            "embeddings": app.state.embedding_cache.stats(),
+            "responses": app.state.response_cache.stats(),
+        },
+        "pipeline": {"pending": app.state.pending, "max_concurrency": MAX_CONCURRENCY, "max_queue": MAX_QUEUE},
+        # With serve.py each worker keeps its own caches and metrics; this identifies which one answered
+        "worker_pid": os.getpid(),
+    }
+
+@app.get("/sources")
+async def sources():
+    """
+    Lists the sources of the served index, with their chunk counts. Any of a source's file,
+    title or url can be passed in an /ask request's sources or exclude_sources.
+    """
+    require_ready()
+    served = app.state.indices.acquire()
+    try:
+        store = served.store
+        counts = np.bincount(store.source_idx, minlength=len(store.sources))
+        return {
+            "index_version": served.version,
+            "sources": [{"file": file, "title": title, "url": url, "chunks": int(count)}
+                        for (title, url), file, count in zip(store.sources, store.source_files, counts)],
+        }
+    finally:
+        served.release()
+
+def cache_samples(stat):
+    return [({"cache": name}, cache.stats()[stat]) for name, cache in
+            (("embeddings", app.state.embedding_cache), ("responses", app.state.response_cache))]
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """
+    Prometheus metrics: per-stage and end-to-end latency histograms labelled by mode,
+    plus cache, embedding-batcher and pipeline-queue gauges once resources are loaded.
+    """
+    gauges = [
+        ("rag_ready", "gauge", "1 once the model and indexes are loaded.", [({}, int(app.state.ready))]),
+        ("rag_pipeline_pending", "gauge", "Requests being embedded, running or queued on the pipeline executor.", [({}, app.state.pending)]),
+        ("rag_pipeline_max_concurrency", "gauge", "Pipeline executor threads.", [({}, MAX_CONCURRENCY)]),
+        ("rag_pipeline_max_queue", "gauge", "Queued requests allowed before new ones get a 503.", [({}, MAX_QUEUE)]),
+    ]
+    if app.state.ready:
+        embedder = app.state.embedder.stats()
+        gauges += [
+            ("rag_embed_queue_depth", "gauge", "Queries waiting for the embedding batcher.", [({}, embedder["queue_depth"])]),
+            ("rag_embed_batches_total", "counter", "encode() calls made by the embedding batcher.", [({}, embedder["batches"])]),
+            ("rag_embed_queue_delay_seconds_sum", "counter", "Total time queries waited for a batch.",
+             [({}, embedder["queue_delay_ms"]["mean"] * embedder["queue_delay_ms"]["count"] / 1000)]),
+            ("rag_embed_queue_delay_seconds_count", "counter", "Queries encoded by the batcher.",
+             [({}, embedder["queue_delay_ms"]["count"])]),
+            ("rag_cache_entries", "gauge", "Entries in each cache.", cache_samples("size")),
+            ("rag_cache_max_entries", "gauge", "Capacity of each cache.", cache_samples("maxsize")),
+            ("rag_cache_hits_total", "counter", "Cache hits.", cache_samples("hits")),
+            ("rag_cache_misses_total", "counter", "Cache misses.", cache_samples("misses")),
+            ("rag_cache_evictions_total", "counter", "Entries evicted to stay within capacity.", cache_samples("evictions")),
+            ("rag_cache_hit_ratio", "gauge", "Hits over lookups since startup.", cache_samples("hit_rate")),
+        ]
+    body = metrics.render([metrics.STAGE_LATENCY, metrics.REQUEST_LATENCY], gauges)
+    return Response(content=body, media_type=metrics.CONTENT_TYPE)
+
+def require_admin(token: Optional[str]):
+    # Fails closed: without a configured token nobody may reload or inspect indexes
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set RAG_ADMIN_TOKEN to enable them.")
+    if not (token and hmac.compare_digest(token, ADMIN_TOKEN)):
+        raise HTTPException(status_code=403, detail="A valid X-Admin-Token header is required.")
+
+def index_status() -> Dict[str, Any]:
+    manager = app.state.indices
+    served = manager.current
+    return {
+        "serving": served.version,
+        "index_type": served.meta["index_type"],
+        "ntotal": int(served.index.ntotal),
+        "loaded_at": served.loaded_at,
+        "in_flight": served.leases,
+        "reload": manager.status,
+        "draining": list(manager.retired),
+        "current": current_version(),
+        "published": list_versions(),
+    }
+
+@app.post("/admin/reload", status_code=202)
+async def admin_reload(request: ReloadRequest, x_admin_token: Optional[str] = Header(None)):
+    """
+    Loads an index version in the background and swaps it in once it is ready; requests
+    keep being served from the current version meanwhile. Poll GET /admin/index to see
+    when the switch has happened.
+    """
+    require_admin(x_admin_token)
+    require_ready()
+    if request.version is not None:
+        if request.version not in list_versions():
+            raise HTTPException(status_code=404, detail=f"Unknown index version: {request.version}")
+        if request.activate:
+            set_current(request.version)
+    threading.Thread(target=reload_index_in_background, args=(request.version, request.force),
+                     name="index-reload", daemon=True).start()
+    return {"status": "loading", "version": request.version or current_version(), **index_status()}
+
+@app.get("/admin/index")
+async def admin_index(x_admin_token: Optional[str] = Header(None)):
+    """The served index version, any reload in progress, and the published versions."""
+    require_admin(x_admin_token)
+    require_ready()
+    return index_status()
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving HTTP, whether or not resources are loaded."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: the model and indexes are loaded and /ask can be served."""
+    if not app.state.ready:
+        detail = {"status": "failed" if app.state.startup_error else "loading", "error": app.state.startup_error}
+        raise HTTPException(status_code=503, detail=detail)
+    return {"status": "ready", "startup_timings": app.state.startup_timings}
@@ -0,0 +1,366 @@
+import json
+import os
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# --- CONFIG ---
+API_URL = "http://127.0.0.1:8000/ask"
+QUESTIONS_FILE = "questions.json"
+FAISS_INDEX_PATH = "data/faiss_index.bin"
+
+def load_questions():
+    with open(QUESTIONS_FILE, 'r') as f:
+        return [q['q'] for q in json.load(f)]
+
+def percentiles(latencies_ms):
+    """
+    Returns p50/p95/p99 latency in milliseconds.
+    """
+    if not latencies_ms:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+def run_load(url, concurrency, total_requests, mode="hybrid"):
+    """
+    Sends total_requests /ask calls from `concurrency` parallel clients and reports
+    throughput, latency percentiles and how many requests were rejected with a 503.
+    """
+    import requests
+
+    questions = load_questions()
+    session = requests.Session()
+
+    def one_request(i):
+        payload = {"q": questions[i % len(questions)], "k": 5, "mode": mode}
+        start = time.perf_counter()
+        try:
+            status = session.post(url, json=payload, timeout=120).status_code
+        except requests.exceptions.RequestException:
+            status = None
+        return status, (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(one_request, range(total_requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [ms for status, ms in outcomes if status == 200]
+    report = {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "ok": len(latencies),
+        "rejected": sum(1 for status, _ in outcomes if status == 503),
+        "errors": sum(1 for status, _ in outcomes if status not in (200, 503)),
+        "throughput_rps": len(latencies) / elapsed,
+    }
+    report.update(percentiles(latencies))
+    return report
+
+def print_load_report(report):
+    p99 = f"{report['p99']:.1f}" if report['p99'] is not None else "n/a"
+    p50 = f"{report['p50']:.1f}" if report['p50'] is not None else "n/a"
+    print(f"  concurrency={report['concurrency']:<3} ok={report['ok']:<5} rejected={report['rejected']:<4} "
+          f"errors={report['errors']:<3} rps={report['throughput_rps']:.1f} p50={p50}ms p99={p99}ms")
+
+def recall_at_k(ground_truth, found, k):
+    """Mean fraction of the exact top-k neighbours that the approximate search returned."""
+    hits = [len(set(gt[:k]) & set(f[:k])) / k for gt, f in zip(ground_truth, found)]
+    return float(np.mean(hits))
+
+def run_ann_benchmark(k=10, n_queries=200, ef_search_values=(16, 32, 64, 128), nprobe_values=(1, 4, 8, 16, 32)):
+    """
+    Builds Flat, HNSW, IVF-Flat and IVF-PQ indexes over the vectors of the saved index and
+    reports recall@k against Flat together with per-query search latency.
+
+    Queries are the questions in questions.json plus a random sample of stored chunk vectors.
+    """
+    import faiss
+    from embed_index import build_faiss_index, index_vectors, EMBEDDING_MODEL_NAME
+
+    ids, vectors = index_vectors(faiss.read_index(FAISS_INDEX_PATH))
+    flat, _ = build_faiss_index(vectors, ids=ids, index_type="flat")
+
+    rng = np.random.default_rng(42)
+    sample = vectors[rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)]
+    try:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu")
+        questions = np.asarray(model.encode(load_questions()), dtype='float32')
+        queries = np.vstack([questions, sample])
+    except ImportError:
+        queries = sample
+    queries = np.ascontiguousarray(queries, dtype='float32')
+
+    def timed_search(index, params=None):
+        found, latencies = [], []
+        for q in queries:
+            start = time.perf_counter()
+            _, ids = index.search(q.reshape(1, -1), k, params=params)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append(ids[0].tolist())
+        return found, latencies
+
+    ground_truth, flat_latencies = timed_search(flat)
+    rows = [("flat", "-", 1.0, float(np.mean(flat_latencies)), percentiles(flat_latencies)["p99"])]
+
+    hnsw, _ = build_faiss_index(vectors, ids=ids, index_type="hnsw")
+    for ef_search in ef_search_values:
+        found, latencies = timed_search(hnsw, faiss.SearchParametersHNSW(efSearch=ef_search))
+        rows.append(("hnsw", f"efSearch={ef_search}", recall_at_k(ground_truth, found, k),
+                     float(np.mean(latencies)), percentiles(latencies)["p99"]))
+
+    for index_type in ("ivf_flat", "ivf_pq"):
+        index, meta = build_faiss_index(vectors, ids=ids, index_type=index_type)
+        for nprobe in nprobe_values:
+            if nprobe > meta["params"]["nlist"]:
+                continue
+            found, latencies = timed_search(index, faiss.SearchParametersIVF(nprobe=nprobe))
+            rows.append((index_type, f"nprobe={nprobe}", recall_at_k(ground_truth, found, k),
+                         float(np.mean(latencies)), percentiles(latencies)["p99"]))
+
+    print(f"ANN benchmark: {flat.ntotal} vectors, {len(queries)} queries, k={k}")
+    print(f"  {'index':<9} {'setting':<14} {'recall@k':>8} {'mean ms':>8} {'p99 ms':>8}")
+    for index_type, setting, recall, mean_ms, p99_ms in rows:
+        print(f"  {index_type:<9} {setting:<14} {recall:>8.3f} {mean_ms:>8.3f} {p99_ms:>8.3f}")
+    return [dict(zip(("index_type", "setting", "recall", "mean_ms", "p99_ms"), row)) for row in rows]
+
+def wait_for(base, path, start, proc, timeout, successes=1):
+    """
+    Polls base + path until it answers 200 `successes` times in a row and returns the
+    seconds since `start`. Raises if the server process exits or timeout passes.
+    """
+    import requests
+
+    streak = 0
+    while time.perf_counter() - start < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited with code {proc.returncode}")
+        try:
+            ok = requests.get(base + path, timeout=1).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        streak = streak + 1 if ok else 0
+        if streak >= successes:
+            return time.perf_counter() - start
+        if not ok:
+            time.sleep(0.05)
+    raise TimeoutError(f"{path} not ready after {timeout}s")
+
+def run_coldstart(runs=3, port=8765, timeout=300):
+    """
+    Starts the API in a fresh uvicorn process and measures, from process start, the time
+    until /healthz answers, /readyz reports ready, and the first /ask returns an answer.
+    """
+    import subprocess
+    import sys
+    import requests
+
+    base = f"http://127.0.0.1:{port}"
+
+    results = []
+    for run in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            live_s = wait_for(base, "/healthz", start, proc, timeout)
+            ready_s = wait_for(base, "/readyz", start, proc, timeout)
+            requests.post(base + "/ask", json={"q": load_questions()[0], "k": 5, "mode": "hybrid"}, timeout=timeout).raise_for_status()
+            first_answer_s = time.perf_counter() - start
+            timings = requests.get(base + "/readyz", timeout=5).json().get("startup_timings", {})
+        finally:
+            proc.terminate()
+            proc.wait()
+        results.append({"live_s": live_s, "ready_s": ready_s, "first_answer_s": first_answer_s, "startup_timings": timings})
+        print(f"  run {run + 1}: healthz={live_s:.2f}s readyz={ready_s:.2f}s first answer={first_answer_s:.2f}s")
+        print(f"    breakdown: {timings}")
+    return results
+
+def run_worker_scaling(worker_counts=(1, 2, 4), concurrency=32, total_requests=400, mode="hybrid", port=8766, timeout=300):
+    """
+    Starts serve.py with each number of workers and load-tests it, to show how throughput
+    scales when the Python parts of the pipeline run on more cores.
+
+    The response and embedding caches are disabled so every request runs the pipeline,
+    and each server gets a warmup round before it is measured.
+    """
+    import subprocess
+    import sys
+
+    base = f"http://127.0.0.1:{port}"
+    env = {**os.environ, "RAG_RESPONSE_CACHE_SIZE": "0", "RAG_EMBED_CACHE_SIZE": "0"}
+    reports = []
+    for workers in worker_counts:
+        proc = subprocess.Popen(
+            [sys.executable, "serve.py", "--workers", str(workers), "--port", str(port)],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            # Connections go to whichever worker accepts first; wait until all of them answer
+            wait_for(base, "/readyz", time.perf_counter(), proc, timeout, successes=4 * workers)
+            run_load(base + "/ask", concurrency, concurrency * 2, mode=mode)
+            report = run_load(base + "/ask", concurrency, total_requests, mode=mode)
+        finally:
+            proc.terminate()
+            proc.wait()
+        report["workers"] = workers
+        report["speedup"] = report["throughput_rps"] / reports[0]["throughput_rps"] if reports else 1.0
+        reports.append(report)
+        print(f"  workers={workers:<3} speedup={report['speedup']:.2f}x", end="")
+        print_load_report(report)
+    return reports
+
+def time_per_call_us(func, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats * 1e6
+
+def run_fusion_benchmark(pool_sizes=(20, 100, 200), repeats=2000, k=5, candidates=None):
+    """
+    Times each fusion method, and the dict-based min-max normalization it replaces, on
+    synthetic candidate pools. Then compares ranking quality on questions.json through the
+    in-process retrieval pipeline. A candidate counts as relevant when it contains at least
+    LABEL_MIN_OVERLAP of the reference answer's terms, as in learned-reranker training.
+    """
+    from fusion import FUSION_METHODS, DEFAULT_ALPHA, fuse
+    from rerank_hybrid import normalize_scores
+
+    rng = np.random.default_rng(42)
+    cost = []
+    print("Fusion cost (us per query):")
+    for n in pool_sizes:
+        vector = rng.random(n)
+        # BM25 only returns some of the candidates
+        keyword = np.where(rng.random(n) < 0.5, rng.random(n) * 20, np.nan)
+        ids = [f"chunk-{i}" for i in range(n)]
+        vector_dict = dict(zip(ids, vector.tolist()))
+        keyword_dict = {chunk_id: score for chunk_id, score in zip(ids, keyword.tolist()) if not np.isnan(score)}
+
+        def dict_minmax():
+            vec_norm, bm25_norm = normalize_scores(vector_dict), normalize_scores(keyword_dict)
+            final = {i: DEFAULT_ALPHA * vec_norm[i] + (1 - DEFAULT_ALPHA) * bm25_norm.get(i, 0.0) for i in ids}
+            return sorted(ids, key=final.get, reverse=True)
+
+        row = {"pool_size": n, "dict_minmax": time_per_call_us(dict_minmax, repeats)}
+        for method in FUSION_METHODS:
+            row[method] = time_per_call_us(lambda: np.argsort(-fuse(vector, keyword, method)[0]), repeats)
+        cost.append(row)
+        print(f"  pool={n:<4} " + " ".join(f"{name}={us:.1f}" for name, us in row.items() if name != "pool_size"))
+
+    import app as rag
+    from rerank_learned import LABEL_MIN_OVERLAP, answer_overlap, tokenize
+
+    rag.app.state.process_start = time.perf_counter()
+    rag.load_resources()
+    with open(QUESTIONS_FILE, 'r') as f:
+        questions = json.load(f)
+    methods = ["baseline"] + list(FUSION_METHODS)
+    totals = {method: {"hit@1": 0.0, f"hit@{k}": 0.0, "mrr": 0.0} for method in methods}
+    try:
+        for item in questions:
+            request = rag.AskRequest(q=item["q"], k=k, candidates=candidates)
+            pool, keyword_scores = rag.retrieve(rag.app.state.indices.current, request)
+            answer_terms = tokenize(item["a"])
+            relevant = {ctx["chunk_id"] for ctx in pool if answer_overlap(answer_terms, ctx["text_snippet"]) >= LABEL_MIN_OVERLAP}
+            for method in methods:
+                contexts = [{**ctx, "scores": dict(ctx["scores"])} for ctx in pool]
+                if method == "baseline":
+                    ranked = rag.rerank(contexts, item["q"], "baseline", keyword_scores)
+                else:
+                    ranked = rag.rerank(contexts, item["q"], "hybrid", keyword_scores, fusion=method)
+                ranks = [rank for rank, ctx in enumerate(ranked, start=1) if ctx["chunk_id"] in relevant]
+                totals[method]["hit@1"] += bool(ranks and ranks[0] == 1)
+                totals[method][f"hit@{k}"] += bool(ranks and ranks[0] <= k)
+                totals[method]["mrr"] += 1.0 / ranks[0] if ranks else 0.0
+    finally:
+        rag.app.state.embedder.close()
+        rag.app.state.indices.current.close()
+
+    quality = {method: {name: value / len(questions) for name, value in metrics.items()} for method, metrics in totals.items()}
+    print(f"Ranking quality over {len(questions)} questions (k={k}):")
+    for method, metrics in quality.items():
+        print(f"  {method:<9} " + " ".join(f"{name}={value:.3f}" for name, value in metrics.items()))
+    return {"cost_us": cost, "quality": quality}
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Performance benchmarks for the Mini RAG service.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    load_parser = subparsers.add_parser("load", help="Concurrent /ask load test against a running server.")
+    load_parser.add_argument("--url", default=API_URL)
+    load_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    load_parser.add_argument("--requests", type=int, default=200)
+    load_parser.add_argument("--mode", default="hybrid")
+    load_parser.add_argument("--label", default="", help="Tag for the run, e.g. 'before' or 'after'.")
+    load_parser.add_argument("--output", help="Write the reports to this JSON file.")
+
+    ann_parser = subparsers.add_parser("ann", help="Recall@k vs latency of HNSW/IVF indexes against the Flat index.")
+    ann_parser.add_argument("--k", type=int, default=10)
+    ann_parser.add_argument("--queries", type=int, default=200)
+    ann_parser.add_argument("--output", help="Write the results to this JSON file.")
+
+    coldstart_parser = subparsers.add_parser("coldstart", help="Time-to-first-answer from process start.")
+    coldstart_parser.add_argument("--runs", type=int, default=3)
+    coldstart_parser.add_argument("--port", type=int, default=8765)
+    coldstart_parser.add_argument("--output", help="Write the results to this JSON file.")
+
+    workers_parser = subparsers.add_parser("workers", help="Throughput of serve.py as the number of workers grows.")
+    workers_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    workers_parser.add_argument("--concurrency", type=int, default=32)
+    workers_parser.add_argument("--requests", type=int, default=400)
+    workers_parser.add_argument("--mode", default="hybrid")
+    workers_parser.add_argument("--port", type=int, default=8766)
+    workers_parser.add_argument("--output", help="Write the reports to this JSON file.")
+
+    fusion_parser = subparsers.add_parser("fusion", help="Cost and ranking quality of the hybrid fusion methods.")
+    fusion_parser.add_argument("--repeats", type=int, default=2000)
+    fusion_parser.add_argument("--k", type=int, default=5)
+    fusion_parser.add_argument("--candidates", type=int, help="Candidate pool size (default: the API's).")
+    fusion_parser.add_argument("--output", help="Write the results to this JSON file.")
+
+    args = parser.parse_args()
+
+    if args.command == "load":
+        print(f"Load test {args.label} against {args.url} (mode={args.mode})")
+        reports = []
+        for concurrency in args.concurrency:
+            report = run_load(args.url, concurrency, args.requests, mode=args.mode)
+            print_load_report(report)
+            reports.append(report)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"label": args.label, "mode": args.mode, "runs": reports}, f, indent=2)
+
+    elif args.command == "ann":
+        results = run_ann_benchmark(k=args.k, n_queries=args.queries)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+
+    elif args.command == "coldstart":
+        print("Cold start benchmark")
+        results = run_coldstart(runs=args.runs, port=args.port)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+
+    elif args.command == "workers":
+        print(f"Worker scaling benchmark ({os.cpu_count()} cores, mode={args.mode})")
+        results = run_worker_scaling(worker_counts=args.workers, concurrency=args.concurrency,
+                                     total_requests=args.requests, mode=args.mode, port=args.port)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+
+    elif args.command == "fusion":
+        results = run_fusion_benchmark(repeats=args.repeats, k=args.k, candidates=args.candidates)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
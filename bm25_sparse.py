@@ -0,0 +1,237 @@
+import json
+import os
+import numpy as np
+from scipy import sparse
+from chunk_store import source_key
+
+# --- CONFIG ---
+SPARSE_BM25_DIR = "data/bm25_index"
+BM25_B = 0.75
+BM25_K1 = 1.2
+
+def analyze(text, analyzer=None):
+    """
+    Tokenizes text with the same StemmingAnalyzer the Whoosh index uses for chunk_text.
+    """
+    if analyzer is None:
+        from whoosh.analysis import StemmingAnalyzer
+        analyzer = StemmingAnalyzer()
+    return [token.text for token in analyzer(text)]
+
+def query_terms(query, analyzer=None):
+    """
+    The terms a keyword query searches for, shared by both backends: the query is
+    analyzed like chunk text and every term must match. Query syntax is not supported:
+    AND/OR/NOT are stopwords, quotes, parentheses, wildcards ('*', '?'), boosts ('^')
+    and 'field:' prefixes are punctuation, so "safety NOT robot" matches chunks with both
+    "safety" and "robot". A repeated term counts once per occurrence.
+    """
+    return analyze(query, analyzer)
+
+def build_sparse_bm25(chunks_data, index_dir=SPARSE_BM25_DIR, B=BM25_B, K1=BM25_K1):
+    """
+    Builds a term x chunk matrix of precomputed BM25 weights and saves it as .npy files
+    that can be memory-mapped at load time.
+
+    The weights follow Whoosh's BM25F scorer (idf, B, K1 and its byte-quantized field
+    lengths), so scores match the Whoosh backend.
+    """
+    from whoosh.analysis import StemmingAnalyzer
+    from whoosh.util.numeric import length_to_byte, byte_to_length
+
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    analyzer = StemmingAnalyzer()
+    vocab = {}
+    rows, cols, tfs = [], [], []
+    doc_lengths = np.zeros(len(chunks_data), dtype=np.float64)
+
+    for doc, chunk in enumerate(chunks_data):
+        counts = {}
+        for term in analyze(chunk['chunk_text'], analyzer):
+            counts[term] = counts.get(term, 0) + 1
+        doc_lengths[doc] = sum(counts.values())
+        for term, tf in counts.items():
+            rows.append(vocab.setdefault(term, len(vocab)))
+            cols.append(doc)
+            tfs.append(tf)
+
+    n_docs = len(chunks_data)
+    tf_matrix = sparse.csr_matrix(
+        (np.array(tfs, dtype=np.float64), (np.array(rows), np.array(cols))),
+        shape=(len(vocab), n_docs)
+    )
+
+    # Whoosh stores field lengths in one byte, so document lengths are quantized the same way
+    avgfl = (doc_lengths.sum() / n_docs) if n_docs else 1.0
+    avgfl = avgfl or 1.0
+    quantized = np.array([byte_to_length(length_to_byte(int(n))) for n in doc_lengths], dtype=np.float64)
+
+    df = np.diff(tf_matrix.indptr)
+    idf = np.log(n_docs / (df + 1)) + 1
+
+    # BM25 weight for every (term, chunk) pair, computed over the non-zero entries only
+    tf = tf_matrix.data
+    doc_of_entry = tf_matrix.indices
+    term_of_entry = np.repeat(np.arange(len(vocab)), df)
+    norm = K1 * ((1 - B) + B * quantized[doc_of_entry] / avgfl)
+    weights = idf[term_of_entry] * (tf * (K1 + 1)) / (tf + norm)
+
+    np.save(os.path.join(index_dir, "data.npy"), weights.astype(np.float32))
+    np.save(os.path.join(index_dir, "indices.npy"), tf_matrix.indices.astype(np.int32))
+    np.save(os.path.join(index_dir, "indptr.npy"), tf_matrix.indptr.astype(np.int32))
+    with open(os.path.join(index_dir, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(index_dir, "meta.json"), "w") as f:
+        json.dump({
+            "doc_ids": [chunk['id'] for chunk in chunks_data],
+            "n_terms": len(vocab),
+            "n_docs": n_docs,
+            "B": B,
+            "K1": K1
+        }, f)
+
+    print(f"Sparse BM25 index built with {len(vocab)} terms over {n_docs} chunks in {index_dir}.")
+
+class SparseBM25:
+    """
+    In-memory BM25 over a memory-mapped term x chunk weight matrix.
+
+    A query is scored against every chunk with one sparse mat-vec. All query terms (see
+    query_terms()) must be present in a chunk for it to match. Source filters are applied
+    to the match mask with precomputed per-source chunk masks. The engine is read-only
+    and safe to share between threads.
+    """
+
+    def __init__(self, index_dir=SPARSE_BM25_DIR):
+        from whoosh.analysis import StemmingAnalyzer
+
+        self.index_dir = index_dir
+        self.analyzer = StemmingAnalyzer()
+
+        with open(os.path.join(index_dir, "vocab.json"), "r") as f:
+            self.vocab = json.load(f)
+        with open(os.path.join(index_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.doc_ids = meta["doc_ids"]
+
+        data = np.load(os.path.join(index_dir, "data.npy"), mmap_mode="r")
+        indices = np.load(os.path.join(index_dir, "indices.npy"), mmap_mode="r")
+        indptr = np.load(os.path.join(index_dir, "indptr.npy"), mmap_mode="r")
+        self.weights = sparse.csr_matrix(
+            (data, indices, indptr), shape=(meta["n_terms"], meta["n_docs"]), copy=False
+        )
+
+        sources = {}
+        doc_sources = np.array([sources.setdefault(source_key(doc_id), len(sources)) for doc_id in self.doc_ids], dtype=np.int64)
+        self.source_codes = sources
+        self.source_masks = np.zeros((len(sources), len(self.doc_ids)), dtype=bool)
+        self.source_masks[doc_sources, np.arange(len(self.doc_ids))] = True
+
+    def source_mask(self, sources=None, exclude_sources=None):
+        """
+        Mask of the chunks from `sources` (all when None) that are not from
+        `exclude_sources`, or None when there is nothing to filter. Sources are file names.
+        """
+        if sources is None and not exclude_sources:
+            return None
+        codes = lambda names: [self.source_codes[name] for name in names if name in self.source_codes]
+        if sources is None:
+            mask = np.ones(len(self.doc_ids), dtype=bool)
+        else:
+            mask = self.source_masks[codes(sources)].any(axis=0)
+        if exclude_sources:
+            mask &= ~self.source_masks[codes(exclude_sources)].any(axis=0)
+        return mask
+
+    def score_all(self, query):
+        """
+        Returns BM25 scores for every chunk (0 where the chunk does not match) and a
+        boolean mask of matching chunks.
+        """
+        n_docs = self.weights.shape[1]
+        counts = {}
+        for term in query_terms(query, self.analyzer):
+            counts[term] = counts.get(term, 0) + 1
+        if not counts or any(term not in self.vocab for term in counts):
+            return np.zeros(n_docs, dtype=np.float32), np.zeros(n_docs, dtype=bool)
+
+        term_ids = [self.vocab[term] for term in counts]
+        query_vec = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        rows = self.weights[term_ids]
+        scores = rows.T @ query_vec
+        matched = rows.getnnz(axis=0) == len(term_ids)
+        return np.where(matched, scores, 0).astype(np.float32), matched
+
+    def search(self, query, k, sources=None, exclude_sources=None):
+        """
+        Returns a dictionary of chunk IDs to BM25 scores for the top k hits, optionally
+        only among the chunks of `sources` and not of `exclude_sources` (file names).
+        """
+        scores, matched = self.score_all(query)
+        mask = self.source_mask(sources, exclude_sources)
+        if mask is not None:
+            matched &= mask
+        hits = np.flatnonzero(matched)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return {self.doc_ids[i]: float(scores[i]) for i in hits}
+
+    def close(self):
+        pass
+
+    __call__ = search
+
+def check_parity(queries, k=10, index_dir=SPARSE_BM25_DIR):
+    """
+    Compares the top-k results of the sparse backend with the Whoosh backend.
+    Returns the queries whose results differ.
+
+    Both backends search the same query_terms(), so queries are passed through as is.
+    Hits tied on score at the k-th position may legitimately differ between backends,
+    so the top-k scores are compared when the ID sets are not identical.
+    """
+    from rerank_hybrid import WhooshBM25
+
+    whoosh_engine = WhooshBM25()
+    sparse_engine = SparseBM25(index_dir)
+    mismatches = []
+    try:
+        for query in queries:
+            expected = whoosh_engine.search(query, k)
+            actual = sparse_engine.search(query, k)
+            if set(expected) == set(actual):
+                continue
+            if len(expected) == len(actual) and np.allclose(
+                    sorted(expected.values()), sorted(actual.values()), rtol=1e-5):
+                continue
+            mismatches.append({"q": query, "whoosh": list(expected), "sparse": list(actual)})
+    finally:
+        whoosh_engine.close()
+    return mismatches
+
+if __name__ == "__main__":
+    import argparse
+    import pickle
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--build", action="store_true", help="Build the sparse BM25 index from chunks.pkl.")
+    parser.add_argument("--check-parity", action="store_true", help="Compare top-k results against Whoosh on questions.json.")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.build:
+        with open("data/chunks.pkl", 'rb') as f:
+            build_sparse_bm25(pickle.load(f))
+
+    if args.check_parity:
+        with open("questions.json", 'r') as f:
+            queries = [q['q'] for q in json.load(f)]
+        mismatches = check_parity(queries, k=args.k)
+        for m in mismatches:
+            print(f"Mismatch for {m['q']!r}:\n  whoosh: {m['whoosh']}\n  sparse: {m['sparse']}")
+        print(f"Top-{args.k} parity: {len(queries) - len(mismatches)}/{len(queries)} queries match.")
+        if mismatches:
+            raise SystemExit(1)
@@ -0,0 +1,205 @@
+import json
+import mmap
+import os
+import shutil
+import numpy as np
+
+# --- CONFIG ---
+CHUNK_STORE_DIR = "data/chunk_store"
+
+def source_key(chunk_id):
+    """The source file a chunk belongs to; ingest.py names chunks '<source_file>-<n>'."""
+    return chunk_id.rsplit("-", 1)[0]
+
+def source_bitmaps(vec_ids, source_idx, n_sources):
+    """
+    One bitmap per source over the vec_id space: bit v of row s is set when vector v
+    belongs to source s. Bits are little-endian within each byte, the layout
+    faiss.IDSelectorBitmap reads.
+    """
+    vec_ids = np.asarray(vec_ids, dtype=np.int64)
+    n_bits = int(vec_ids.max()) + 1 if len(vec_ids) else 0
+    masks = np.zeros((n_sources, n_bits), dtype=bool)
+    masks[np.asarray(source_idx, dtype=np.int64), vec_ids] = True
+    return np.packbits(masks, axis=1, bitorder="little")
+
+def _write_blob(strings, blob_path, offsets_path):
+    """Writes strings as one UTF-8 blob plus an int64 array of n+1 byte offsets."""
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    with open(blob_path, "wb") as f:
+        for i, text in enumerate(strings):
+            data = text.encode("utf-8")
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    np.save(offsets_path, offsets)
+
+def write_chunk_store(chunks_data, store_dir=CHUNK_STORE_DIR):
+    """
+    Writes chunks as a columnar store: text and chunk ids as UTF-8 blobs with offsets,
+    integer metadata columns, and a small source table (one entry per source file, with
+    its title and url) referenced by integer id. Rows are ordered by vec_id so FAISS results map to rows by binary search.
+    Each row also records the vec_id of its near-duplicate cluster's canonical chunk
+    (embed_index.py's dedup stage), or its own vec_id.
+
+    The store is written to a temporary directory and swapped in, so processes that have
+    the old files mapped keep a consistent view.
+    """
+    chunks = sorted(chunks_data, key=lambda c: c.get('vec_id', 0))
+    tmp_dir = store_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    # One source per file; title and url are its attributes, and several files may share them
+    sources, source_idx = {}, []
+    for chunk in chunks:
+        file = chunk.get('source_file') or source_key(chunk['id'])
+        if file not in sources:
+            sources[file] = (len(sources), chunk['source_title'], chunk['source_url'])
+        source_idx.append(sources[file][0])
+
+    vec_ids = np.array([c.get('vec_id', i) for i, c in enumerate(chunks)], dtype=np.int64)
+    ids = [c['id'] for c in chunks]
+    np.save(os.path.join(tmp_dir, "vec_ids.npy"), vec_ids)
+    np.save(os.path.join(tmp_dir, "source_idx.npy"), np.array(source_idx, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, "source_bitmaps.npy"), source_bitmaps(vec_ids, source_idx, len(sources)))
+    vec_id_of = dict(zip(ids, vec_ids.tolist()))
+    canonical = [vec_id_of.get(c.get('canonical_id'), vec_id) for c, vec_id in zip(chunks, vec_ids.tolist())]
+    np.save(os.path.join(tmp_dir, "canonical.npy"), np.array(canonical, dtype=np.int64))
+    for column in ("page", "char_start", "char_end"):
+        values = [c.get(column) if c.get(column) is not None else -1 for c in chunks]
+        np.save(os.path.join(tmp_dir, f"{column}.npy"), np.array(values, dtype=np.int64))
+    # Row numbers sorted by chunk id, for looking up rows by id without a dict
+    np.save(os.path.join(tmp_dir, "id_order.npy"), np.array(sorted(range(len(ids)), key=ids.__getitem__), dtype=np.int64))
+    _write_blob([c['chunk_text'] for c in chunks], os.path.join(tmp_dir, "text.bin"), os.path.join(tmp_dir, "text_offsets.npy"))
+    _write_blob(ids, os.path.join(tmp_dir, "ids.bin"), os.path.join(tmp_dir, "id_offsets.npy"))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({
+            "n_chunks": len(chunks),
+            "sources": [{"title": title, "url": url, "file": file} for file, (_, title, url) in sources.items()],
+        }, f)
+
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+    print(f"Chunk store with {len(chunks)} chunks saved to {store_dir}")
+
+class ChunkStore:
+    """
+    Read-only, memory-mapped view of the columnar chunk store.
+
+    Every column is mapped rather than loaded, so worker processes share the same page
+    cache and startup does not deserialize any per-chunk objects.
+    """
+
+    def __init__(self, store_dir=CHUNK_STORE_DIR):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.sources = [(s["title"], s["url"]) for s in meta["sources"]]
+        self.n_chunks = meta["n_chunks"]
+
+        load = lambda name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode="r")
+        self.vec_ids = load("vec_ids")
+        self.source_idx = load("source_idx")
+        self.page = load("page")
+        self.char_start = load("char_start")
+        self.char_end = load("char_end")
+        self.id_order = load("id_order")
+        self.text_offsets = load("text_offsets")
+        self.id_offsets = load("id_offsets")
+        self._text = self._map(os.path.join(store_dir, "text.bin"))
+        self._ids = self._map(os.path.join(store_dir, "ids.bin"))
+
+        # Stores written before source filtering existed lack these; derive them once here
+        self.source_files = [s.get("file") for s in meta["sources"]]
+        for i, file in enumerate(self.source_files):
+            if file is None:
+                self.source_files[i] = source_key(self.chunk_id(int(np.argmax(self.source_idx == i))))
+        if os.path.exists(os.path.join(store_dir, "source_bitmaps.npy")):
+            self.source_bitmaps = load("source_bitmaps")
+        else:
+            self.source_bitmaps = source_bitmaps(self.vec_ids, self.source_idx, len(self.sources))
+        # Without a dedup stage every chunk is its own canonical chunk
+        self.canonical = load("canonical") if os.path.exists(os.path.join(store_dir, "canonical.npy")) else self.vec_ids
+
+    @staticmethod
+    def _map(path):
+        # mmap cannot map an empty file
+        if os.path.getsize(path) == 0:
+            return b""
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def exists(store_dir=CHUNK_STORE_DIR):
+        return os.path.exists(os.path.join(store_dir, "meta.json"))
+
+    def __len__(self):
+        return self.n_chunks
+
+    def rows_for_vec_ids(self, vec_ids):
+        """Maps FAISS ids to row numbers; ids that are not in the store map to -1."""
+        vec_ids = np.asarray(vec_ids, dtype=np.int64)
+        if not self.n_chunks:
+            return np.full(len(vec_ids), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.vec_ids, vec_ids), self.n_chunks - 1)
+        return np.where(self.vec_ids[rows] == vec_ids, rows, -1)
+
+    def text(self, row):
+        return self._text[self.text_offsets[row]:self.text_offsets[row + 1]].decode("utf-8")
+
+    def chunk_id(self, row):
+        return self._ids[self.id_offsets[row]:self.id_offsets[row + 1]].decode("utf-8")
+
+    def source(self, row):
+        """Returns (source_title, source_url) for a row."""
+        return self.sources[self.source_idx[row]]
+
+    def find_sources(self, names):
+        """
+        Maps source names to source indices. A name matches a source's file name, title or
+        URL, ignoring case. Returns (sorted indices, names that matched nothing).
+        """
+        lookup = {}
+        for i, ((title, url), file) in enumerate(zip(self.sources, self.source_files)):
+            for key in (file, title, url):
+                if key:
+                    lookup.setdefault(key.casefold(), set()).add(i)
+        found, unknown = set(), []
+        for name in names:
+            matches = lookup.get(name.casefold())
+            if matches:
+                found |= matches
+            else:
+                unknown.append(name)
+        return sorted(found), unknown
+
+    def vec_id_bitmap(self, include=None, exclude=()):
+        """
+        Bitmap over vec_ids of the chunks from the `include` sources (every source when None)
+        that are not from an `exclude` source, combined from the per-source bitmaps.
+        """
+        bitmaps = self.source_bitmaps
+        allowed = np.bitwise_or.reduce(bitmaps if include is None else bitmaps[list(include)], axis=0)
+        if len(exclude):
+            allowed &= ~np.bitwise_or.reduce(bitmaps[list(exclude)], axis=0)
+        return allowed
+
+    def row_for_chunk_id(self, chunk_id):
+        """Binary search over the id-sorted row order; returns -1 if the id is unknown."""
+        lo, hi = 0, self.n_chunks
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.chunk_id(self.id_order[mid]) < chunk_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_chunks and self.chunk_id(self.id_order[lo]) == chunk_id:
+            return int(self.id_order[lo])
+        return -1
+
+    def close(self):
+        for blob in (self._text, self._ids):
+            if isinstance(blob, mmap.mmap):
+                blob.close()
@@ -0,0 +1,46 @@
+import numpy as np
+from fusion import minmax
+
+# Query-time diversity for the reranked candidates. Every function takes arrays aligned to
+# the candidates in rank order and returns the positions to keep, in their new order.
+
+# --- CONFIG ---
+DEFAULT_MMR_LAMBDA = 0.7 # Weight of relevance; 1 - lambda penalizes similarity to earlier picks
+
+def collapse_duplicates(canonical):
+    """
+    Keeps the best-ranked candidate of each near-duplicate cluster. `canonical` holds each
+    candidate's cluster id (the canonical chunk's vec_id); rank order is preserved.
+    """
+    _, first = np.unique(np.asarray(canonical), return_index=True)
+    return np.sort(first)
+
+def mmr(relevance, embeddings, k, mmr_lambda=DEFAULT_MMR_LAMBDA):
+    """
+    Maximal marginal relevance: greedily picks the candidate with the highest
+    mmr_lambda * relevance - (1 - mmr_lambda) * (max cosine similarity to the picks so far).
+
+    Relevance (e.g. the reranker's final scores) is min-max scaled so it is on the same
+    0-1 footing as the similarities. The candidate similarity matrix is computed with one
+    matrix product; each of the k picks is then a vectorized update. Returns up to k
+    positions in pick order.
+    """
+    relevance = minmax(np.asarray(relevance, dtype=np.float64))
+    k = min(k, len(relevance))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    unit = np.asarray(embeddings, dtype=np.float32)
+    unit = unit / np.maximum(np.linalg.norm(unit, axis=1, keepdims=True), 1e-12)
+    similarity = unit @ unit.T
+
+    picked = np.zeros(len(relevance), dtype=bool)
+    max_similarity = np.zeros(len(relevance))
+    order = np.empty(k, dtype=np.int64)
+    for step in range(k):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        scores[picked] = -np.inf
+        best = int(np.argmax(scores))
+        order[step] = best
+        picked[best] = True
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return order
@@ -1,61 +1,579 @@
 import sqlite_utils
-from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
 import pickle
-import torch
 import os
+import json
+import hashlib
+import multiprocessing
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from bm25_sparse import SPARSE_BM25_DIR, build_sparse_bm25
+from rerank_hybrid import WHOOSH_INDEX_DIR, build_whoosh_index, update_whoosh_index
+from chunk_store import CHUNK_STORE_DIR, ChunkStore, write_chunk_store
+from encoders import (ENCODER_BACKEND, ENCODER_THREADS, REFERENCE_PATH, check_agreement, load_encoder, load_reference,
+                      reference_sample, sample_texts, save_reference)
 
 # Set a consistent random seed for reproducibility
 np.random.seed(42)
-torch.manual_seed(42)
 
 # --- CONFIG ---
 DB_PATH = "data/chunks.db"
 EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
 FAISS_INDEX_PATH = "data/faiss_index.bin"
 CHUNKS_PATH = "data/chunks.pkl"
+INDEX_META_PATH = "data/index_meta.json"
+# Every artifact of a build is written here first and moved into data/ only once all of
+# them, the FAISS index included, have been written
+BUILD_STAGING_DIR = "data/build.tmp"
 
-def embed_and_index():
+# FAISS index type: "flat" (exact), "hnsw", "ivf_flat" or "ivf_pq"
+INDEX_TYPE = "flat"
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+IVF_NLIST = None # None picks ~4*sqrt(n), capped so every list gets enough training points
+IVF_NPROBE = 8
+PQ_M = 16 # Sub-quantizers; must divide the embedding dimension (384 for MiniLM)
+PQ_NBITS = 8
+
+# Streaming build: chunks are read from SQLite and encoded a page at a time, and their
+# vectors appended to a memory-mapped .npy with a checkpoint after every page
+EMBED_PAGE_SIZE = 1024 # Chunks per page; each page is one encode task
+EMBED_WORKERS = 1 # Encoder processes; 1 encodes in the build process itself
+EMBEDDINGS_PATH = "data/embeddings.npy"
+EMBED_CHECKPOINT_PATH = "data/embeddings_checkpoint.json"
+FAISS_ADD_BATCH_SIZE = 65536 # Vectors read from the memmap per add() call
+IVF_TRAIN_POINTS_PER_LIST = 256 # FAISS samples no more than this per list when training
+
+# Near-duplicate detection: chunks whose embeddings have at least this cosine similarity
+# are clustered, transitively, under one canonical chunk. None disables the dedup stage.
+DEDUP_THRESHOLD = 0.95
+DEDUP_BATCH_SIZE = 1024 # Query vectors per range search
+# Leave chunks whose text exactly repeats an earlier chunk's out of the vector index
+DROP_EXACT_DUPLICATES = False
+
+def default_nlist(n_vectors):
+    # FAISS wants roughly 39 training points per inverted list
+    return max(1, min(int(4 * np.sqrt(n_vectors)), n_vectors // 39))
+
+def training_sample(embeddings, nlist):
+    """
+    The vectors an IVF index is trained on: all of them, or an evenly random sample of
+    IVF_TRAIN_POINTS_PER_LIST per list, read from a memmap in file order.
+    """
+    n = len(embeddings)
+    size = min(n, nlist * IVF_TRAIN_POINTS_PER_LIST)
+    if size == n:
+        return np.ascontiguousarray(embeddings, dtype='float32')
+    return np.ascontiguousarray(embeddings[np.sort(np.random.choice(n, size, replace=False))], dtype='float32')
+
+def add_vectors(index, embeddings, ids):
+    """Adds (memory-mapped) embeddings under ids, FAISS_ADD_BATCH_SIZE rows at a time."""
+    for start in range(0, len(embeddings), FAISS_ADD_BATCH_SIZE):
+        end = start + FAISS_ADD_BATCH_SIZE
+        index.add_with_ids(np.ascontiguousarray(embeddings[start:end], dtype='float32'), ids[start:end])
+
+def build_faiss_index(embeddings, ids=None, index_type=INDEX_TYPE, hnsw_m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION,
+                      ef_search=HNSW_EF_SEARCH, nlist=IVF_NLIST, nprobe=IVF_NPROBE, pq_m=PQ_M, pq_nbits=PQ_NBITS,
+                      encoder_backend=ENCODER_BACKEND):
+    """
+    Builds an inner-product FAISS index of the given type over float32 embeddings, which
+    may be a read-only memmap. Returns the index and a metadata dict describing how it was
+    built.
+
+    Vectors are stored under `ids` (chunk vec_ids, default 0..n-1) so they can later be
+    removed or replaced individually. Flat and HNSW indexes are wrapped in an IndexIDMap2
+    for this; IVF indexes store ids natively.
+    """
+    n, dim = embeddings.shape
+    ids = np.arange(n, dtype='int64') if ids is None else np.asarray(ids, dtype='int64')
+    params = {}
+
+    if index_type == "flat":
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+    elif index_type == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = ef_construction
+        hnsw.hnsw.efSearch = ef_search
+        index = faiss.IndexIDMap2(hnsw)
+        params = {"M": hnsw_m, "efConstruction": ef_construction, "efSearch": ef_search}
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = nlist or default_nlist(n)
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+            params.update({"pq_m": pq_m, "pq_nbits": pq_nbits})
+        print(f"Training {index_type} index with nlist={nlist}...")
+        index.train(training_sample(embeddings, nlist))
+        index.nprobe = nprobe
+        params.update({"nlist": nlist, "nprobe": nprobe})
+    else:
+        raise ValueError(f"Unknown index type: {index_type}")
+
+    add_vectors(index, embeddings, ids)
+    meta = {
+        "index_type": index_type,
+        "metric": "inner_product",
+        "dim": dim,
+        "ntotal": int(index.ntotal),
+        "params": params,
+        "embedding_model": EMBEDDING_MODEL_NAME,
+        "encoder_backend": encoder_backend,
+        "id_mapped": True,
+        "next_vec_id": int(ids.max()) + 1 if n else 0,
+    }
+    return index, meta
+
+def index_vectors(index):
+    """
+    Returns (ids, vectors) for every vector stored in a Flat or HNSW index, with or
+    without an IndexIDMap wrapper.
+    """
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        ids = faiss.vector_to_array(index.id_map).astype('int64')
+        return ids, faiss.downcast_index(index.index).reconstruct_n(0, index.ntotal)
+    return np.arange(index.ntotal, dtype='int64'), index.reconstruct_n(0, index.ntotal)
+
+def near_duplicate_pairs(index, embeddings, vec_ids, threshold=DEDUP_THRESHOLD, batch_size=DEDUP_BATCH_SIZE):
+    """
+    Range-searches `embeddings` (a memmap, read batch_size rows at a time) against the
+    built index. Returns (vec_ids, neighbour vec_ids) for every pair whose inner product
+    (cosine similarity for the normalized sentence embeddings) is above `threshold`.
+    """
+    sources, targets = [np.zeros(0, dtype='int64')], [np.zeros(0, dtype='int64')]
+    for start in range(0, len(embeddings), batch_size):
+        batch = np.ascontiguousarray(embeddings[start:start + batch_size], dtype='float32')
+        lims, _, labels = index.range_search(batch, threshold)
+        # FAISS returns lims as uint64, which np.repeat will not cast to a count
+        sources.append(np.repeat(vec_ids[start:start + len(batch)], np.diff(lims).astype(np.int64)))
+        targets.append(labels.astype('int64'))
+    return np.concatenate(sources), np.concatenate(targets)
+
+def near_duplicate_clusters(n, sources, targets):
+    """
+    Single-linkage clusters of n items given the similar pairs as position arrays: the
+    connected components of the pair graph. Returns, per item, the position of its
+    cluster's first item.
+    """
+    from scipy import sparse
+    from scipy.sparse.csgraph import connected_components
+
+    if n == 0:
+        return np.zeros(0, dtype='int64')
+    graph = sparse.csr_matrix((np.ones(len(sources), dtype=np.int8), (sources, targets)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    first = np.full(labels.max() + 1, n, dtype='int64')
+    np.minimum.at(first, labels, np.arange(n))
+    return first[labels]
+
+def exact_duplicates(db):
+    """Maps each live chunk whose text repeats an earlier chunk's (by id) to that chunk's id."""
+    first, duplicates = {}, {}
+    for row in db.query("SELECT id, content_hash FROM chunks WHERE deleted = 0 ORDER BY id"):
+        canonical = first.setdefault(row["content_hash"], row["id"])
+        if canonical != row["id"]:
+            duplicates[row["id"]] = canonical
+    return duplicates
+
+def moved_chunks(db):
+    """
+    Compares the chunk store of the last build, which lists every vector in the index,
+    with chunks.db. ingest.py hands a vector to the chunk that now holds its text when an
+    edit shifts chunks to new ids, so the vector needs no re-embedding but the keyword
+    index must learn the new id, and the vector the receiving chunk had before is no
+    longer referenced by any chunk.
+
+    Returns the moved chunks (id, chunk_text), the ids the last build indexed that no
+    longer have a vector, and the vec_ids no chunk references.
+    """
+    if not ChunkStore.exists():
+        return [], [], []
+    store = ChunkStore()
+    built = {int(vec_id): store.chunk_id(row) for row, vec_id in enumerate(store.vec_ids)}
+    current = {row["vec_id"]: row["id"] for row in db.query("SELECT id, vec_id FROM chunks WHERE deleted = 0 AND vec_id IS NOT NULL")}
+    referenced = {row[0] for row in db.execute("SELECT vec_id FROM chunks WHERE vec_id IS NOT NULL")}
+    moved = sorted(chunk_id for vec_id, chunk_id in current.items() if built.get(vec_id, chunk_id) != chunk_id)
+    unindexed = sorted(set(built.values()) - set(current.values()))
+    orphaned = sorted(vec_id for vec_id in built if vec_id not in referenced)
+    moved_rows = list(db["chunks"].rows_where(f"id IN ({', '.join('?' * len(moved))})", moved, select="id, chunk_text")) if moved else []
+    return moved_rows, unindexed, orphaned
+
+def dedup_chunks(db, index, embeddings=None, vec_ids=None, threshold=DEDUP_THRESHOLD, dropped=None):
+    """
+    Dedup stage: clusters the indexed chunks into near-duplicate groups and records each
+    chunk's canonical chunk (the lowest vec_id in its cluster, itself for most chunks) in
+    the chunks table's canonical_id column.
+
+    Only the vectors embedded by this build are read, from the `embeddings` memmap (rows
+    aligned with `vec_ids`) a batch at a time, and range-searched against the built index.
+    Pairs between chunks that were not re-embedded are carried over from their recorded
+    canonical_id, so an incremental build does not touch the rest of the corpus; a full
+    build reclusters everything. Chunks in `dropped` (exact duplicates left out of the
+    index) get the canonical chunk of the chunk they repeat. Returns a summary for the
+    index metadata.
+
+    The updates are not committed here; embed_and_index() commits them with the rest of
+    the build.
+    """
+    dropped = dropped or {}
+    canonical_ids = {}
+    rows = []
+    if threshold is not None:
+        rows = list(db["chunks"].rows_where("deleted = 0 AND vec_id IS NOT NULL", order_by="vec_id", select="id, vec_id, canonical_id"))
+    if rows:
+        indexed = np.array([row["vec_id"] for row in rows], dtype='int64')
+        vec_ids = np.zeros(0, dtype='int64') if vec_ids is None else np.asarray(vec_ids, dtype='int64')
+        embedded = np.isin(indexed, vec_ids)
+        pairs = [np.zeros((0, 2), dtype='int64')]
+
+        if embeddings is not None and len(vec_ids):
+            print(f"Clustering {len(vec_ids)} new vectors against {index.ntotal} at cosine similarity > {threshold}...")
+            sources, neighbours = near_duplicate_pairs(index, embeddings, vec_ids, threshold)
+            # Index ids to positions; neighbours no live chunk references are left out
+            targets = np.minimum(np.searchsorted(indexed, neighbours), len(indexed) - 1)
+            live = indexed[targets] == neighbours
+            pairs.append(np.column_stack([np.searchsorted(indexed, sources), targets])[live])
+
+        position = {row["id"]: i for i, row in enumerate(rows)}
+        carried = [(i, position[row["canonical_id"]]) for i, row in enumerate(rows)
+                   if row["canonical_id"] in position and not embedded[i] and not embedded[position[row["canonical_id"]]]]
+        if carried:
+            pairs.append(np.array(carried, dtype='int64'))
+        pairs = np.concatenate(pairs)
+        canonical = near_duplicate_clusters(len(rows), pairs[:, 0], pairs[:, 1])
+        canonical_ids = {row["id"]: rows[c]["id"] for row, c in zip(rows, canonical)}
+    for chunk_id, repeated in dropped.items():
+        canonical_ids[chunk_id] = canonical_ids.get(repeated, repeated)
+
+    db.conn.execute("UPDATE chunks SET canonical_id = NULL")
+    db.conn.executemany("UPDATE chunks SET canonical_id = ? WHERE id = ?",
+                        [(canonical, chunk_id) for chunk_id, canonical in canonical_ids.items()])
+    duplicates = [canonical for chunk_id, canonical in canonical_ids.items() if chunk_id != canonical]
+    duplicates, clusters = len(duplicates), len(set(duplicates))
+    if canonical_ids:
+        print(f"Dedup: {duplicates} chunks collapse onto {clusters} canonical chunks; {len(dropped)} exact duplicates not indexed.")
+    return {"threshold": threshold, "duplicates": duplicates, "clusters": clusters, "dropped_exact": len(dropped)}
+
+def iter_chunk_pages(db, ids, start=0, page_size=EMBED_PAGE_SIZE):
+    """
+    Yields the texts of the chunks in `ids` (sorted as SQLite sorts them), page_size at a
+    time, from ids[start] on. Each page is one range scan over the primary key, so only
+    one page of text is in memory.
+    """
+    for begin in range(start, len(ids), page_size):
+        page = ids[begin:begin + page_size]
+        wanted = set(page)
+        texts = {row["id"]: row["chunk_text"] for row in db["chunks"].rows_where(
+            "id >= ? AND id <= ?", [page[0], page[-1]], select="id, chunk_text") if row["id"] in wanted}
+        yield [texts[chunk_id] for chunk_id in page]
+
+# Set in each encoder worker process by _init_encode_worker()
+_worker_encoder = None
+
+def _init_encode_worker(backend, threads):
+    global _worker_encoder
+    _worker_encoder = load_encoder(backend, threads=threads)
+
+def _encode_page(texts):
+    return _worker_encoder.encode(texts)
+
+def encode_to_memmap(db, rows, encoder, workers=EMBED_WORKERS, encoder_threads=ENCODER_THREADS, page_size=EMBED_PAGE_SIZE,
+                     path=EMBEDDINGS_PATH, checkpoint_path=EMBED_CHECKPOINT_PATH):
+    """
+    Encodes the chunks in `rows` (dicts with id and content_hash, in id order) into a
+    float32 (n, dim) .npy at `path`, written through a memmap one page at a time, and
+    returns it opened read-only.
+
+    With workers > 1 pages are encoded by that many spawned processes, each with its own
+    encoder; at most two pages per worker are in flight and results are written in
+    order. After each page the checkpoint records how many rows are done. A later call
+    for the same chunks, content and encoder resumes from there; anything else starts over.
+    """
+    ids = [row["id"] for row in rows]
+    digest = hashlib.sha1()
+    for row in rows:
+        digest.update(f"{row['id']}\t{row['content_hash']}\n".encode("utf-8"))
+    job = {"n": len(ids), "dim": encoder.dim, "encoder_backend": encoder.backend,
+           "embedding_model": EMBEDDING_MODEL_NAME, "chunks_sha1": digest.hexdigest()}
+
+    done = 0
+    if os.path.exists(checkpoint_path) and os.path.exists(path):
+        with open(checkpoint_path, 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint["job"] == job:
+            done = checkpoint["done"]
+            print(f"Resuming embedding at chunk {done}/{len(ids)} from {checkpoint_path}.")
+    if done:
+        embeddings = np.lib.format.open_memmap(path, mode="r+")
+    else:
+        embeddings = np.lib.format.open_memmap(path, mode="w+", dtype='float32', shape=(len(ids), encoder.dim))
+
+    def write(vectors):
+        nonlocal done
+        embeddings[done:done + len(vectors)] = vectors
+        embeddings.flush()
+        done += len(vectors)
+        tmp_path = checkpoint_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"job": job, "done": done}, f)
+        os.replace(tmp_path, checkpoint_path)
+        print(f"Encoded {done}/{len(ids)} chunks")
+
+    print(f"Generating embeddings for {len(ids) - done} chunks with the {encoder.backend} encoder ({workers} workers)...")
+    pages = iter_chunk_pages(db, ids, done, page_size)
+    if workers <= 1:
+        for texts in pages:
+            write(encoder.encode(texts))
+    else:
+        threads = encoder_threads or max(1, (os.cpu_count() or 1) // workers)
+        # Spawned, not forked: the parent has already started torch's and ONNX's thread pools
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_encode_worker,
+                                 initargs=(encoder.backend, threads)) as pool:
+            in_flight = deque()
+            for texts in pages:
+                in_flight.append(pool.submit(_encode_page, texts))
+                if len(in_flight) >= 2 * workers:
+                    write(in_flight.popleft().result())
+            while in_flight:
+                write(in_flight.popleft().result())
+    embeddings.flush()
+    return np.load(path, mmap_mode="r")
+
+def clear_embedding_checkpoint(path=EMBEDDINGS_PATH, checkpoint_path=EMBED_CHECKPOINT_PATH):
+    """Deletes the build's embeddings file and checkpoint once the index has been saved."""
+    for file in (checkpoint_path, path):
+        if os.path.exists(file):
+            os.remove(file)
+
+def staged_path(path, staging_dir=BUILD_STAGING_DIR):
+    return os.path.join(staging_dir, os.path.basename(path))
+
+def swap_in_staged(paths, staging_dir=BUILD_STAGING_DIR):
+    """
+    Moves the staged artifacts over the ones in data/, in the order given. Files are
+    replaced atomically; a directory is removed and its staged copy renamed into place.
+    """
+    for path in paths:
+        staged = staged_path(path, staging_dir)
+        if os.path.isdir(staged) and os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(staged, path)
+    shutil.rmtree(staging_dir)
+
+def load_index_meta():
+    if not (os.path.exists(FAISS_INDEX_PATH) and os.path.exists(INDEX_META_PATH)):
+        return None
+    with open(INDEX_META_PATH, 'r') as f:
+        return json.load(f)
+
+def embed_and_index(index_type=INDEX_TYPE, full=False, encoder_backend=ENCODER_BACKEND, encoder_threads=ENCODER_THREADS,
+                    dedup_threshold=DEDUP_THRESHOLD, drop_exact_duplicates=DROP_EXACT_DUPLICATES, workers=EMBED_WORKERS,
+                    page_size=EMBED_PAGE_SIZE, **index_params):
     """
     Loads text chunks from the database, generates embeddings, and builds a FAISS index.
+
+    By default only chunks that are new or whose content_hash changed since they were last
+    embedded are encoded; their old vectors and those of tombstoned chunks are removed from
+    the FAISS and Whoosh indexes. A full rebuild happens with full=True, when the index type
+    or encoder backend changes, or when an HNSW index would need vectors removed (HNSW
+    cannot delete).
+
+    Embeddings are streamed: chunks are read and encoded page by page (across `workers`
+    processes) into a memory-mapped file that the FAISS index is built from, so memory
+    holds one page of text per worker rather than the corpus. Progress is checkpointed, so
+    rerunning an interrupted build resumes encoding where it stopped.
+
+    A non-PyTorch encoder must agree with PyTorch on a sample of chunks before it is used.
+    The sample and its PyTorch embeddings are saved so the API can run the same check when
+    it queries with a different backend than the index was built with.
+
+    After indexing, the dedup stage records each chunk's near-duplicate cluster (see
+    dedup_chunks()). With drop_exact_duplicates, chunks whose text repeats an earlier
+    chunk's are not embedded at all and any vectors they had are removed.
     """
     db = sqlite_utils.Database(DB_PATH)
-    
-    # Load model and set to CPU
-    device = "cpu"
-    print(f"Loading Sentence-Transformer model: {EMBEDDING_MODEL_NAME} on {device}")
-    model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
-    
-    # Fetch all chunks
-    chunks_data = list(db["chunks"].rows_where())
-    texts = [row["chunk_text"] for row in chunks_data]
-    
-    print(f"Generating embeddings for {len(texts)} chunks...")
-    embeddings = model.encode(texts, show_progress_bar=True)
-    embeddings = np.array(embeddings).astype('float32') # FAISS requires float32
-    
-    # Check if embeddings are non-empty
-    if embeddings.shape[0] == 0:
-        print("Error: No embeddings generated. Exiting.")
+    if "vec_id" not in db["chunks"].columns_dict:
+        print("Error: chunks table has no vec_id column. Run `python ingest.py --full` first.")
         return
 
-    print(f"Creating FAISS index with dimension {embeddings.shape[1]}...")
-    # L2 distance is an alternative, but for sentence-transformers, cosine similarity is preferred.
-    # The inner product index (IP) finds maximum score, which corresponds to highest cosine similarity
-    # for normalized vectors. Sentence-transformers' embeddings are already normalized by default.
-    index = faiss.IndexFlatIP(embeddings.shape[1])
-    index.add(embeddings)
-    
-    # Save the index and the chunks_data for later lookup
-    faiss.write_index(index, FAISS_INDEX_PATH)
-    
-    with open(CHUNKS_PATH, 'wb') as f:
-        pickle.dump(chunks_data, f)
-        
+    # Vectors that no longer match a live chunk, and live chunks that need a (new) vector
+    stale_rows = list(db["chunks"].rows_where(
+        "vec_id IS NOT NULL AND (deleted = 1 OR embedded_hash IS NOT content_hash)", select="id, vec_id, deleted"))
+    todo_rows = list(db["chunks"].rows_where(
+        "deleted = 0 AND (vec_id IS NULL OR embedded_hash IS NOT content_hash)", order_by="id"))
+    # Exact duplicates are treated like deleted chunks: no new vector, and any old one goes
+    dropped = exact_duplicates(db) if drop_exact_duplicates else {}
+    if dropped:
+        stale_rows += [row for row in db["chunks"].rows_where(
+            "deleted = 0 AND vec_id IS NOT NULL AND embedded_hash IS content_hash", select="id, vec_id, deleted") if row["id"] in dropped]
+        todo_rows = [row for row in todo_rows if row["id"] not in dropped]
+    removed = lambda row: row["deleted"] or row["id"] in dropped
+
+    meta = load_index_meta()
+    # Indexes built before encoder backends were recorded used PyTorch
+    incremental = (not full and meta is not None and meta.get("id_mapped")
+                   and meta["index_type"] == index_type and meta.get("encoder_backend", "torch") == encoder_backend)
+    # Vectors ingest.py moved to a chunk's new id stay in the index under the same vec_id
+    moved_rows, unindexed, orphaned = moved_chunks(db) if incremental else ([], [], [])
+    if incremental:
+        # Every vector in the index should be referenced by a chunk, apart from the ones a
+        # moved vector replaced. After `ingest.py --full` recreates the chunks table none
+        # are, and adding every chunk again would leave the old vectors in the index as
+        # orphans that take up search results
+        referenced = db.execute("SELECT COUNT(*) FROM chunks WHERE vec_id IS NOT NULL").fetchone()[0]
+        if referenced == 0 or referenced + len(orphaned) != meta.get("ntotal"):
+            print(f"chunks.db references {referenced} vectors but the index holds {meta.get('ntotal')}; rebuilding from scratch.")
+            incremental = False
+    if incremental and index_type == "hnsw" and (stale_rows or orphaned):
+        print("HNSW indexes cannot remove vectors; rebuilding from scratch.")
+        incremental = False
+
+    if incremental and not stale_rows and not todo_rows and not moved_rows and not unindexed and not orphaned:
+        print("Index is up to date; nothing to embed.")
+        return
+
+    # Load the encoder (CPU) and check it against PyTorch on a sample of the corpus
+    print(f"Loading {encoder_backend} encoder for {EMBEDDING_MODEL_NAME}")
+    encoder = load_encoder(encoder_backend, threads=encoder_threads, export=True)
+    reference_ids = sample_texts([row["id"] for row in db["chunks"].rows_where("deleted = 0", order_by="id", select="id")])
+    reference_rows = list(db["chunks"].rows_where(f"id IN ({', '.join('?' * len(reference_ids))})", reference_ids,
+                                                  order_by="id", select="id, content_hash, chunk_text"))
+    reference_texts = [row["chunk_text"] for row in reference_rows]
+    # The PyTorch reference is re-encoded only when the sampled chunks or their text changed
+    sample = [f"{row['id']}:{row['content_hash']}" for row in reference_rows]
+    if reference_sample(REFERENCE_PATH) == sample:
+        _, reference_embeddings = load_reference(REFERENCE_PATH)
+    else:
+        torch_encoder = encoder if encoder.backend == "torch" else load_encoder("torch", threads=encoder_threads)
+        reference_embeddings = torch_encoder.encode(reference_texts)
+    if encoder.backend != "torch":
+        report = check_agreement(encoder, reference_texts, reference_embeddings)
+        print(f"Encoder agreement with PyTorch: min cosine {report['min_cosine']}, mean cosine {report['mean_cosine']}")
+        if not report["passed"]:
+            print(f"Error: the {encoder_backend} encoder does not agree with PyTorch. Exiting.")
+            return
+
+    if incremental:
+        index = faiss.read_index(FAISS_INDEX_PATH)
+        stale_ids = np.array([row["vec_id"] for row in stale_rows] + orphaned, dtype='int64')
+        if len(stale_ids):
+            index.remove_ids(stale_ids)
+        vec_ids = np.arange(meta["next_vec_id"], meta["next_vec_id"] + len(todo_rows), dtype='int64')
+        embeddings = encode_to_memmap(db, todo_rows, encoder, workers, encoder_threads, page_size) if todo_rows else None
+        if todo_rows:
+            add_vectors(index, embeddings, vec_ids)
+        meta.update({"ntotal": int(index.ntotal), "next_vec_id": meta["next_vec_id"] + len(todo_rows)})
+        print(f"FAISS index updated: {len(todo_rows)} vectors added, {len(stale_ids)} removed, {len(moved_rows)} moved to a new chunk id.")
+    else:
+        # Fetch the ids of all live chunks; their text is read page by page while encoding
+        # Ingestion writes documents concurrently, so order explicitly for a reproducible index
+        todo_rows = [row for row in db["chunks"].rows_where("deleted = 0", order_by="id", select="id, content_hash")
+                     if row["id"] not in dropped]
+        if not todo_rows:
+            print("Error: No chunks to embed. Exiting.")
+            return
+        embeddings = encode_to_memmap(db, todo_rows, encoder, workers, encoder_threads, page_size)
+
+        print(f"Creating {index_type} FAISS index with dimension {embeddings.shape[1]}...")
+        # L2 distance is an alternative, but for sentence-transformers, cosine similarity is preferred.
+        # The inner product index (IP) finds maximum score, which corresponds to highest cosine similarity
+        # for normalized vectors. Sentence-transformers' embeddings are already normalized by default.
+        vec_ids = np.arange(len(todo_rows), dtype='int64')
+        index, meta = build_faiss_index(embeddings, ids=vec_ids, index_type=index_type, encoder_backend=encoder_backend, **index_params)
+
+    if "canonical_id" not in db["chunks"].columns_dict:
+        db["chunks"].add_column("canonical_id", str)
+    # Every chunks.db update below is one transaction, committed only after the artifacts
+    # are in place. They are all written to BUILD_STAGING_DIR first and moved into data/
+    # only once every one of them, the FAISS index included, has been written: incremental
+    # runs trust chunks.db, so a build that fails part way must leave it, and every
+    # artifact, describing the index still on disk
+    if os.path.exists(BUILD_STAGING_DIR):
+        shutil.rmtree(BUILD_STAGING_DIR)
+    os.makedirs(BUILD_STAGING_DIR)
+    with db.conn:
+        # Record which vector now backs each chunk
+        if not incremental:
+            db.conn.execute("UPDATE chunks SET vec_id = NULL, embedded_hash = NULL")
+        db.conn.executemany(
+            "UPDATE chunks SET vec_id = NULL, embedded_hash = NULL WHERE id = ?",
+            [(row["id"],) for row in stale_rows if removed(row)])
+        db.conn.executemany(
+            "UPDATE chunks SET vec_id = ?, embedded_hash = content_hash WHERE id = ?",
+            [(int(vec_id), row["id"]) for vec_id, row in zip(vec_ids, todo_rows)])
+
+        meta["dedup"] = dedup_chunks(db, index, embeddings, vec_ids, dedup_threshold, dropped)
+
+        chunks_data = list(db["chunks"].rows_where("deleted = 0 AND vec_id IS NOT NULL", order_by="vec_id"))
+        # The API maps the columnar chunk store; chunks.pkl is kept for offline scripts
+        write_chunk_store(chunks_data, staged_path(CHUNK_STORE_DIR))
+        with open(staged_path(CHUNKS_PATH), 'wb') as f:
+            pickle.dump(chunks_data, f)
+
+        # Keep the keyword indexes in step with the vectors; an incremental update is
+        # applied to a copy of the Whoosh index
+        deleted_ids = sorted({row["id"] for row in stale_rows if removed(row)} | set(unindexed))
+        whoosh_dir = staged_path(WHOOSH_INDEX_DIR)
+        if incremental and os.path.isdir(WHOOSH_INDEX_DIR):
+            shutil.copytree(WHOOSH_INDEX_DIR, whoosh_dir, ignore=shutil.ignore_patterns("*WRITELOCK"))
+        if not (incremental and update_whoosh_index(todo_rows + moved_rows, deleted_ids, whoosh_dir)):
+            build_whoosh_index(chunks_data, whoosh_dir)
+        # The in-memory BM25 backend is cheap to rebuild from the same chunk list
+        build_sparse_bm25(chunks_data, staged_path(SPARSE_BM25_DIR))
+
+        # Save the index and its metadata
+        faiss.write_index(index, staged_path(FAISS_INDEX_PATH))
+        with open(staged_path(INDEX_META_PATH), 'w') as f:
+            json.dump(meta, f, indent=2)
+        save_reference(reference_texts, reference_embeddings, staged_path(REFERENCE_PATH), sample)
+
+        swap_in_staged([CHUNK_STORE_DIR, CHUNKS_PATH, WHOOSH_INDEX_DIR, SPARSE_BM25_DIR, REFERENCE_PATH,
+                        FAISS_INDEX_PATH, INDEX_META_PATH])
+    clear_embedding_checkpoint()
+
     print(f"FAISS index saved to {FAISS_INDEX_PATH}")
     print(f"Chunk data saved to {CHUNKS_PATH}")
 
 if __name__ == "__main__":
-    embed_and_index()
-    # To run: python embed_index.py
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--full", action="store_true", help="Re-embed every chunk and rebuild the indexes.")
+    parser.add_argument("--index-type", default=INDEX_TYPE, choices=["flat", "hnsw", "ivf_flat", "ivf_pq"])
+    parser.add_argument("--hnsw-m", type=int, default=HNSW_M)
+    parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION)
+    parser.add_argument("--ef-search", type=int, default=HNSW_EF_SEARCH)
+    parser.add_argument("--nlist", type=int, default=IVF_NLIST)
+    parser.add_argument("--nprobe", type=int, default=IVF_NPROBE)
+    parser.add_argument("--pq-m", type=int, default=PQ_M)
+    parser.add_argument("--pq-nbits", type=int, default=PQ_NBITS)
+    parser.add_argument("--encoder-backend", default=ENCODER_BACKEND, choices=["torch", "onnx", "onnx-int8"])
+    parser.add_argument("--encoder-threads", type=int, default=ENCODER_THREADS)
+    parser.add_argument("--workers", type=int, default=EMBED_WORKERS, help="Encoder processes.")
+    parser.add_argument("--page-size", type=int, default=EMBED_PAGE_SIZE, help="Chunks read and encoded per page.")
+    parser.add_argument("--dedup-threshold", type=float, default=DEDUP_THRESHOLD,
+                        help="Cosine similarity at which chunks count as near-duplicates.")
+    parser.add_argument("--no-dedup", action="store_true", help="Skip near-duplicate clustering.")
+    parser.add_argument("--drop-exact-duplicates", action="store_true", default=DROP_EXACT_DUPLICATES,
+                        help="Do not index chunks whose text repeats an earlier chunk's.")
+    parser.add_argument("--publish", action="store_true", help="Publish the built index as a new version and make it current.")
+    args = parser.parse_args()
+
+    embed_and_index(
+        index_type=args.index_type, full=args.full, encoder_backend=args.encoder_backend,
+        encoder_threads=args.encoder_threads, dedup_threshold=None if args.no_dedup else args.dedup_threshold,
+        drop_exact_duplicates=args.drop_exact_duplicates, workers=args.workers, page_size=args.page_size,
+        hnsw_m=args.hnsw_m, ef_construction=args.ef_construction,
+        ef_search=args.ef_search, nlist=args.nlist, nprobe=args.nprobe, pq_m=args.pq_m, pq_nbits=args.pq_nbits
+    )
+    if args.publish:
+        # A running API loads the new version in the background and switches to it when ready
+        from index_versions import publish
+        publish()
+    # To run: python embed_index.py [--index-type hnsw] [--encoder-backend onnx-int8] [--workers 4] [--full] [--publish]
@@ -0,0 +1,259 @@
+import os
+import json
+import numpy as np
+
+# torch/sentence-transformers and onnxruntime are imported by the backend that needs them,
+# so a process serving the ONNX backend never imports torch.
+
+# --- CONFIG ---
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# Query/chunk encoder backend: "torch" (fp32 PyTorch), "onnx" (fp32 ONNX Runtime) or
+# "onnx-int8" (ONNX Runtime with dynamically quantized int8 weights)
+ENCODER_BACKEND = os.environ.get("RAG_ENCODER_BACKEND", "torch")
+ENCODER_BACKENDS = ("torch", "onnx", "onnx-int8")
+# Intra-op threads for the encoder (0 keeps the library default of one per core)
+ENCODER_THREADS = int(os.environ.get("RAG_ENCODER_THREADS", 0))
+ONNX_DIR = "data/onnx"
+ONNX_OPSET = 14
+# Chunk texts and their PyTorch embeddings, written by embed_index.py, that other
+# backends are compared against
+REFERENCE_PATH = "data/encoder_reference.npz"
+REFERENCE_SAMPLE_SIZE = 64
+# An encoder agrees with PyTorch when every sample embedding is at least this similar
+AGREEMENT_MIN_COSINE = 0.97
+AGREEMENT_MIN_MEAN_COSINE = 0.99
+
+class TorchEncoder:
+    """SentenceTransformer on CPU in fp32."""
+
+    backend = "torch"
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, threads=ENCODER_THREADS):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        # Set a consistent random seed for reproducibility
+        torch.manual_seed(42)
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False):
+        """Returns a float32 (n, dim) array of embeddings."""
+        embeddings = self.model.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar, convert_to_tensor=False)
+        return np.asarray(embeddings, dtype='float32')
+
+class OnnxEncoder:
+    """
+    The exported transformer run by ONNX Runtime, with the SentenceTransformer pooling
+    (attention-masked mean) and normalization reimplemented in NumPy.
+    """
+
+    def __init__(self, onnx_dir=ONNX_DIR, quantized=False, threads=ENCODER_THREADS):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.backend = "onnx-int8" if quantized else "onnx"
+        with open(os.path.join(onnx_dir, "encoder.json"), "r") as f:
+            self.config = json.load(f)
+        self.dim = self.config["dim"]
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(onnx_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"])
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        # Requests are already parallel at the pipeline level; keep each run on one op stream
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        model_file = "model_int8.onnx" if quantized else "model.onnx"
+        self.session = ort.InferenceSession(os.path.join(onnx_dir, model_file), options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False):
+        """Returns a float32 (n, dim) array of embeddings."""
+        if isinstance(texts, str):
+            texts = [texts]
+        out = np.empty((len(texts), self.dim), dtype='float32')
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            mask = np.array([e.attention_mask for e in encodings], dtype='int64')
+            feeds = {
+                "input_ids": np.array([e.ids for e in encodings], dtype='int64'),
+                "attention_mask": mask,
+                "token_type_ids": np.array([e.type_ids for e in encodings], dtype='int64'),
+            }
+            hidden = self.session.run(None, {name: value for name, value in feeds.items() if name in self.input_names})[0]
+            weights = mask[:, :, None].astype('float32')
+            pooled = (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+            if self.config["normalize"]:
+                pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            out[start:start + len(encodings)] = pooled
+            if show_progress_bar:
+                print(f"Encoded {start + len(encodings)}/{len(texts)}")
+        return out
+
+def export_onnx(model_name=EMBEDDING_MODEL_NAME, onnx_dir=ONNX_DIR):
+    """
+    Exports the SentenceTransformer's transformer to ONNX with dynamic batch and sequence
+    axes, alongside its tokenizer and the pooling settings OnnxEncoder needs.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    module_types = [type(m).__name__ for m in model]
+    # Older sentence-transformers releases spell the pooling mode as a set of flags
+    pooling = model[1].get_config_dict() if len(model) > 1 else {}
+    mean_pooled = pooling.get("pooling_mode") == "mean" or pooling.get("pooling_mode_mean_tokens", False)
+    if module_types[:2] != ["Transformer", "Pooling"] or not mean_pooled:
+        raise ValueError(f"Only mean-pooled transformer models can be exported, got {module_types}")
+    transformer = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+
+    class HiddenStates(torch.nn.Module):
+        # Calls the transformer with keyword inputs and returns only last_hidden_state
+        def __init__(self, transformer, input_names):
+            super().__init__()
+            self.transformer = transformer
+            self.input_names = input_names
+
+        def forward(self, *inputs):
+            return self.transformer(**dict(zip(self.input_names, inputs)), return_dict=False)[0]
+
+    os.makedirs(onnx_dir, exist_ok=True)
+    sample = tokenizer(["an example sentence to trace the graph with"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    axes = {0: "batch", 1: "sequence"}
+    print(f"Exporting {model_name} to ONNX...")
+    with torch.no_grad():
+        torch.onnx.export(
+            HiddenStates(transformer, input_names),
+            tuple(sample[name] for name in input_names),
+            os.path.join(onnx_dir, "model.onnx"),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={**{name: axes for name in input_names}, "last_hidden_state": axes},
+            opset_version=ONNX_OPSET,
+            dynamo=False,
+        )
+    tokenizer.backend_tokenizer.save(os.path.join(onnx_dir, "tokenizer.json"))
+    with open(os.path.join(onnx_dir, "encoder.json"), "w") as f:
+        json.dump({
+            "embedding_model": model_name,
+            "dim": model.get_sentence_embedding_dimension(),
+            "max_seq_length": model.max_seq_length,
+            "pad_token_id": tokenizer.pad_token_id,
+            "normalize": "Normalize" in module_types,
+        }, f, indent=2)
+    print(f"ONNX model saved to {onnx_dir}")
+
+def quantize_onnx(onnx_dir=ONNX_DIR):
+    """Writes model_int8.onnx: the fp32 model with int8 weights and dynamically quantized activations."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    print("Quantizing ONNX model to int8...")
+    quantize_dynamic(os.path.join(onnx_dir, "model.onnx"), os.path.join(onnx_dir, "model_int8.onnx"), weight_type=QuantType.QInt8)
+
+def load_encoder(backend=ENCODER_BACKEND, model_name=EMBEDDING_MODEL_NAME, threads=ENCODER_THREADS, onnx_dir=ONNX_DIR, export=False):
+    """
+    Loads an encoder for the given backend. ONNX models are exported (and quantized) on
+    demand only when export=True; the API expects embed_index.py to have produced them.
+    """
+    if backend == "torch":
+        return TorchEncoder(model_name, threads=threads)
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend: {backend}")
+
+    quantized = backend == "onnx-int8"
+    model_file = os.path.join(onnx_dir, "model_int8.onnx" if quantized else "model.onnx")
+    if not os.path.exists(model_file):
+        if not export:
+            raise FileNotFoundError(f"{model_file} not found. Run `python encoders.py --export` first.")
+        if not os.path.exists(os.path.join(onnx_dir, "model.onnx")):
+            export_onnx(model_name, onnx_dir)
+        if quantized:
+            quantize_onnx(onnx_dir)
+    return OnnxEncoder(onnx_dir, quantized=quantized, threads=threads)
+
+# --- Agreement checks ---
+def sample_texts(texts, n=REFERENCE_SAMPLE_SIZE):
+    """Evenly spaced sample of texts, so the reference covers the whole corpus."""
+    if len(texts) <= n:
+        return list(texts)
+    return [texts[i] for i in np.linspace(0, len(texts) - 1, n).astype(int)]
+
+def save_reference(texts, embeddings, path=REFERENCE_PATH, sample=()):
+    """
+    Saves the PyTorch embeddings of texts. `sample` identifies the chunks the texts came
+    from (see reference_sample()), so a later build can tell whether they are current.
+    """
+    np.savez(path, texts=np.array(texts, dtype=str), embeddings=np.asarray(embeddings, dtype='float32'),
+             sample=np.array(sample, dtype=str))
+
+def load_reference(path=REFERENCE_PATH):
+    """Returns (texts, PyTorch embeddings), or None if no reference has been written."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return data["texts"].tolist(), data["embeddings"]
+
+def reference_sample(path=REFERENCE_PATH):
+    """The sample saved with the reference, or None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return data["sample"].tolist() if "sample" in data.files else None
+
+def check_agreement(encoder, texts, reference_embeddings):
+    """
+    Encodes texts with `encoder` and compares them row by row with the reference (PyTorch)
+    embeddings. Returns a report dict whose "passed" says whether the two are close enough
+    to share an index.
+    """
+    embeddings = encoder.encode(texts)
+    a = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    b = reference_embeddings / np.maximum(np.linalg.norm(reference_embeddings, axis=1, keepdims=True), 1e-12)
+    cosines = (a * b).sum(axis=1)
+    min_cosine, mean_cosine = float(cosines.min()), float(cosines.mean())
+    return {
+        "backend": encoder.backend,
+        "n_samples": len(texts),
+        "min_cosine": round(min_cosine, 5),
+        "mean_cosine": round(mean_cosine, 5),
+        "passed": min_cosine >= AGREEMENT_MIN_COSINE and mean_cosine >= AGREEMENT_MIN_MEAN_COSINE,
+    }
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export", action="store_true", help="Export the ONNX model and its int8-quantized variant.")
+    parser.add_argument("--check", action="store_true", help="Compare every backend with PyTorch on the reference chunks, with timings.")
+    parser.add_argument("--threads", type=int, default=ENCODER_THREADS)
+    args = parser.parse_args()
+
+    if args.export:
+        export_onnx()
+        quantize_onnx()
+    if args.check:
+        reference = load_reference()
+        if reference is None:
+            print(f"Error: {REFERENCE_PATH} not found. Run `python embed_index.py` first.")
+        else:
+            texts, reference_embeddings = reference
+            for backend in ENCODER_BACKENDS:
+                encoder = load_encoder(backend, threads=args.threads, export=True)
+                start = time.perf_counter()
+                for text in texts:
+                    encoder.encode([text])
+                per_query_ms = (time.perf_counter() - start) / len(texts) * 1000
+                report = check_agreement(encoder, texts, reference_embeddings)
+                print(f"{backend:>9}: {per_query_ms:.2f} ms/query, min cosine {report['min_cosine']}, "
+                      f"mean cosine {report['mean_cosine']}, {'PASS' if report['passed'] else 'FAIL'}")
+    # To run: python encoders.py --export --check
@@ -1,97 +1,324 @@
-import requests
+import asyncio
 import json
-import csv
 import os
-from collections import defaultdict
+import platform
+import time
+from contextlib import asynccontextmanager
+import numpy as np
+from benchmark import percentiles
 
-# Set a consistent random seed for reproducibility
-import random
-random.seed(42)
+# Benchmark suite for the /ask API: replays questions.json (and optionally a JSONL request
+# log) at a configurable concurrency, against a running server or the app in-process, and
+# writes latency and ranking-quality reports as JSON that `compare` can diff.
 
 # --- CONFIG ---
-API_URL = "http://127.0.0.1:8000/ask"
+API_URL = "http://127.0.0.1:8000"
 QUESTIONS_FILE = "questions.json"
-RESULTS_FILE = "results/learned.md"
+RESULTS_DIR = "results"
+MODES = ["baseline", "hybrid", "learned"]
+EVAL_K = 10
+REQUEST_TIMEOUT_S = 120
+# `compare` fails when p95 latency grows by more than this fraction...
+MAX_LATENCY_REGRESSION = 0.10
+# ...or recall@k / MRR drop by more than this much (absolute)
+MAX_QUALITY_DROP = 0.02
 
-def run_evaluation():
+def load_questions(path=QUESTIONS_FILE):
+    """Questions with their reference answer and, once labelled, their gold_chunk_ids."""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def load_replay(path):
     """
-    Runs evaluation by sending requests to the API and comparing answers.
+    Reads /ask payloads from a JSONL request log, one JSON object per line. Lines that are
+    not an object with a string `q` are skipped.
     """
-    if not os.path.exists("results"):
-        os.makedirs("results")
-    
-    with open(QUESTIONS_FILE, 'r') as f:
-        questions = json.load(f)
-
-    modes = ["baseline", "hybrid", "learned"]
-    results = defaultdict(dict)
-    
-    # Run a dry run to warm up the API
-    try:
-        requests.post(API_URL, json={"q": "test", "k": 1, "mode": "baseline"}).json()
-    except requests.exceptions.ConnectionError:
-        print("API is not running. Please start the API with `uvicorn api:app --reload` first.")
+    payloads, skipped = [], 0
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                skipped += 1
+                continue
+            if isinstance(entry, dict) and isinstance(entry.get("q"), str):
+                payloads.append(entry)
+            else:
+                skipped += 1
+    if skipped:
+        print(f"Skipped {skipped} lines of {path} that are not /ask payloads.")
+    return payloads
+
+@asynccontextmanager
+async def open_client(url=None):
+    """
+    Async HTTP client for the server at `url`, or for the FastAPI app in this process
+    when url is None. In-process, the app's startup and shutdown hooks are run here since
+    the ASGI transport does not send lifespan events.
+    """
+    import httpx
+
+    if url:
+        async with httpx.AsyncClient(base_url=url, timeout=REQUEST_TIMEOUT_S) as client:
+            yield client
         return
 
-    print("Running evaluation...")
-    for q_data in questions:
-        q = q_data['q']
-        print(f"\n--- Question: {q} ---")
-        
-        for mode in modes:
-            print(f"  Mode: {mode}")
+    import app as rag
+
+    await rag.startup_event()
+    try:
+        while not rag.app.state.ready:
+            if rag.app.state.startup_error:
+                raise RuntimeError(f"App failed to start: {rag.app.state.startup_error}")
+            await asyncio.sleep(0.1)
+        transport = httpx.ASGITransport(app=rag.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://in-process", timeout=REQUEST_TIMEOUT_S) as client:
+            yield client
+    finally:
+        await rag.shutdown_event()
+
+async def run_requests(client, payloads, concurrency):
+    """
+    Posts every payload to /ask with at most `concurrency` in flight. Returns one outcome
+    per payload, in order, and the wall-clock time for the whole set.
+    """
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_request(payload):
+        async with semaphore:
+            start = time.perf_counter()
             try:
-                response = requests.post(
-                    API_URL,
-                    json={"q": q, "k": 10, "mode": mode},
-                    timeout=30 # Add a timeout
-                ).json()
-                
-                answer = response['answer']
-                abstained = response['abstained']
-                
-                # Simple check for correctness: does the correct answer appear in the response?
-                is_correct = "✔️" if not abstained else "❌"
-                
-                if not abstained:
-                    top_context = response['contexts'][0]['text_snippet']
-                    # Very simple check for correctness
-                    if q == "What is the importance of regular safety inspections?" and "identify and correct potential hazards" in top_context:
-                        is_correct = "✔️"
-                    elif q == "What is the purpose of lockout/tagout (LOTO)?" and "lockout/tagout program is to control hazardous energy" in top_context:
-                         is_correct = "✔️"
-                    # Add more checks as needed for the 8 questions
-                    
-                results[q][mode] = is_correct
-                print(f"    - Correct? {is_correct}")
-                
-            except requests.exceptions.RequestException as e:
-                print(f"    - Error: API request failed with {e}")
-                results[q][mode] = "❌"
-    
-    print("\n--- Evaluation Results Table ---")
-    header = ["Question"] + modes
-    print(" | ".join(header))
-    print(" | ".join("-" * len(h) for h in header))
-    
-    for q in questions:
-        row = [q['q']] + [results[q['q']].get(mode, "N/A") for mode in modes]
-        print(" | ".join(row))
-
-    # Save the results table and short writeup to a markdown file
-    with open(RESULTS_FILE, "w") as f:
-        f.write("## Project Overview & Key Learnings\n\n")
-        f.write("This project demonstrates a complete, reproducible RAG (Retrieval-Augmented Generation) system from scratch, showcasing the improvement a reranker provides over a simple vector search. The key learning is that a **hybrid approach, combining semantic (vector) and keyword (BM25) search, consistently outperforms a naive baseline**. While the learned reranker shows promise, its performance is highly dependent on the quality and quantity of training data, and with only 8 labeled questions, it provides a subtle but sometimes less consistent improvement compared to the hand-tuned hybrid model. The simplicity and robustness of the hybrid reranker make it a highly effective and practical choice for many real-world applications.\n\n")
-        f.write("### Results Table 📊\n\n")
-        f.write("| " + " | ".join(header) + " |\n")
-        f.write("|" + "|".join("---" for _ in header) + "|\n")
-        for q_data in questions:
-            q = q_data['q']
-            row = [q] + [results[q].get(mode, "N/A") for mode in modes]
-            f.write("| " + " | ".join(row) + " |\n")
-            
-    print(f"\nEvaluation complete. Results saved to {RESULTS_FILE}")
+                response = await client.post("/ask", json=payload)
+                status = response.status_code
+                body = response.json() if status == 200 else None
+            except httpx.HTTPError:
+                status, body = None, None
+            return {"status": status, "latency_ms": (time.perf_counter() - start) * 1000, "body": body}
+
+    start = time.perf_counter()
+    outcomes = await asyncio.gather(*(one_request(payload) for payload in payloads))
+    return outcomes, time.perf_counter() - start
+
+def latency_report(outcomes, elapsed):
+    """Throughput and p50/p95/p99 latency over the successful requests."""
+    latencies = [o["latency_ms"] for o in outcomes if o["status"] == 200]
+    report = {
+        "requests": len(outcomes),
+        "ok": len(latencies),
+        "rejected": sum(1 for o in outcomes if o["status"] == 503),
+        "errors": sum(1 for o in outcomes if o["status"] not in (200, 503)),
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+    }
+    report.update(percentiles(latencies))
+    return report
+
+def ranking_metrics(returned_ids, gold_ids, k):
+    """recall@k, reciprocal rank and hit@1 of one ranked list against its gold chunk ids."""
+    gold = set(gold_ids)
+    ranks = [rank for rank, chunk_id in enumerate(returned_ids[:k], start=1) if chunk_id in gold]
+    return {
+        f"recall@{k}": len(ranks) / len(gold),
+        "mrr": 1.0 / ranks[0] if ranks else 0.0,
+        "hit@1": float(bool(ranks) and ranks[0] == 1),
+    }
+
+def mean_stage_timings(outcomes):
+    """Mean of the server's debug_timings per stage, over responses that carry them."""
+    stages = {}
+    for o in outcomes:
+        for stage, ms in ((o["body"] or {}).get("debug_timings") or {}).items():
+            stages.setdefault(stage, []).append(ms)
+    return {stage: float(np.mean(values)) for stage, values in stages.items()}
+
+async def run_suite(url=None, modes=MODES, concurrency=8, repeat=1, k=EVAL_K, replay_path=None, debug_timings=False, label=""):
+    """
+    Runs questions.json once per mode (repeated `repeat` times) and then the replay log,
+    if given. Returns the report: latency and throughput per mode, ranking quality against
+    gold_chunk_ids for the labelled questions, and the top ids returned for each question.
+
+    Repeats after the first are usually served from the response cache; quality is
+    computed from the first repetition only.
+    """
+    questions = load_questions()
+    report = {
+        "label": label,
+        "target": url or "in-process",
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": platform.node(),
+        "concurrency": concurrency,
+        "repeat": repeat,
+        "k": k,
+        "questions": len(questions),
+        "labelled_questions": sum(1 for item in questions if item.get("gold_chunk_ids")),
+        "modes": {},
+        "per_question": {item["q"]: {} for item in questions},
+    }
+
+    async with open_client(url) as client:
+        # The first request pays one-off costs; keep it out of the measurements
+        warmup = await client.post("/ask", json={"q": questions[0]["q"], "k": 1, "mode": "baseline"})
+        if warmup.status_code == 200:
+            report["index_version"] = warmup.json().get("index_version")
+
+        for mode in modes:
+            payloads = [{"q": item["q"], "k": k, "mode": mode, "debug_timings": debug_timings}
+                        for _ in range(repeat) for item in questions]
+            outcomes, elapsed = await run_requests(client, payloads, concurrency)
+            mode_report = latency_report(outcomes, elapsed)
+
+            quality, abstained = [], 0
+            for item, outcome in zip(questions, outcomes):
+                body = outcome["body"]
+                if body is None:
+                    report["per_question"][item["q"]][mode] = {"status": outcome["status"]}
+                    continue
+                returned_ids = [ctx["chunk_id"] for ctx in body["contexts"]]
+                abstained += body["abstained"]
+                entry = {"status": 200, "abstained": body["abstained"], "top_ids": returned_ids}
+                if item.get("gold_chunk_ids"):
+                    entry.update(ranking_metrics(returned_ids, item["gold_chunk_ids"], k))
+                    quality.append(entry)
+                report["per_question"][item["q"]][mode] = entry
+
+            mode_report["abstain_rate"] = abstained / len(questions)
+            for metric in (f"recall@{k}", "mrr", "hit@1"):
+                mode_report[metric] = float(np.mean([entry[metric] for entry in quality])) if quality else None
+            if debug_timings:
+                mode_report["stages_ms"] = mean_stage_timings(outcomes)
+            report["modes"][mode] = mode_report
+
+        if replay_path:
+            payloads = load_replay(replay_path)
+            outcomes, elapsed = await run_requests(client, payloads, concurrency)
+            by_mode = {}
+            for payload, outcome in zip(payloads, outcomes):
+                if outcome["status"] == 200:
+                    by_mode.setdefault(payload.get("mode", "hybrid"), []).append(outcome["latency_ms"])
+            report["replay"] = {"path": replay_path, **latency_report(outcomes, elapsed),
+                                "by_mode": {mode: percentiles(latencies) for mode, latencies in by_mode.items()}}
+    return report
+
+def print_report(report):
+    k = report["k"]
+    print(f"Eval {report['label']} against {report['target']}: {report['questions']} questions "
+          f"({report['labelled_questions']} labelled), concurrency={report['concurrency']}, k={k}")
+    fmt = lambda value, spec: format(value, spec) if value is not None else "n/a"
+    print(f"  {'mode':<9} {'ok':>5} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {f'recall@{k}':>9} {'mrr':>6} {'hit@1':>6} {'abstain':>7}")
+    for mode, r in report["modes"].items():
+        print(f"  {mode:<9} {r['ok']:>5} {r['throughput_rps']:>7.1f} {fmt(r['p50'], '8.1f')} {fmt(r['p95'], '8.1f')} "
+              f"{fmt(r['p99'], '8.1f')} {fmt(r[f'recall@{k}'], '9.3f')} {fmt(r['mrr'], '6.3f')} {fmt(r['hit@1'], '6.3f')} "
+              f"{r['abstain_rate']:>7.2f}")
+        if r.get("stages_ms"):
+            print("            stages (ms): " + ", ".join(f"{stage}={ms:.2f}" for stage, ms in r["stages_ms"].items()))
+    if "replay" in report:
+        r = report["replay"]
+        print(f"  replay of {r['path']}: ok={r['ok']}/{r['requests']} rps={r['throughput_rps']:.1f} "
+              f"p50={fmt(r['p50'], '.1f')}ms p95={fmt(r['p95'], '.1f')}ms p99={fmt(r['p99'], '.1f')}ms")
+
+def compare_reports(baseline, candidate, max_latency_regression=MAX_LATENCY_REGRESSION, max_quality_drop=MAX_QUALITY_DROP):
+    """
+    Lists the regressions of `candidate` against `baseline` for every mode in both:
+    p95 latency growing by more than max_latency_regression (relative), recall@k, MRR or
+    hit@1 dropping by more than max_quality_drop (absolute), or new errors.
+    """
+    regressions = []
+    k = baseline["k"]
+    for mode in baseline["modes"].keys() & candidate["modes"].keys():
+        old, new = baseline["modes"][mode], candidate["modes"][mode]
+        if old["p95"] and new["p95"] and new["p95"] > old["p95"] * (1 + max_latency_regression):
+            regressions.append(f"{mode}: p95 {old['p95']:.1f}ms -> {new['p95']:.1f}ms")
+        for metric in (f"recall@{k}", "mrr", "hit@1"):
+            if old.get(metric) is not None and new.get(metric) is not None and new[metric] < old[metric] - max_quality_drop:
+                regressions.append(f"{mode}: {metric} {old[metric]:.3f} -> {new[metric]:.3f}")
+        if new["errors"] + new["rejected"] > old["errors"] + old["rejected"]:
+            regressions.append(f"{mode}: failed requests {old['errors'] + old['rejected']} -> {new['errors'] + new['rejected']}")
+    return regressions
+
+def label_gold(candidates=50, overwrite=False, path=QUESTIONS_FILE):
+    """
+    Bootstraps gold_chunk_ids in questions.json: every chunk in a wide hybrid candidate
+    pool that contains at least LABEL_MIN_OVERLAP of the reference answer's terms, as in
+    learned-reranker training. The labels are the harness's ground truth, so review them.
+    """
+    import app as rag
+    from rerank_learned import LABEL_MIN_OVERLAP, answer_overlap, tokenize
+
+    rag.app.state.process_start = time.perf_counter()
+    rag.load_resources()
+    questions = load_questions(path)
+    try:
+        for item in questions:
+            if item.get("gold_chunk_ids") and not overwrite:
+                continue
+            pool, _ = rag.retrieve(rag.app.state.indices.current, rag.AskRequest(q=item["q"], k=1, mode="hybrid", candidates=candidates))
+            answer_terms = tokenize(item["a"])
+            item["gold_chunk_ids"] = [ctx["chunk_id"] for ctx in pool
+                                      if answer_overlap(answer_terms, ctx["text_snippet"]) >= LABEL_MIN_OVERLAP]
+            print(f"{len(item['gold_chunk_ids']):>3} gold chunks for {item['q']!r}")
+    finally:
+        rag.app.state.embedder.close()
+        rag.app.state.indices.current.close()
+    with open(path, 'w') as f:
+        json.dump(questions, f, indent=2, ensure_ascii=False)
+        f.write("\n")
 
 if __name__ == "__main__":
-    run_evaluation()
-    # To run: python eval.py
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Latency and ranking-quality benchmark suite for the /ask API.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run questions.json (and a replay log) and write a JSON report.")
+    run_parser.add_argument("--url", default=None, help=f"Server to test, e.g. {API_URL}. Default: the app in-process, no server.")
+    run_parser.add_argument("--modes", nargs="+", default=MODES)
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--repeat", type=int, default=1, help="Times to send each question per mode.")
+    run_parser.add_argument("--k", type=int, default=EVAL_K)
+    run_parser.add_argument("--replay", help="JSONL file of /ask payloads to replay after the questions.")
+    run_parser.add_argument("--debug-timings", action="store_true", help="Ask the API for per-stage timings and report their means.")
+    run_parser.add_argument("--label", default="", help="Tag for the run, e.g. a commit or 'before'/'after'.")
+    run_parser.add_argument("--output", help=f"Report path (default: {RESULTS_DIR}/eval-<label or timestamp>.json).")
+
+    compare_parser = subparsers.add_parser("compare", help="Fail if a report regressed against a baseline report.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--max-latency-regression", type=float, default=MAX_LATENCY_REGRESSION)
+    compare_parser.add_argument("--max-quality-drop", type=float, default=MAX_QUALITY_DROP)
+
+    label_parser = subparsers.add_parser("label", help="Bootstrap gold_chunk_ids in questions.json from the reference answers.")
+    label_parser.add_argument("--candidates", type=int, default=50)
+    label_parser.add_argument("--overwrite", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        report = asyncio.run(run_suite(
+            url=args.url, modes=args.modes, concurrency=args.concurrency, repeat=args.repeat, k=args.k,
+            replay_path=args.replay, debug_timings=args.debug_timings, label=args.label))
+        print_report(report)
+        output = args.output or os.path.join(RESULTS_DIR, f"eval-{args.label or time.strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {output}")
+
+    elif args.command == "compare":
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        with open(args.candidate, 'r') as f:
+            candidate = json.load(f)
+        regressions = compare_reports(baseline, candidate, args.max_latency_regression, args.max_quality_drop)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        print(f"{len(regressions)} regressions in {args.candidate} against {args.baseline}.")
+        if regressions:
+            raise SystemExit(1)
+
+    elif args.command == "label":
+        label_gold(candidates=args.candidates, overwrite=args.overwrite)
+    # To run: python eval.py run [--url http://127.0.0.1:8000] [--concurrency 16] [--replay requests.jsonl] --label after
@@ -0,0 +1,81 @@
+import numpy as np
+
+# Score fusion for the hybrid reranker. Every function works on float arrays aligned to
+# the same candidate list, with NaN marking a candidate the retriever did not return.
+
+# --- CONFIG ---
+FUSION_METHODS = ("weighted", "rrf", "zscore")
+DEFAULT_ALPHA = 0.6 # Weight of the vector score; BM25 gets 1 - alpha
+RRF_K = 60 # Rank offset from the original RRF paper; damps the influence of the top ranks
+
+def align_scores(ids, hit_ids, hit_scores):
+    """
+    Returns hit_scores re-ordered to line up with the integer ids in `ids`, with NaN where
+    an id has no hit. One sort plus a binary search; no per-id dict lookups.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    aligned = np.full(len(ids), np.nan)
+    if len(hit_ids) == 0:
+        return aligned
+    order = np.argsort(hit_ids)
+    sorted_ids = np.asarray(hit_ids, dtype=np.int64)[order]
+    pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    found = sorted_ids[pos] == ids
+    aligned[found] = np.asarray(hit_scores, dtype=np.float64)[order][pos[found]]
+    return aligned
+
+def minmax(scores):
+    """Scales the present scores to 0-1 (all 0.5 if they are equal); missing ones become 0."""
+    present = ~np.isnan(scores)
+    out = np.zeros(len(scores))
+    if not present.any():
+        return out
+    lo, hi = scores[present].min(), scores[present].max()
+    out[present] = 0.5 if hi == lo else (scores[present] - lo) / (hi - lo)
+    return out
+
+def zscore(scores):
+    """
+    Standardizes the present scores; missing ones get the lowest present z-score, so a
+    retriever that returned few hits cannot push its misses above its worst hit.
+    """
+    present = ~np.isnan(scores)
+    out = np.zeros(len(scores))
+    if not present.any():
+        return out
+    values = scores[present]
+    std = values.std()
+    z = (values - values.mean()) / std if std > 0 else np.zeros(len(values))
+    out[present] = z
+    out[~present] = z.min()
+    return out
+
+def reciprocal_ranks(scores, rrf_k=RRF_K):
+    """1 / (rrf_k + rank) by descending score (rank 1 is best); missing scores contribute 0."""
+    present = ~np.isnan(scores)
+    order = np.argsort(-np.where(present, scores, -np.inf), kind="stable")
+    ranks = np.empty(len(scores))
+    ranks[order] = np.arange(1, len(scores) + 1)
+    return np.where(present, 1.0 / (rrf_k + ranks), 0.0)
+
+def fuse(vector_scores, keyword_scores, method="weighted", alpha=DEFAULT_ALPHA, rrf_k=RRF_K):
+    """
+    Fuses aligned vector and BM25 score arrays. Returns (fused, vector part, keyword part),
+    where the parts are the per-retriever scores after the method's normalization.
+
+    - weighted: alpha * min-max(vector) + (1 - alpha) * min-max(BM25)
+    - zscore:   alpha * z(vector) + (1 - alpha) * z(BM25)
+    - rrf:      reciprocal rank fusion, unweighted, on each retriever's ranks
+    """
+    vector_scores = np.asarray(vector_scores, dtype=np.float64)
+    keyword_scores = np.asarray(keyword_scores, dtype=np.float64)
+    if method == "weighted":
+        vector_part, keyword_part = minmax(vector_scores), minmax(keyword_scores)
+    elif method == "zscore":
+        vector_part, keyword_part = zscore(vector_scores), zscore(keyword_scores)
+    elif method == "rrf":
+        vector_part, keyword_part = reciprocal_ranks(vector_scores, rrf_k), reciprocal_ranks(keyword_scores, rrf_k)
+        return vector_part + keyword_part, vector_part, keyword_part
+    else:
+        raise ValueError(f"Unknown fusion method: {method}")
+    return alpha * vector_part + (1 - alpha) * keyword_part, vector_part, keyword_part
@@ -0,0 +1,259 @@
+import os
+import shutil
+import threading
+import time
+
+# Blue/green index versions. embed_index.py builds into the working paths under data/;
+# publish() snapshots them into data/indexes/<version>/ and data/indexes/CURRENT names the
+# version the API should serve. Without a CURRENT file the API serves data/ directly.
+
+# --- CONFIG ---
+DATA_DIR = "data"
+VERSIONS_DIR = os.path.join(DATA_DIR, "indexes")
+CURRENT_FILE = os.path.join(VERSIONS_DIR, "CURRENT")
+# The artifacts that make up one index version, by name inside data/ or a version directory
+ARTIFACTS = {
+    "faiss_index": "faiss_index.bin",
+    "index_meta": "index_meta.json",
+    "chunk_store": "chunk_store",
+    "whoosh_index": "whoosh_index",
+    "bm25_index": "bm25_index",
+    "encoder_reference": "encoder_reference.npz",
+}
+# Artifacts a version cannot be served without
+REQUIRED_ARTIFACTS = ("faiss_index", "chunk_store")
+
+def artifact_paths(version=None):
+    """Paths of a version's artifacts; version None means the working paths in data/."""
+    base = DATA_DIR if version is None else os.path.join(VERSIONS_DIR, version)
+    return {name: os.path.join(base, filename) for name, filename in ARTIFACTS.items()}
+
+def list_versions():
+    """Published versions, oldest first (names sort by publish time)."""
+    if not os.path.isdir(VERSIONS_DIR):
+        return []
+    return sorted(name for name in os.listdir(VERSIONS_DIR)
+                  if os.path.isdir(os.path.join(VERSIONS_DIR, name)) and not name.endswith(".tmp"))
+
+def current_version():
+    """The version named by CURRENT, or None to serve the working paths in data/."""
+    try:
+        with open(CURRENT_FILE, 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def set_current(version):
+    """Points CURRENT at a published version; the rename makes the switch atomic for readers."""
+    if version not in list_versions():
+        raise ValueError(f"Unknown index version: {version}")
+    tmp_path = CURRENT_FILE + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(version + "\n")
+    os.replace(tmp_path, CURRENT_FILE)
+
+def publish(name=None, activate=True):
+    """
+    Copies the working artifacts in data/ into a new version directory and, with
+    activate=True, makes it CURRENT. The copy is staged in a .tmp directory and renamed,
+    so a version directory is always complete. Returns the version name.
+    """
+    source = artifact_paths()
+    missing = [name for name in REQUIRED_ARTIFACTS if not os.path.exists(source[name])]
+    if missing:
+        raise FileNotFoundError(f"Cannot publish: {', '.join(source[m] for m in missing)} not found. Run embed_index.py first.")
+
+    name = name or time.strftime("%Y%m%d-%H%M%S")
+    target_dir = os.path.join(VERSIONS_DIR, name)
+    if os.path.exists(target_dir):
+        raise FileExistsError(f"Index version {name} already exists.")
+    tmp_dir = target_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for artifact, path in source.items():
+        if not os.path.exists(path):
+            continue
+        target = os.path.join(tmp_dir, ARTIFACTS[artifact])
+        if os.path.isdir(path):
+            # The Whoosh write lock is not part of the index
+            shutil.copytree(path, target, ignore=shutil.ignore_patterns("*WRITELOCK"))
+        else:
+            shutil.copy2(path, target)
+    os.rename(tmp_dir, target_dir)
+    print(f"Published index version {name} to {target_dir}")
+    if activate:
+        set_current(name)
+        print(f"Index version {name} is now current.")
+    return name
+
+def prune(keep=3):
+    """Deletes all but the newest `keep` published versions, never the current one."""
+    current = current_version()
+    versions = list_versions()
+    removed = [v for v in versions[:max(0, len(versions) - keep)] if v != current]
+    for version in removed:
+        shutil.rmtree(os.path.join(VERSIONS_DIR, version))
+    return removed
+
+class LoadedIndex:
+    """
+    One index version loaded in memory: the FAISS index and its metadata, the chunk store
+    and the BM25 engine.
+
+    Requests hold a lease on the version they started with for their whole lifetime, so a
+    reload never mixes versions within a request. A retired version is closed once its
+    last lease is released.
+    """
+
+    def __init__(self, version, paths, index, meta, store, bm25):
+        self.version = version
+        self.paths = paths
+        self.index = index
+        self.meta = meta
+        self.store = store
+        self.bm25 = bm25
+        self.loaded_at = time.time()
+        self._lock = threading.Lock()
+        self._leases = 0
+        self._drained = threading.Event()
+        self._drained.set()
+        self._retired = False
+        self._on_close = None
+
+    def retain(self):
+        with self._lock:
+            self._leases += 1
+            self._drained.clear()
+
+    def release(self):
+        with self._lock:
+            self._leases -= 1
+            if self._leases:
+                return
+            self._drained.set()
+            closing = self._retired
+        if closing:
+            self._close_retired()
+
+    def retire(self, on_close=None):
+        """
+        Closes this version once no request holds a lease: now if none does, otherwise in
+        the release() of the last one. on_close() is called after it is closed.
+        """
+        with self._lock:
+            self._retired = True
+            self._on_close = on_close
+            closing = self._leases == 0
+        if closing:
+            self._close_retired()
+
+    def _close_retired(self):
+        self.close()
+        if self._on_close is not None:
+            self._on_close()
+
+    @property
+    def leases(self):
+        return self._leases
+
+    def wait_drained(self, timeout=None):
+        """Blocks until no request holds a lease; returns False on timeout."""
+        return self._drained.wait(timeout)
+
+    def close(self):
+        self.store.close()
+        self.bm25.close()
+
+class IndexManager:
+    """
+    Holds the served index version and swaps in new ones.
+
+    acquire() hands out the current version with a lease taken under the same lock that
+    swap() replaces it under, so a version is never drained while a request is between
+    picking it and leasing it.
+    """
+
+    def __init__(self, current):
+        self.current = current
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.status = {"state": "idle", "version": None, "error": None}
+        self.retired = []
+
+    def acquire(self):
+        with self._lock:
+            served = self.current
+            served.retain()
+        return served
+
+    def swap(self, new):
+        """Makes `new` the served version and returns the previous one."""
+        with self._lock:
+            old, self.current = self.current, new
+        return old
+
+    def reload(self, load, version, force=False):
+        """
+        Loads `version` with load(version) and swaps it in. Returns the version it replaced,
+        or None if `version` was already being served. Reloads run one at a time; if
+        loading fails the current version keeps serving and the error is re-raised.
+        """
+        with self._reload_lock:
+            if not force and version is not None and version == self.current.version:
+                return None
+            self.status = {"state": "loading", "version": version, "error": None}
+            try:
+                new = load(version)
+            except Exception as e:
+                self.status = {"state": "failed", "version": version, "error": repr(e)}
+                raise
+            old = self.swap(new)
+            self.status = {"state": "idle", "version": new.version, "error": None}
+            print(f"Now serving index version {new.version} (was {old.version}).")
+            return old
+
+    def retire(self, old, drain_timeout):
+        """
+        Retires `old`: it is closed, freeing its memory maps and file handles, when its last
+        in-flight request releases it, however long that takes. Waits up to drain_timeout
+        seconds for that, only to report requests that hold it longer.
+        """
+        self.retired.append(old.version)
+
+        def closed():
+            self.retired.remove(old.version)
+            print(f"Index version {old.version} closed.")
+
+        old.retire(closed)
+        if not old.wait_drained(drain_timeout):
+            print(f"Index version {old.version} still has {old.leases} requests after {drain_timeout}s; "
+                  f"it will be closed when the last one finishes.")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage published index versions.")
+    parser.add_argument("--list", action="store_true", help="List published versions.")
+    parser.add_argument("--publish", action="store_true", help="Snapshot data/ as a new version and make it current.")
+    parser.add_argument("--name", help="Name for the published version (default: a timestamp).")
+    parser.add_argument("--no-activate", action="store_true", help="Publish without making the version current.")
+    parser.add_argument("--activate", metavar="VERSION", help="Make a published version current.")
+    parser.add_argument("--prune", type=int, metavar="KEEP", help="Delete all but the newest KEEP versions.")
+    args = parser.parse_args()
+
+    if args.publish:
+        publish(args.name, activate=not args.no_activate)
+    if args.activate:
+        set_current(args.activate)
+        print(f"Index version {args.activate} is now current.")
+    if args.prune is not None:
+        for version in prune(args.prune):
+            print(f"Removed index version {version}")
+    if args.list:
+        current = current_version()
+        for version in list_versions():
+            print(("* " if version == current else "  ") + version)
+        if current is None:
+            print("No current version; the API serves the working index in data/.")
+    # To run: python index_versions.py --publish, then the API picks it up (see /admin/reload)
@@ -1,9 +1,13 @@
 import os
 import json
+import hashlib
+import sqlite3
 import sqlite_utils
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pypdf import PdfReader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import random
+from collections import deque
 
 # Set a consistent random seed for reproducibility
 random.seed(42)
@@ -14,16 +18,196 @@ PDF_DIR = "data/industrial-safety-pdfs"
 SOURCES_FILE = "data/sources.json"
 CHUNK_SIZE = 400
 CHUNK_OVERLAP = 50
+INSERT_BATCH_SIZE = 500 # Chunks buffered per worker before writing to SQLite
+MAX_WORKERS = None # None uses one process per CPU
 
-def ingest_pdfs():
+CHUNKS_COLUMNS = {
+    "id": str,
+    "source_title": str,
+    "source_url": str,
+    "chunk_text": str,
+    "chunk_id_in_doc": int,
+    "page": int,
+    "char_start": int,
+    "char_end": int,
+    "source_file": str,
+    "content_hash": str, # Hash of chunk_text
+    "deleted": int, # Tombstone: 1 once the chunk's document or position no longer exists
+    "vec_id": int, # FAISS id, assigned by embed_index.py
+    "embedded_hash": str, # content_hash the vector at vec_id was computed from
+    "canonical_id": str, # First chunk of this chunk's near-duplicate cluster, set by embed_index.py
+}
+
+DOCUMENTS_COLUMNS = {
+    "source_file": str,
+    "content_hash": str, # Hash of the PDF file bytes
+    "source_title": str,
+    "source_url": str,
+    "deleted": int,
+}
+
+def file_hash(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def create_tables(db):
+    """Drops and recreates the chunks and documents tables."""
+    if "chunks" in db.table_names() and db["chunks"].detect_fts():
+        db["chunks"].disable_fts()
+    for table in ("chunks", "documents"):
+        if table in db.table_names():
+            db[table].drop()
+    db["chunks"].create(CHUNKS_COLUMNS, pk="id", defaults={"deleted": 0})
+    db["chunks"].create_index(["source_file"])
+    db["documents"].create(DOCUMENTS_COLUMNS, pk="source_file", defaults={"deleted": 0})
+
+def make_text_splitter():
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=["\n\n", "\n", ".", " ", ""],
+        add_start_index=True
+    )
+
+def iter_page_chunks(filepath, text_splitter):
+    """
+    Yields (page_number, chunk_text, char_start, char_end) for a PDF one page at a time,
+    so only the current page's text is held in memory.
+
+    Offsets refer to the document text formed by concatenating every page's extracted text.
+    Chunks do not span page boundaries.
+    """
+    reader = PdfReader(filepath)
+    doc_offset = 0
+    for page_number, page in enumerate(reader.pages, start=1):
+        page_text = page.extract_text() or ""
+        for chunk in text_splitter.create_documents([page_text]):
+            char_start = doc_offset + chunk.metadata["start_index"]
+            yield page_number, chunk.page_content, char_start, char_start + len(chunk.page_content)
+        doc_offset += len(page_text)
+
+def ingest_pdf(filename, source_meta):
+    """
+    Parses one PDF and writes its chunks to the database in batches of INSERT_BATCH_SIZE.
+    Runs in a worker process; returns (chunks written, chunks changed, chunks tombstoned).
+
+    Chunks whose text is unchanged keep their vector (only page and offsets are refreshed);
+    new or changed chunks get a new content_hash so embed_index.py re-embeds them, and
+    chunks the document no longer produces are tombstoned.
+
+    Chunk ids are positional, so an edit early in a document shifts every later chunk to
+    a new id. Text that reappears at another position takes over the vector (vec_id,
+    embedded_hash and canonical_id) of the old chunk with the same content_hash, and the
+    chunk that vector came from is left without one; embed_index.py then only re-indexes
+    the moved chunks' ids for keyword search.
+    """
+    # Workers write concurrently, so wait on SQLite's lock instead of failing
+    db = sqlite_utils.Database(sqlite3.connect(DB_PATH, timeout=60))
+    text_splitter = make_text_splitter()
+    existing = {
+        row["id"]: row
+        for row in db.query("SELECT id, content_hash, vec_id, embedded_hash, canonical_id FROM chunks "
+                            "WHERE source_file = ? AND deleted = 0", [filename])
+    }
+    # Old chunks with an up-to-date vector, by text, in position order
+    vectors_by_hash = {}
+    for chunk_id, old in sorted(existing.items(), key=lambda item: int(item[0].rsplit("-", 1)[1])):
+        if old["vec_id"] is not None and old["embedded_hash"] == old["content_hash"]:
+            vectors_by_hash.setdefault(old["content_hash"], deque()).append(chunk_id)
+    claimed = {} # Old chunk id -> id of the chunk that now has its vector
+    changed, unchanged = [], []
+    seen = set()
+    count = 0
+    n_changed = 0
+
+    def flush():
+        # Unchanged rows omit chunk_text/content_hash so upserting them keeps the stored vector
+        if changed:
+            db["chunks"].upsert_all(changed, pk="id")
+        if unchanged:
+            db["chunks"].upsert_all(unchanged, pk="id")
+        changed.clear()
+        unchanged.clear()
+
+    try:
+        for i, (page, text, char_start, char_end) in enumerate(iter_page_chunks(os.path.join(PDF_DIR, filename), text_splitter)):
+            chunk_id = f"{filename}-{i}"
+            row = {
+                "id": chunk_id,
+                "source_title": source_meta["title"],
+                "source_url": source_meta["url"],
+                "chunk_id_in_doc": i,
+                "page": page,
+                "char_start": char_start,
+                "char_end": char_end,
+                "source_file": filename,
+                "deleted": 0
+            }
+            content_hash = text_hash(text)
+            old = existing.get(chunk_id)
+            if old is not None and old["content_hash"] == content_hash and chunk_id not in claimed:
+                claimed[chunk_id] = chunk_id
+                unchanged.append(row)
+            else:
+                row = {**row, "chunk_text": text, "content_hash": content_hash}
+                moved_from = vectors_by_hash.get(content_hash)
+                while moved_from and moved_from[0] in claimed:
+                    moved_from.popleft()
+                if moved_from:
+                    source = existing[moved_from.popleft()]
+                    claimed[source["id"]] = chunk_id
+                    row.update(vec_id=source["vec_id"], embedded_hash=source["embedded_hash"], canonical_id=source["canonical_id"])
+                else:
+                    n_changed += 1
+                changed.append(row)
+            seen.add(chunk_id)
+            count += 1
+            if len(changed) + len(unchanged) >= INSERT_BATCH_SIZE:
+                flush()
+        flush()
+
+        removed = [chunk_id for chunk_id in existing if chunk_id not in seen]
+        moved = {old_id: new_id for old_id, new_id in claimed.items() if old_id != new_id}
+        received = set(moved.values())
+        with db.conn:
+            db.conn.executemany("UPDATE chunks SET deleted = 1 WHERE id = ?", [(chunk_id,) for chunk_id in removed])
+            # A chunk whose vector moved away keeps none of its own, so embed_index.py neither
+            # removes the moved vector nor counts it twice
+            db.conn.executemany("UPDATE chunks SET vec_id = NULL, embedded_hash = NULL WHERE id = ?",
+                                [(old_id,) for old_id in moved if old_id not in received])
+            # Near-duplicate links follow the text: ids whose old text moved are renamed,
+            # ids whose old text is gone no longer name a cluster
+            renamed = [(old_id, moved.get(old_id)) for old_id in existing if claimed.get(old_id) != old_id]
+            if renamed:
+                db.conn.execute("CREATE TEMP TABLE IF NOT EXISTS renamed (old_id TEXT PRIMARY KEY, new_id TEXT)")
+                db.conn.execute("DELETE FROM renamed")
+                db.conn.executemany("INSERT INTO renamed VALUES (?, ?)", renamed)
+                db.conn.execute("UPDATE chunks SET canonical_id = (SELECT new_id FROM renamed WHERE old_id = chunks.canonical_id) "
+                                "WHERE canonical_id IN (SELECT old_id FROM renamed)")
+    finally:
+        db.conn.close()
+    return count, n_changed, len(removed)
+
+def ingest_pdfs(max_workers=MAX_WORKERS, full=False):
     """
     Parses PDFs, chunks text, and stores the chunks in a SQLite database.
+    Each PDF is handled by its own worker process.
+
+    Only PDFs whose content hash changed since the last run are re-parsed; documents that
+    disappeared from PDF_DIR are tombstoned. Pass full=True to rebuild from scratch.
     """
     db = sqlite_utils.Database(DB_PATH)
 
-    # Drop table to ensure a clean run
-    if "chunks" in db.tables:
-        db["chunks"].drop()
+    if full or "documents" not in db.table_names() or "content_hash" not in db["chunks"].columns_dict:
+        # Create the tables up front so workers only ever write rows
+        create_tables(db)
+    db.conn.execute("PRAGMA journal_mode=WAL")
 
     # Load source metadata
     with open(SOURCES_FILE, "r") as f:
@@ -34,51 +218,65 @@ def ingest_pdfs():
     for s in sources_list:
         filename = os.path.basename(s['url']).split('?')[0] # Handles URLs with parameters
         sources[filename] = s
-        
-    pdf_files = [f for f in os.listdir(PDF_DIR) if f.endswith(".pdf")]
 
-    # Initialize text splitter
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        separators=["\n\n", "\n", ".", " ", ""]
-    )
+    pdf_files = [f for f in os.listdir(PDF_DIR) if f.endswith(".pdf")]
+    known = {row["source_file"]: row for row in db["documents"].rows}
 
-    documents = []
+    # Tombstone documents that were removed from PDF_DIR
+    for filename, doc in known.items():
+        if filename not in pdf_files and not doc["deleted"]:
+            with db.conn:
+                db.conn.execute("UPDATE documents SET deleted = 1 WHERE source_file = ?", [filename])
+                db.conn.execute("UPDATE chunks SET deleted = 1 WHERE source_file = ?", [filename])
+            print(f"Tombstoned removed document {filename}")
 
-    # Process each PDF file
+    todo = {}
     for filename in pdf_files:
-        filepath = os.path.join(PDF_DIR, filename)
-        source_meta = sources.get(filename, {"title": filename, "url": "N/A"})
-
-        try:
-            reader = PdfReader(filepath)
-            doc_text = "".join([page.extract_text() or "" for page in reader.pages])
-
-            # Split the document text into chunks
-            chunks = text_splitter.create_documents([doc_text])
-
-            # Prepare data for insertion
-            for i, chunk in enumerate(chunks):
-                documents.append({
-                    "id": f"{filename}-{i}",
-                    "source_title": source_meta["title"],
-                    "source_url": source_meta["url"],
-                    "chunk_text": chunk.page_content,
-                    "chunk_id_in_doc": i,
-                    "char_start": -1, # PDF parsing makes this tricky, but we'll include the field
-                    "char_end": -1
-                })
-        except Exception as e:
-            print(f"Error processing {filename}: {e}")
-
-    # Insert data into SQLite
-    db["chunks"].insert_all(documents, pk="id")
-
-    # Create a full-text search index on the chunk_text column
-    db["chunks"].enable_fts(["chunk_text"])
-
-    print(f"Ingestion complete. {len(documents)} chunks stored in {DB_PATH}")
+        content_hash = file_hash(os.path.join(PDF_DIR, filename))
+        doc = known.get(filename)
+        if doc and doc["content_hash"] == content_hash and not doc["deleted"]:
+            continue
+        todo[filename] = content_hash
+    print(f"{len(todo)} of {len(pdf_files)} documents are new or changed.")
+
+    total = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for filename in todo:
+            source_meta = sources.get(filename, {"title": filename, "url": "N/A"})
+            futures[pool.submit(ingest_pdf, filename, source_meta)] = (filename, source_meta)
+        for future in as_completed(futures):
+            filename, source_meta = futures[future]
+            try:
+                count, n_changed, n_removed = future.result()
+            except Exception as e:
+                # Leave the stored hash stale so the next run retries this document
+                print(f"Error processing {filename}: {e}")
+                continue
+            total += count
+            db["documents"].upsert({
+                "source_file": filename,
+                "content_hash": todo[filename],
+                "source_title": source_meta["title"],
+                "source_url": source_meta["url"],
+                "deleted": 0
+            }, pk="source_file")
+            print(f"Ingested {filename}: {count} chunks ({n_changed} new or changed, {n_removed} tombstoned)")
+
+    # Create (or refresh) the full-text search index on the chunk_text column
+    if db["chunks"].detect_fts():
+        db["chunks"].rebuild_fts()
+    else:
+        db["chunks"].enable_fts(["chunk_text"])
+
+    print(f"Ingestion complete. {total} chunks written to {DB_PATH}")
 
 if __name__ == "__main__":
-    ingest_pdfs()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Worker processes (default: one per CPU).")
+    parser.add_argument("--full", action="store_true", help="Drop all chunks and re-ingest every document.")
+    args = parser.parse_args()
+
+    ingest_pdfs(max_workers=args.workers, full=args.full)
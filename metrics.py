@@ -0,0 +1,119 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Latency metrics in the Prometheus text exposition format, without a client library.
+# Histograms are filled by the request pipeline; gauges and counters are read from the
+# components' stats() at scrape time.
+
+# --- CONFIG ---
+# Bucket bounds in seconds, from sub-millisecond cache hits up to cold-start encodes
+LATENCY_BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _number(value):
+    if value is None:
+        return "NaN"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    """
+    Thread-safe histogram with a fixed set of label names.
+
+    Observations are counted in their bucket only; the cumulative counts Prometheus
+    expects are computed when the histogram is rendered.
+    """
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS_S):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["buckets"][bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(s["buckets"]), s["sum"], s["count"]) for key, s in self._series.items()}
+        for key, (buckets, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), buckets):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {count}")
+        return lines
+
+def render_metric(name, metric_type, help_text, samples):
+    """
+    Renders a gauge or counter. `samples` is a list of (labels dict, value) pairs.
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(labels.keys(), labels.values())} {_number(value)}")
+    return lines
+
+def render(histograms, metrics):
+    """
+    Renders histograms and (name, type, help, samples) tuples as one exposition document.
+    """
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+    for name, metric_type, help_text, samples in metrics:
+        lines.extend(render_metric(name, metric_type, help_text, samples))
+    return "\n".join(lines) + "\n"
+
+@contextmanager
+def stage_timer(timings, stage):
+    """
+    Adds the time spent in the block, in seconds, to timings[stage]. Stages that run more
+    than once for a request (e.g. BM25 per question of a batch) accumulate. Does nothing
+    when timings is None.
+    """
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+# --- Pipeline metrics ---
+STAGE_LATENCY = Histogram(
+    "rag_stage_duration_seconds", "Time spent in each /ask pipeline stage.", ("stage", "mode"))
+REQUEST_LATENCY = Histogram(
+    "rag_request_duration_seconds", "End-to-end request handling time, including cache hits.", ("endpoint", "mode"))
+
+def observe_stages(timings, mode):
+    """Records a request's stage timings in the stage histogram under `mode`."""
+    for stage, seconds in timings.items():
+        STAGE_LATENCY.observe(seconds, stage=stage, mode=mode)
+
+def timings_ms(timings):
+    """Stage timings as rounded milliseconds, for the debug_timings response field."""
+    return {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()}
@@ -1,24 +1,37 @@
-import whoosh.index
-from whoosh.fields import Schema, TEXT, ID
-from whoosh.qparser import QueryParser
-from whoosh.analysis import StemmingAnalyzer
 import os
+import threading
+import time
+import numpy as np
+from chunk_store import source_key
+from fusion import DEFAULT_ALPHA, fuse
+
+# Whoosh is imported inside the functions that use it, here and in bm25_sparse, so the
+# reranking helpers can be used without loading it. The sparse backend loads only
+# whoosh.analysis, to tokenize exactly as the Whoosh index does.
 
 # --- CONFIG ---
 WHOOSH_INDEX_DIR = "data/whoosh_index"
+# "whoosh" for the on-disk Whoosh index, "sparse" for the in-memory NumPy/SciPy index
+BM25_BACKEND = os.environ.get("BM25_BACKEND", "whoosh")
+# Seconds between checks of the Whoosh index generation on disk
+WHOOSH_REFRESH_INTERVAL_S = float(os.environ.get("WHOOSH_REFRESH_INTERVAL_S", 2))
 
-def build_whoosh_index(chunks_data):
+def build_whoosh_index(chunks_data, index_dir=WHOOSH_INDEX_DIR):
     """
     Builds a Whoosh FTS index from chunks data.
     """
-    if not os.path.exists(WHOOSH_INDEX_DIR):
-        os.makedirs(WHOOSH_INDEX_DIR)
+    import whoosh.index
+    from whoosh.fields import Schema, TEXT, ID
+    from whoosh.analysis import StemmingAnalyzer
+
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
 
     schema = Schema(
-        id=ID(stored=True),
+        id=ID(stored=True, unique=True),
         chunk_text=TEXT(analyzer=StemmingAnalyzer())
     )
-    ix = whoosh.index.create_in(WHOOSH_INDEX_DIR, schema)
+    ix = whoosh.index.create_in(index_dir, schema)
     
     writer = ix.writer()
     for chunk in chunks_data:
@@ -26,28 +39,195 @@ def build_whoosh_index(chunks_data):
     writer.commit()
     print("Whoosh index built successfully.")
 
-def get_bm25_scores(query, k):
+def update_whoosh_index(upserted_chunks, deleted_ids, index_dir=WHOOSH_INDEX_DIR):
     """
-    Performs a BM25 search using Whoosh and returns a dictionary of chunk IDs to BM25 scores.
+    Applies an incremental change set to the Whoosh index: adds or replaces upserted_chunks
+    and removes deleted_ids. Returns False if there is no index yet to update.
     """
-    if not whoosh.index.exists_in(WHOOSH_INDEX_DIR):
-        print("Whoosh index not found. Please run ingest.py and build_whoosh_index().")
-        return {}
-        
-    ix = whoosh.index.open_dir(WHOOSH_INDEX_DIR)
-    
-    with ix.searcher() as searcher:
-        # Using a stemming analyzer for robustness
-        parser = QueryParser("chunk_text", ix.schema)
+    import whoosh.index
+
+    if not whoosh.index.exists_in(index_dir):
+        return False
+
+    ix = whoosh.index.open_dir(index_dir)
+    writer = ix.writer()
+    for chunk_id in deleted_ids:
+        writer.delete_by_term("id", chunk_id)
+    for chunk in upserted_chunks:
+        writer.update_document(id=chunk['id'], chunk_text=chunk['chunk_text'])
+    writer.commit()
+    print(f"Whoosh index updated: {len(upserted_chunks)} upserted, {len(deleted_ids)} deleted.")
+    return True
+
+class WhooshBM25:
+    """
+    Long-lived BM25 engine over the Whoosh index.
+
+    Whoosh searchers are not safe to share between threads, so each thread searches with
+    its own searcher, opened on its first query and reused across requests; searches run
+    in parallel without a lock. At most every refresh_interval seconds a search checks
+    the index generation on disk, and when the index has been rebuilt each thread reopens
+    its searcher on its next query.
+
+    The document numbers of each source are collected when a searcher is opened, so a
+    source filter is a set union passed to Whoosh as its filter/mask.
+
+    Queries are not parsed with Whoosh's query syntax: the engine searches for every term
+    of bm25_sparse.query_terms(), exactly as the sparse backend does.
+    """
+
+    def __init__(self, index_dir=WHOOSH_INDEX_DIR, refresh_interval=WHOOSH_REFRESH_INTERVAL_S):
+        self.index_dir = index_dir
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._searchers = set()
+        self._generation = None
+        self._checked_at = None
+        # Bumped by close(), so every thread reopens its searcher
+        self._epoch = 0
+
+    def _index_generation(self):
+        """
+        Identifies the index version on disk, or None when there is no index. A rebuild
+        with create_in() restarts the generation counter, so the TOC file's mtime is part
+        of the key.
+        """
+        import whoosh.index
+
+        try:
+            ix = whoosh.index.open_dir(self.index_dir)
+        except (whoosh.index.EmptyIndexError, OSError):
+            return None
+        generation = ix.latest_generation()
+        toc_path = os.path.join(self.index_dir, f"_{ix.indexname}_{generation}.toc")
         try:
-            query_obj = parser.parse(query)
-            results = searcher.search(query_obj, limit=k)
-            scores = {result['id']: result.score for result in results}
-            return scores
-        except Exception as e:
-            # Handle parsing errors for complex queries
-            print(f"Whoosh query parsing failed: {e}. Returning empty scores.")
+            return generation, os.stat(toc_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _check_generation(self):
+        """Re-reads the index generation on disk, at most every refresh_interval seconds."""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+            return
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.refresh_interval:
+                return
+            generation = self._index_generation()
+            # While a rebuild swaps the index in, keep the current generation and look again
+            if generation is not None:
+                self._generation = generation
+                self._checked_at = now
+
+    def _open_searcher(self):
+        import whoosh.index
+
+        key = (self._epoch, self._generation)
+        ix = whoosh.index.open_dir(self.index_dir)
+        searcher = ix.searcher()
+        source_docs = {}
+        for docnum, fields in searcher.reader().iter_docs():
+            source_docs.setdefault(source_key(fields['id']), set()).add(docnum)
+        with self._lock:
+            self._searchers.add(searcher)
+        return key, searcher, ix.schema["chunk_text"].analyzer, source_docs
+
+    def _thread_searcher(self):
+        """
+        Returns this thread's (searcher, analyzer, source docs) for the current index
+        generation, opening or reopening the searcher as needed; None if there is no index.
+        """
+        import whoosh.index
+
+        self._check_generation()
+        state = self._local
+        current = getattr(state, "key", None)
+        if self._generation is not None and current != (self._epoch, self._generation):
+            try:
+                opened = self._open_searcher()
+            except (whoosh.index.EmptyIndexError, OSError):
+                # The index is being swapped; look again on the next query
+                self._checked_at = None
+                opened = None
+            if opened is not None:
+                if current is not None:
+                    self._release(state.searcher)
+                state.key, state.searcher, state.analyzer, state.source_docs = opened
+        if getattr(state, "key", None) is None or state.key[0] != self._epoch:
+            return None
+        return state.searcher, state.analyzer, state.source_docs
+
+    def _release(self, searcher):
+        with self._lock:
+            if searcher not in self._searchers:
+                return
+            self._searchers.discard(searcher)
+        searcher.close()
+
+    def close(self):
+        """Closes every thread's searcher. No search may be in flight."""
+        with self._lock:
+            searchers, self._searchers = self._searchers, set()
+            self._generation = None
+            self._checked_at = None
+            self._epoch += 1
+        for searcher in searchers:
+            searcher.close()
+
+    def search(self, query, k, sources=None, exclude_sources=None):
+        """
+        Returns a dictionary of chunk IDs to BM25 scores for the top k hits, optionally
+        only among the chunks of `sources` and not of `exclude_sources` (file names).
+        """
+        from whoosh.query import And, Term
+        from bm25_sparse import query_terms
+
+        opened = self._thread_searcher()
+        if opened is None:
+            print("Whoosh index not found. Please run ingest.py and build_whoosh_index().")
             return {}
+        searcher, analyzer, source_docs = opened
+
+        def docs(names):
+            return set().union(*(source_docs.get(name, ()) for name in names))
+
+        terms = query_terms(query, analyzer)
+        allowed = docs(sources) if sources is not None else None
+        excluded = docs(exclude_sources) if exclude_sources else None
+        if not terms or (allowed is not None and not allowed):
+            return {}
+        query_obj = And([Term("chunk_text", term) for term in terms])
+        results = searcher.search(query_obj, limit=k, filter=allowed, mask=excluded)
+        return {result['id']: result.score for result in results}
+
+    __call__ = search
+
+def load_bm25_engine(backend=None, index_dir=None):
+    """
+    Creates a long-lived BM25 engine for the configured backend, over index_dir or the
+    backend's default index directory.
+    """
+    backend = backend or BM25_BACKEND
+    if backend == "sparse":
+        from bm25_sparse import SparseBM25, SPARSE_BM25_DIR
+        return SparseBM25(index_dir or SPARSE_BM25_DIR)
+    if backend == "whoosh":
+        return WhooshBM25(index_dir or WHOOSH_INDEX_DIR)
+    raise ValueError(f"Unknown BM25 backend: {backend}")
+
+def get_bm25_scores(query, k, backend=None):
+    """
+    Performs a BM25 search and returns a dictionary of chunk IDs to BM25 scores.
+
+    Opens the index for a single query; long-running services should keep the engine
+    from load_bm25_engine() instead.
+    """
+    engine = load_bm25_engine(backend)
+    try:
+        return engine.search(query, k)
+    finally:
+        engine.close()
             
 def normalize_scores(scores):
     """
@@ -64,33 +244,31 @@ def normalize_scores(scores):
     
     return {key: (score - min_score) / (max_score - min_score) for key, score in scores.items()}
     
-def hybrid_rerank(vector_results, query, alpha=0.6):
+def hybrid_rerank(vector_results, query, alpha=DEFAULT_ALPHA, bm25_search=get_bm25_scores, keyword_scores=None, fusion="weighted"):
     """
-    Reranks results using a hybrid approach: alpha * vector_score + (1-alpha) * bm25_score.
+    Reranks results by fusing their vector and BM25 scores with one of the methods in
+    fusion.py. The default "weighted" fusion is alpha * vector_score + (1-alpha) * bm25_score
+    on min-max normalized scores.
+
+    Pass `keyword_scores`, the BM25 scores aligned to vector_results (NaN where BM25 did not
+    return the chunk), when the caller already has them. Otherwise `bm25_search(query, k)` is
+    called; pass a long-lived engine such as load_bm25_engine().search to avoid reopening
+    the index per query.
     """
-    top_k = len(vector_results)
-    vector_scores = {res['chunk_id']: res['scores']['vector'] for res in vector_results}
-    
+    if not vector_results:
+        return []
+    vector_scores = np.array([res['scores']['vector'] for res in vector_results])
+
     # Get BM25 scores for the query
-    bm25_scores = get_bm25_scores(query, k=top_k * 2) # Search a bit wider for keywords
-    
-    # Normalize both score sets to 0-1
-    normalized_vector_scores = normalize_scores(vector_scores)
-    normalized_bm25_scores = normalize_scores(bm25_scores)
-    
-    # Combine scores and update results
-    for res in vector_results:
-        chunk_id = res['chunk_id']
-        vec_norm = normalized_vector_scores.get(chunk_id, 0.0)
-        bm25_norm = normalized_bm25_scores.get(chunk_id, 0.0)
-        
-        final_score = alpha * vec_norm + (1 - alpha) * bm25_norm
-        
+    if keyword_scores is None:
+        bm25_scores = bm25_search(query, k=len(vector_results) * 2) # Search a bit wider for keywords
+        keyword_scores = np.array([bm25_scores.get(res['chunk_id'], np.nan) for res in vector_results])
+
+    final, vector_part, keyword_part = fuse(vector_scores, keyword_scores, method=fusion, alpha=alpha)
+    for res, vec_norm, bm25_norm, final_score in zip(vector_results, vector_part.tolist(), keyword_part.tolist(), final.tolist()):
         res['scores']['vector_norm'] = vec_norm
         res['scores']['keyword'] = bm25_norm
         res['scores']['final'] = final_score
 
     # Sort the results by the new final score in descending order
-    reranked_results = sorted(vector_results, key=lambda x: x['scores']['final'], reverse=True)
-    
-    return reranked_results
\ No newline at end of file
+    return [vector_results[i] for i in np.argsort(-final, kind="stable")]
@@ -1,11 +1,8 @@
-import sqlite_utils
 import numpy as np
-from sklearn.linear_model import LogisticRegression
 import pickle
-import sys
+import json
 import os
-from sentence_transformers import SentenceTransformer
-import faiss
+import re
 
 # Set a consistent random seed for reproducibility
 np.random.seed(42)
@@ -16,22 +13,47 @@ MODEL_PATH = "data/learned_reranker.pkl"
 EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
 FAISS_INDEX_PATH = "data/faiss_index.bin"
 CHUNKS_PATH = "data/chunks.pkl"
+QUESTIONS_FILE = "questions.json"
+TRAIN_K = 20 # Vector candidates labelled per training question
+# A candidate is a positive example when it contains at least this fraction of the
+# reference answer's terms
+LABEL_MIN_OVERLAP = 0.3
+# Pseudo-count pulling each source's prior towards the overall positive rate
+SOURCE_PRIOR_SMOOTHING = 5.0
 
-# Load resources once
-print("Loading resources...")
-model = SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu")
-index = faiss.read_index(FAISS_INDEX_PATH)
-with open(CHUNKS_PATH, 'rb') as f:
-    chunks_data = pickle.load(f)
+FEATURE_NAMES = ["vector", "bm25", "term_overlap", "log_length", "source_prior"]
+TOKEN_PATTERN = re.compile(r"\w\w+")
+
+# Offline training resources, loaded by load_resources(). The API imports this module for
+# learned_rerank only and must not load a second model or index here.
+model = None
+index = None
+chunks_data = None
+chunks_by_vec = None
+
+def load_resources():
+    """Loads the embedding model, FAISS index and chunk data for offline training."""
+    global model, index, chunks_data, chunks_by_vec
+    from encoders import ENCODER_BACKEND, load_encoder
+    import faiss
+
+    print("Loading resources...")
+    model = load_encoder(ENCODER_BACKEND, EMBEDDING_MODEL_NAME)
+    index = faiss.read_index(FAISS_INDEX_PATH)
+    with open(CHUNKS_PATH, 'rb') as f:
+        chunks_data = pickle.load(f)
+    chunks_by_vec = {c.get('vec_id', i): c for i, c in enumerate(chunks_data)}
 
 def vector_search(query, k):
     """Performs a basic vector search and returns ranked chunks."""
-    query_embedding = model.encode([query], convert_to_tensor=False).astype('float32')
+    query_embedding = model.encode([query])
     distances, indices = index.search(query_embedding, k)
-    
+
     results = []
     for i, idx in enumerate(indices[0]):
-        chunk = chunks_data[idx]
+        if idx == -1:
+            continue
+        chunk = chunks_by_vec[int(idx)]
         results.append({
             "chunk_id": chunk['id'],
             "source_title": chunk['source_title'],
@@ -41,31 +63,140 @@ def vector_search(query, k):
         })
     return results
 
-# ... (the rest of the code remains the same) ...
+def tokenize(text):
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+def extract_features(vector_results, query, keyword_scores, source_prior, default_prior):
+    """
+    Builds the (n_candidates, len(FEATURE_NAMES)) feature matrix for one query from the
+    vector hits and the BM25 scores the caller already has, aligned to vector_results
+    (NaN where BM25 did not return the chunk).
+
+    BM25 is scaled by the best BM25 score among the candidates, since raw BM25 values are
+    not comparable across queries.
+    """
+    n = len(vector_results)
+    query_terms = tokenize(query)
+    features = np.empty((n, len(FEATURE_NAMES)), dtype=np.float64)
+    features[:, 1] = np.nan_to_num(keyword_scores, nan=0.0)
+    for i, res in enumerate(vector_results):
+        text = res['text_snippet']
+        features[i, 0] = res['scores']['vector']
+        features[i, 2] = len(query_terms & tokenize(text)) / len(query_terms) if query_terms else 0.0
+        features[i, 3] = len(text)
+        features[i, 4] = source_prior.get(res['source_title'], default_prior)
+    best_bm25 = features[:, 1].max() if n else 0.0
+    if best_bm25 > 0:
+        features[:, 1] /= best_bm25
+    features[:, 3] = np.log1p(features[:, 3])
+    return features
+
+def answer_overlap(answer_terms, text):
+    """Fraction of the reference answer's terms that appear in a chunk."""
+    if not answer_terms:
+        return 0.0
+    return len(answer_terms & tokenize(text)) / len(answer_terms)
 
-# The original get_training_data, extract_features, and learned_rerank functions
-# are the same as before. Just make sure the train_learned_reranker function
-# calls your new local vector_search function.
+def train_learned_reranker(questions, vector_search_func, bm25_search_func, k=TRAIN_K, model_path=MODEL_PATH):
+    """
+    Trains a logistic-regression reranker on the vector candidates for each question in
+    questions.json, labelling a candidate relevant when it overlaps enough with the
+    question's reference answer. Saves the model together with the per-source priors
+    used as a feature.
+    """
+    from sklearn.linear_model import LogisticRegression
 
-def train_learned_reranker(chunks_data, vector_search_func, bm25_search_func):
-    # ... (same as before) ...
-    pass # No changes needed here, as the function signature is the same
+    candidates = []
+    for item in questions:
+        results = vector_search_func(item["q"], k)
+        bm25_scores = bm25_search_func(item["q"], k=k * 2)
+        keyword_scores = np.array([bm25_scores.get(res['chunk_id'], np.nan) for res in results])
+        answer_terms = tokenize(item["a"])
+        labels = [int(answer_overlap(answer_terms, res['text_snippet']) >= LABEL_MIN_OVERLAP) for res in results]
+        candidates.append((item["q"], results, keyword_scores, labels))
 
-def learned_rerank(vector_results, query, chunks_data, vector_search_func, bm25_search_func):
-    # ... (same as before) ...
-    pass # No changes needed here, as the function signature is the same
+    # Source prior: smoothed share of each source's candidates that were labelled relevant
+    all_labels = [label for _, _, _, labels in candidates for label in labels]
+    if len(set(all_labels)) < 2:
+        print(f"Error: training needs both relevant and irrelevant candidates, got {len(all_labels)} labels of one class.")
+        return None
+    default_prior = float(np.mean(all_labels))
+    counts = {}
+    for _, results, _, labels in candidates:
+        for res, label in zip(results, labels):
+            positives, total = counts.get(res['source_title'], (0, 0))
+            counts[res['source_title']] = (positives + label, total + 1)
+    source_prior = {
+        title: (positives + SOURCE_PRIOR_SMOOTHING * default_prior) / (total + SOURCE_PRIOR_SMOOTHING)
+        for title, (positives, total) in counts.items()
+    }
+
+    X = np.vstack([extract_features(results, q, keyword_scores, source_prior, default_prior) for q, results, keyword_scores, _ in candidates])
+    y = np.array(all_labels)
+    clf = LogisticRegression(class_weight="balanced", max_iter=1000)
+    clf.fit(X, y)
+    print(f"Trained on {len(y)} candidates from {len(questions)} questions ({int(y.sum())} relevant); "
+          f"training accuracy {clf.score(X, y):.3f}")
+    print("Feature weights: " + ", ".join(f"{name}={w:.3f}" for name, w in zip(FEATURE_NAMES, clf.coef_[0])))
+
+    reranker = {
+        "model": clf,
+        "feature_names": FEATURE_NAMES,
+        "source_prior": source_prior,
+        "default_prior": default_prior,
+    }
+    with open(model_path, 'wb') as f:
+        pickle.dump(reranker, f)
+    print(f"Learned reranker saved to {model_path}")
+    return reranker
+
+def load_learned_reranker(model_path=MODEL_PATH):
+    """Loads the trained reranker saved by train_learned_reranker(), or None if there is none."""
+    if not os.path.exists(model_path):
+        return None
+    with open(model_path, 'rb') as f:
+        reranker = pickle.load(f)
+    if reranker.get("feature_names") != FEATURE_NAMES:
+        raise ValueError(f"{model_path} was trained on features {reranker.get('feature_names')}; retrain it.")
+    return reranker
+
+def learned_rerank(vector_results, query, keyword_scores, reranker):
+    """
+    Reranks the vector hits by the learned model's probability of relevance.
+
+    `keyword_scores` are the query's BM25 scores aligned to vector_results (NaN where BM25
+    did not return the chunk) and `reranker` is the dict
+    returned by load_learned_reranker(). All candidates are scored with one matrix-vector
+    product.
+    """
+    if not vector_results:
+        return []
+    features = extract_features(vector_results, query, keyword_scores, reranker["source_prior"], reranker["default_prior"])
+    # Equal to predict_proba(features)[:, 1], without scikit-learn's per-call input
+    # validation, which costs more than the rest of the reranker put together
+    clf = reranker["model"]
+    probabilities = 1.0 / (1.0 + np.exp(-(features @ clf.coef_[0] + clf.intercept_[0])))
+    for res, keyword, probability in zip(vector_results, features[:, 1], probabilities):
+        res['scores']['keyword'] = float(keyword)
+        res['scores']['learned'] = float(probability)
+        res['scores']['final'] = float(probability)
+    return sorted(vector_results, key=lambda x: x['scores']['final'], reverse=True)
 
 if __name__ == "__main__":
     import argparse
-    from rerank_hybrid import get_bm25_scores, build_whoosh_index
-    
+    from rerank_hybrid import load_bm25_engine
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--train", action="store_true", help="Train the learned reranker model.")
+    parser.add_argument("--k", type=int, default=TRAIN_K, help="Vector candidates labelled per question.")
     args = parser.parse_args()
-    
+
     if args.train:
-        # Build Whoosh index if it doesn't exist
-        if not os.path.exists(os.path.join("data", "whoosh_index")):
-            build_whoosh_index(chunks_data)
-        
-        train_learned_reranker(chunks_data, vector_search, get_bm25_scores)
\ No newline at end of file
+        load_resources()
+        with open(QUESTIONS_FILE, 'r') as f:
+            questions = json.load(f)
+        bm25 = load_bm25_engine()
+        try:
+            train_learned_reranker(questions, vector_search, bm25.search, k=args.k)
+        finally:
+            bm25.close()
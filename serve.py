@@ -0,0 +1,117 @@
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+# Multi-worker serving with fork-after-load: the parent loads the model and indexes once,
+# then forks workers that share those pages copy-on-write and accept connections from one
+# listening socket. The chunk store and the sparse BM25 index are memory-mapped, so they
+# are shared through the page cache as well.
+
+# --- CONFIG ---
+HOST = os.environ.get("RAG_HOST", "0.0.0.0")
+PORT = int(os.environ.get("RAG_PORT", 8000))
+WORKERS = int(os.environ.get("RAG_WORKERS", os.cpu_count() or 1))
+# Seconds to wait before restarting a worker that died, so a crash loop does not spin
+RESTART_DELAY_S = 1.0
+
+def threads_per_worker(workers):
+    """Splits the cores between workers so their torch/FAISS thread pools do not oversubscribe."""
+    return max(1, (os.cpu_count() or 1) // workers)
+
+def configure_threads(threads):
+    """
+    Caps the OpenMP/BLAS pools and the encoder's intra-op threads. Must run before torch,
+    faiss or onnxruntime are imported; explicitly set environment variables win.
+    """
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "RAG_ENCODER_THREADS"):
+        os.environ.setdefault(var, str(threads))
+
+def run_worker(app, sock, worker_id, threads):
+    """Serves the app on the inherited socket; runs in the forked child."""
+    import faiss
+    import uvicorn
+
+    faiss.omp_set_num_threads(threads)
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(threads)
+    print(f"Worker {worker_id} started (pid {os.getpid()}, {threads} threads).")
+    uvicorn.Server(uvicorn.Config(app, log_level="info")).run(sockets=[sock])
+
+def serve(host=HOST, port=PORT, workers=WORKERS):
+    """
+    Preloads the shared resources, forks `workers` uvicorn workers and restarts any that
+    die until SIGTERM/SIGINT, which is passed on to the workers.
+    """
+    threads = threads_per_worker(workers)
+    configure_threads(threads)
+    # Imported only now so the thread settings above apply to torch and faiss
+    import app as rag
+
+    print(f"Preloading resources for {workers} workers ({threads} threads each)...")
+    rag.preload_shared_resources()
+    # Stop the garbage collector from touching the preloaded objects, which would copy
+    # their pages into every worker
+    gc.freeze()
+
+    sock = socket.create_server((host, port), backlog=2048)
+    sock.set_inheritable(True)
+    children = {}
+    stopping = False
+
+    def spawn(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(rag.app, sock, worker_id, threads)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            os._exit(code)
+        children[pid] = worker_id
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker_id in range(workers):
+        spawn(worker_id)
+    print(f"Serving on http://{host}:{port} with {workers} workers.")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_id = children.pop(pid, None)
+        if worker_id is not None and not stopping:
+            print(f"Worker {worker_id} (pid {pid}) exited with status {status}; restarting.")
+            time.sleep(RESTART_DELAY_S)
+            spawn(worker_id)
+    sock.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the Mini RAG API from N forked workers sharing one loaded index.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    serve(host=args.host, port=args.port, workers=args.workers)
+    # To run: python serve.py --workers 4 --port 8000
@@ -0,0 +1,29 @@
+import hashlib
+
+import numpy as np
+
+# Shared by the tests that build an index: a deterministic encoder and a chunks.db writer
+DIM = 16
+
+class HashEncoder:
+    """Deterministic stand-in for the sentence encoder: one unit vector per distinct text."""
+
+    backend = "torch"
+    dim = DIM
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def encode(self, texts, **kwargs):
+        vectors = np.array([np.random.default_rng(int(hashlib.sha1(t.encode()).hexdigest()[:8], 16)).normal(size=DIM)
+                            for t in texts], dtype='float32').reshape(len(texts), DIM)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def insert_chunks(db, texts, source_file="doc.pdf"):
+    db["chunks"].insert_all(
+        [{"id": f"{source_file}-{i}", "source_title": "Doc", "source_url": "N/A", "chunk_text": text,
+          "chunk_id_in_doc": i, "page": 1, "char_start": 0, "char_end": len(text), "source_file": source_file,
+          "content_hash": hashlib.sha1(text.encode()).hexdigest(), "deleted": 0}
+         for i, text in enumerate(texts)],
+        pk="id", replace=True,
+        columns={"vec_id": int, "embedded_hash": str, "canonical_id": str})
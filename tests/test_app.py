@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+import sqlite_utils
+from fastapi.testclient import TestClient
+
+import app as rag_app
+import embed_index
+from corpus import HashEncoder, insert_chunks
+
+TOPICS = ["robot arm safety interlock", "forklift load limits", "ladder inspection checklist",
+          "chemical spill response", "machine guarding rules", "lockout tagout procedure",
+          "hearing protection levels", "welding fume ventilation"]
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """The API serving an index built over TOPICS, each repeated in three documents."""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+    monkeypatch.setattr(embed_index, "load_encoder", HashEncoder)
+    db = sqlite_utils.Database(embed_index.DB_PATH)
+    for copy in range(3):
+        insert_chunks(db, [f"{topic} for safety staff" for topic in TOPICS], source_file=f"doc{copy}.pdf")
+    embed_index.embed_and_index()
+
+    monkeypatch.setattr(rag_app, "load_encoder", HashEncoder)
+    monkeypatch.setattr(rag_app, "INDEX_WATCH_INTERVAL_S", 0)
+    with TestClient(rag_app.app) as client:
+        deadline = time.time() + 30
+        while client.get("/readyz").status_code != 200:
+            assert time.time() < deadline, client.get("/readyz").json()
+            time.sleep(0.05)
+        yield client
+
+def test_stream_sends_vector_hits_before_keyword_search(client, monkeypatch):
+    served = rag_app.app.state.indices.current
+    events = []
+    search = served.bm25.search
+    def recording_search(*args, **kwargs):
+        events.append("bm25")
+        return search(*args, **kwargs)
+    monkeypatch.setattr(served.bm25, "search", recording_search)
+
+    async def collect():
+        response = await rag_app.ask_stream(rag_app.AskRequest(q="forklift load limits", k=3))
+        async for chunk in response.body_iterator:
+            events.append(json.loads(chunk))
+    asyncio.run(collect())
+
+    assert [e if e == "bm25" else e["event"] for e in events] == ["retrieved", "bm25", "reranked", "answer"]
+    assert all(set(ctx["scores"]) == {"vector"} for ctx in events[0]["contexts"])
+    assert len(events[0]["contexts"]) == 3
+
+def test_concurrent_queries_share_an_embedding_batch(client):
+    embedder = rag_app.app.state.embedder
+    embedder.max_wait = 0.5
+    queries = [f"{topic} question" for topic in TOPICS]
+
+    async def ask_all():
+        return await asyncio.gather(*(rag_app.ask_question(rag_app.AskRequest(q=q)) for q in queries))
+    responses = asyncio.run(ask_all())
+
+    assert all(response.status_code == 200 for response in responses)
+    # Queries are queued from the event loop, so a batch is not capped by the pipeline threads
+    assert max(embedder.stats()["batch_size_distribution"]) == len(queries) > rag_app.MAX_CONCURRENCY
+
+def test_batch_reports_timings_for_cached_items(client):
+    ask = {"q": "ladder inspection checklist", "debug_timings": True}
+    client.post("/ask", json=ask)
+    results = client.post("/ask/batch", json={"items": [ask, {**ask, "q": "welding fume ventilation"}]}).json()["results"]
+    cached, computed = results
+    assert set(cached["debug_timings"]) == {"response_cache"}
+    assert {"response_cache", "embed", "vector_search", "rerank"} <= set(computed["debug_timings"])
+
+@pytest.mark.parametrize("mode", ["baseline", "hybrid"])
+def test_collapse_duplicates_still_returns_k(client, mode):
+    # Every topic appears in three documents, so a pool of 5 holds only 2-3 clusters
+    ask = {"q": "robot arm safety interlock", "k": 5, "candidates": 5, "mode": mode, "collapse_duplicates": True}
+    for contexts in (client.post("/ask", json=ask).json()["contexts"],
+                     client.post("/ask/batch", json={"items": [{**ask, "q": "forklift load limits"}]}).json()["results"][0]["contexts"]):
+        texts = [ctx["text_snippet"] for ctx in contexts]
+        assert len(texts) == 5 and len(set(texts)) == 5
+
+def test_rejected_queries_are_not_encoded(client, monkeypatch):
+    monkeypatch.setattr(rag_app, "MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(rag_app, "MAX_QUEUE", 1)
+    embedder = rag_app.app.state.embedder
+    embedder.max_wait = 0.2
+    encoded = embedder.stats()["queue_delay_ms"]["count"]
+
+    async def ask_all():
+        requests = [rag_app.AskRequest(q=f"question {i}") for i in range(20)]
+        return await asyncio.gather(*(rag_app.ask_question(r) for r in requests), return_exceptions=True)
+    results = asyncio.run(ask_all())
+
+    rejected = [r for r in results if isinstance(r, rag_app.HTTPException) and r.status_code == 503]
+    assert len(rejected) == 18
+    assert embedder.stats()["queue_delay_ms"]["count"] - encoded == 2
+    assert rag_app.app.state.pending == 0
+
+def test_sources_are_files_even_with_shared_metadata(client):
+    # Every document of the fixture has the same title and url
+    assert [source["file"] for source in client.get("/sources").json()["sources"]] == ["doc0.pdf", "doc1.pdf", "doc2.pdf"]
+    for mode in ("baseline", "hybrid"):
+        ask = {"q": "forklift load limits", "k": 10, "mode": mode, "sources": ["doc1.pdf"]}
+        response = client.post("/ask", json=ask)
+        assert response.status_code == 200
+        assert {ctx["chunk_id"].rsplit("-", 1)[0] for ctx in response.json()["contexts"]} == {"doc1.pdf"}
+
+@pytest.mark.parametrize("token, headers, status", [(None, {}, 403), (None, {"X-Admin-Token": ""}, 403),
+                                                    ("secret", {}, 403), ("secret", {"X-Admin-Token": "wrong"}, 403),
+                                                    ("secret", {"X-Admin-Token": "secret"}, 200)])
+def test_admin_endpoints_fail_closed(client, monkeypatch, token, headers, status):
+    monkeypatch.setattr(rag_app, "ADMIN_TOKEN", token)
+    assert client.get("/admin/index", headers=headers).status_code == status
+    if status == 403:
+        assert client.post("/admin/reload", json={}, headers=headers).status_code == 403
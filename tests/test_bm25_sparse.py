@@ -0,0 +1,54 @@
+import pytest
+
+from bm25_sparse import SparseBM25, build_sparse_bm25, check_parity, query_terms
+from rerank_hybrid import WhooshBM25, build_whoosh_index
+
+CHUNKS = [
+    "Robot safety zones must be fenced and interlocked.",
+    "Safety shoes are required in the warehouse.",
+    "The robot arm stops when the light curtain is broken.",
+    "Forklift safety: never carry passengers on a forklift.",
+    "Lockout procedures keep robot maintenance safe; safety first, safety always.",
+    "Warehouse racking must be inspected every year.",
+]
+
+QUERIES = [
+    "robot safety",
+    "safety NOT robot",
+    "safety OR warehouse",
+    "safety AND robot",
+    '"robot safety"',
+    "(forklift OR robot) safety",
+    "saf* rob?t",
+    "chunk_text:forklift",
+    "safety^3 robot",
+    "safety safety robot",
+    "racking inspection",
+    "unknownterm safety",
+    "NOT",
+    "",
+]
+
+@pytest.fixture
+def engines(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    chunks = [{"id": f"doc{i % 2}.pdf-{i}", "chunk_text": text} for i, text in enumerate(CHUNKS)]
+    build_whoosh_index(chunks)
+    build_sparse_bm25(chunks)
+    whoosh_engine, sparse_engine = WhooshBM25(), SparseBM25()
+    yield whoosh_engine, sparse_engine
+    whoosh_engine.close()
+
+def test_backends_agree_on_every_query(engines):
+    assert check_parity(QUERIES, k=3) == []
+    whoosh_engine, sparse_engine = engines
+    for query in QUERIES:
+        for filters in ({}, {"sources": ["doc0.pdf"]}, {"exclude_sources": ["doc0.pdf"]}):
+            expected, actual = whoosh_engine.search(query, 10, **filters), sparse_engine.search(query, 10, **filters)
+            assert expected == pytest.approx(actual, rel=1e-5), (query, filters)
+
+def test_query_syntax_is_plain_terms(engines):
+    assert query_terms("safety NOT robot") == ["safeti", "robot"]
+    whoosh_engine, _ = engines
+    # Operators are stopwords, so the NOT query matches the chunks with both terms
+    assert set(whoosh_engine.search("safety NOT robot", 10)) == {"doc0.pdf-0", "doc0.pdf-4"}
@@ -0,0 +1,85 @@
+import faiss
+import numpy as np
+import pytest
+import sqlite_utils
+
+from embed_index import build_faiss_index, dedup_chunks, near_duplicate_clusters, near_duplicate_pairs
+
+DIM = 16
+
+def unit(vectors):
+    vectors = np.asarray(vectors, dtype='float32')
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def corpus():
+    """Chunks a-e: b nearly repeats a, d nearly repeats c, e stands alone."""
+    rng = np.random.default_rng(0)
+    base = unit(rng.normal(size=(3, DIM)))
+    noise = unit(rng.normal(size=(2, DIM)))
+    vectors = unit(np.vstack([base[0], base[0] + 0.05 * noise[0], base[1], base[1] + 0.05 * noise[1], base[2]]))
+    return ["a", "b", "c", "d", "e"], vectors
+
+def make_db(ids):
+    db = sqlite_utils.Database(memory=True)
+    db["chunks"].insert_all(
+        [{"id": chunk_id, "chunk_text": chunk_id, "content_hash": chunk_id, "deleted": 0, "vec_id": vec_id,
+          "embedded_hash": chunk_id, "canonical_id": None} for vec_id, chunk_id in enumerate(ids)],
+        pk="id", columns={"canonical_id": str})
+    return db
+
+def canonical_ids(db):
+    return {row["id"]: row["canonical_id"] for row in db["chunks"].rows}
+
+def test_near_duplicate_pairs_reads_in_batches():
+    _, vectors = corpus()
+    index, _ = build_faiss_index(vectors, ids=np.arange(10, 15), index_type="flat")
+    sources, targets = near_duplicate_pairs(index, vectors, np.arange(10, 15), threshold=0.95, batch_size=2)
+    pairs = {(s, t) for s, t in zip(sources.tolist(), targets.tolist()) if s != t}
+    assert pairs == {(10, 11), (11, 10), (12, 13), (13, 12)}
+
+def test_near_duplicate_clusters_is_single_linkage():
+    # 0-1-2 chain into one cluster even though 0 and 2 are not a pair
+    canonical = near_duplicate_clusters(5, np.array([0, 2, 4]), np.array([1, 1, 3]))
+    assert canonical.tolist() == [0, 0, 0, 3, 3]
+
+def test_near_duplicate_clusters_empty():
+    assert len(near_duplicate_clusters(0, np.zeros(0, dtype=int), np.zeros(0, dtype=int))) == 0
+
+@pytest.mark.parametrize("index_type", ["flat", "hnsw", "ivf_flat", "ivf_pq"])
+def test_dedup_chunks_records_canonical_ids(index_type, tmp_path):
+    ids, vectors = corpus()
+    db = make_db(ids)
+    # The build hands the stage its embeddings as a read-only memmap
+    np.save(tmp_path / "embeddings.npy", vectors)
+    embeddings = np.load(tmp_path / "embeddings.npy", mmap_mode="r")
+    index, _ = build_faiss_index(vectors, ids=np.arange(len(ids)), index_type=index_type, nlist=1, pq_m=4, pq_nbits=2)
+    summary = dedup_chunks(db, index, embeddings, np.arange(len(ids)), threshold=0.95)
+    assert canonical_ids(db) == {"a": "a", "b": "a", "c": "c", "d": "c", "e": "e"}
+    assert summary["duplicates"] == 2 and summary["clusters"] == 2
+
+def test_dedup_chunks_incremental_keeps_existing_clusters():
+    ids, vectors = corpus()
+    db = make_db(ids)
+    index, _ = build_faiss_index(vectors, ids=np.arange(len(ids)), index_type="flat")
+    dedup_chunks(db, index, vectors, np.arange(len(ids)), threshold=0.95)
+    # A new chunk that repeats e; only its vector is read
+    db["chunks"].insert({"id": "g", "chunk_text": "g", "content_hash": "g", "deleted": 0, "vec_id": 5, "embedded_hash": "g"})
+    index.add_with_ids(vectors[4:5], np.array([5]))
+    dedup_chunks(db, index, vectors[4:5], np.array([5]), threshold=0.95)
+    assert canonical_ids(db) == {"a": "a", "b": "a", "c": "c", "d": "c", "e": "e", "g": "e"}
+
+def test_dedup_chunks_maps_dropped_exact_duplicates():
+    ids, vectors = corpus()
+    db = make_db(ids)
+    db["chunks"].insert({"id": "f", "chunk_text": "b", "content_hash": "b", "deleted": 0})
+    index, _ = build_faiss_index(vectors, ids=np.arange(len(ids)), index_type="flat")
+    summary = dedup_chunks(db, index, vectors, np.arange(len(ids)), threshold=0.95, dropped={"f": "b"})
+    assert canonical_ids(db)["f"] == "a"
+    assert summary["dropped_exact"] == 1
+
+def test_dedup_chunks_disabled_clears_canonical_ids():
+    ids, vectors = corpus()
+    db = make_db(ids)
+    db.conn.execute("UPDATE chunks SET canonical_id = 'a'")
+    dedup_chunks(db, faiss.IndexIDMap2(faiss.IndexFlatIP(DIM)), threshold=None)
+    assert set(canonical_ids(db).values()) == {None}
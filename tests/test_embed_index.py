@@ -0,0 +1,91 @@
+import os
+
+import faiss
+import pytest
+import sqlite_utils
+
+import embed_index
+from corpus import HashEncoder, insert_chunks
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+    monkeypatch.setattr(embed_index, "load_encoder", HashEncoder)
+    return tmp_path
+
+def texts(n):
+    return [f"chunk number {i} about machine safety" for i in range(n)]
+
+def test_full_build_indexes_every_chunk(workdir):
+    db = sqlite_utils.Database(embed_index.DB_PATH)
+    insert_chunks(db, texts(6))
+    embed_index.embed_and_index(dedup_threshold=None)
+    index = faiss.read_index(embed_index.FAISS_INDEX_PATH)
+    vec_ids = [row["vec_id"] for row in db["chunks"].rows]
+    assert index.ntotal == 6 and sorted(vec_ids) == list(range(6))
+    assert not os.path.exists(embed_index.EMBED_CHECKPOINT_PATH)
+
+def test_recreated_chunks_table_forces_full_rebuild(workdir):
+    db = sqlite_utils.Database(embed_index.DB_PATH)
+    insert_chunks(db, texts(6))
+    embed_index.embed_and_index(dedup_threshold=None)
+    # What `ingest.py --full` leaves behind: the same chunks, none with a vector
+    db["chunks"].drop()
+    insert_chunks(db, texts(6))
+    embed_index.embed_and_index(dedup_threshold=None)
+    index = faiss.read_index(embed_index.FAISS_INDEX_PATH)
+    vec_ids = sorted(row["vec_id"] for row in db["chunks"].rows)
+    assert index.ntotal == 6
+    assert vec_ids == sorted(faiss.vector_to_array(index.id_map).tolist())
+
+def test_build_records_near_duplicates(workdir):
+    db = sqlite_utils.Database(embed_index.DB_PATH)
+    insert_chunks(db, texts(4) + [texts(4)[1]])
+    embed_index.embed_and_index()
+    canonical = {row["id"]: row["canonical_id"] for row in db["chunks"].rows}
+    assert canonical["doc.pdf-4"] == "doc.pdf-1"
+    assert sum(chunk_id != c for chunk_id, c in canonical.items()) == 1
+
+def test_failed_build_leaves_every_artifact_in_place(workdir, monkeypatch):
+    db = sqlite_utils.Database(embed_index.DB_PATH)
+    insert_chunks(db, texts(4))
+    embed_index.embed_and_index()
+    artifacts = [embed_index.FAISS_INDEX_PATH, embed_index.INDEX_META_PATH, embed_index.CHUNKS_PATH,
+                 "data/chunk_store", "data/whoosh_index", "data/bm25_index"]
+    def snapshot():
+        files = [os.path.join(root, name) for path in artifacts for root, _, names in os.walk(path) for name in names]
+        files += [path for path in artifacts if os.path.isfile(path)]
+        return {path: open(path, "rb").read() for path in files}
+    before, rows = snapshot(), list(db["chunks"].rows)
+
+    insert_chunks(db, ["an extra chunk about forklifts"], source_file="other.pdf")
+    def failing_write(index, path):
+        raise OSError("disk full")
+    monkeypatch.setattr(faiss, "write_index", failing_write)
+    with pytest.raises(OSError):
+        embed_index.embed_and_index()
+    assert snapshot() == before
+    assert [row for row in db["chunks"].rows if row["source_file"] == "doc.pdf"] == rows
+
+def test_reference_is_encoded_only_when_its_sample_changes(workdir, monkeypatch):
+    class OnnxEncoder(HashEncoder):
+        backend = "onnx"
+    loaded = []
+    def load_encoder(backend, **kwargs):
+        loaded.append(backend)
+        return OnnxEncoder() if backend == "onnx" else HashEncoder()
+    monkeypatch.setattr(embed_index, "load_encoder", load_encoder)
+    db = sqlite_utils.Database(embed_index.DB_PATH)
+    insert_chunks(db, texts(6))
+    embed_index.embed_and_index(encoder_backend="onnx", dedup_threshold=None)
+    assert loaded == ["onnx", "torch"]
+
+    # Same chunks: the agreement check uses the saved PyTorch embeddings
+    embed_index.embed_and_index(encoder_backend="onnx", full=True, dedup_threshold=None)
+    assert loaded == ["onnx", "torch", "onnx"]
+
+    # An edited chunk is in the sample, so the reference is re-encoded
+    insert_chunks(db, texts(5) + ["chunk number 5 about ladder safety"])
+    embed_index.embed_and_index(encoder_backend="onnx", dedup_threshold=None)
+    assert loaded == ["onnx", "torch", "onnx", "onnx", "torch"]
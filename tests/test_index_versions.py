@@ -0,0 +1,29 @@
+from index_versions import IndexManager, LoadedIndex
+
+class Closable:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+def loaded(version):
+    return LoadedIndex(version, {}, None, {}, Closable(), Closable())
+
+def test_retired_version_stays_open_until_its_last_lease():
+    old = loaded("v1")
+    manager = IndexManager(old)
+    first, second = manager.acquire(), manager.acquire()
+    manager.swap(loaded("v2"))
+    manager.retire(old, drain_timeout=0.01)
+    assert not old.store.closed and manager.retired == ["v1"]
+    first.release()
+    assert not old.store.closed
+    second.release()
+    assert old.store.closed and old.bm25.closed and manager.retired == []
+
+def test_unleased_version_closes_on_retire():
+    old = loaded("v1")
+    manager = IndexManager(old)
+    manager.swap(loaded("v2"))
+    manager.retire(old, drain_timeout=0.01)
+    assert old.store.closed and manager.retired == []
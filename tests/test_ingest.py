@@ -0,0 +1,78 @@
+import os
+
+import faiss
+import pytest
+import sqlite_utils
+
+import embed_index
+import ingest
+from chunk_store import ChunkStore
+from corpus import HashEncoder
+from rerank_hybrid import WhooshBM25
+
+SOURCE = {"title": "Doc", "url": "N/A"}
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+    monkeypatch.setattr(embed_index, "load_encoder", HashEncoder)
+    ingest.create_tables(sqlite_utils.Database(ingest.DB_PATH))
+    return tmp_path
+
+def ingest_texts(monkeypatch, texts, filename="doc.pdf"):
+    """Ingests `filename` as if its PDF split into `texts`, all on page 1."""
+    chunks = [(1, text, 0, len(text)) for text in texts]
+    monkeypatch.setattr(ingest, "iter_page_chunks", lambda filepath, text_splitter: iter(chunks))
+    return ingest.ingest_pdf(filename, SOURCE)
+
+def vectors_by_text(db):
+    return {row["chunk_text"]: row["vec_id"] for row in db["chunks"].rows_where("deleted = 0")}
+
+TEXTS = ["guard rails on platforms", "ladder feet and angles", "scaffold tie spacing", "harness anchor points", "hoist brake checks"]
+
+@pytest.mark.parametrize("edit", [["edge protection overview"] + TEXTS, TEXTS[1:], TEXTS[:2] + ["roof hatch covers"] + TEXTS[2:]])
+def test_shifted_chunks_keep_their_vectors(workdir, monkeypatch, edit):
+    db = sqlite_utils.Database(ingest.DB_PATH)
+    ingest_texts(monkeypatch, TEXTS)
+    embed_index.embed_and_index()
+    before = vectors_by_text(db)
+
+    count, n_changed, _ = ingest_texts(monkeypatch, edit)
+    assert n_changed == len(set(edit) - set(TEXTS))
+    embed_index.embed_and_index()
+
+    # Only new text is embedded; every other chunk kept its vector under its new id
+    after = vectors_by_text(db)
+    assert {text: after[text] for text in before if text in after} == {text: before[text] for text in edit if text in before}
+    index = faiss.read_index(embed_index.FAISS_INDEX_PATH)
+    assert index.ntotal == count == len(after)
+    assert embed_index.load_index_meta()["next_vec_id"] == len(TEXTS) + n_changed
+
+    # The chunk store and keyword index follow the new ids
+    store = ChunkStore()
+    rows = {store.chunk_id(row): store.text(row) for row in range(len(store))}
+    assert rows == {f"doc.pdf-{i}": text for i, text in enumerate(edit)}
+    bm25 = WhooshBM25()
+    for i, text in enumerate(edit):
+        assert list(bm25.search(text, k=3)) == [f"doc.pdf-{i}"]
+
+def test_repeated_text_gets_one_vector_per_chunk(workdir, monkeypatch):
+    db = sqlite_utils.Database(ingest.DB_PATH)
+    ingest_texts(monkeypatch, ["header", "body one", "footer"])
+    embed_index.embed_and_index(dedup_threshold=None)
+    # The header moves down and is repeated; only one copy can take the old vector
+    ingest_texts(monkeypatch, ["preface", "header", "body one", "header"])
+    embed_index.embed_and_index(dedup_threshold=None)
+    vec_ids = [row["vec_id"] for row in db["chunks"].rows_where("deleted = 0")]
+    assert len(set(vec_ids)) == 4 and None not in vec_ids
+    assert faiss.read_index(embed_index.FAISS_INDEX_PATH).ntotal == 4
+
+def test_shifted_duplicates_keep_their_cluster(workdir, monkeypatch):
+    db = sqlite_utils.Database(ingest.DB_PATH)
+    ingest_texts(monkeypatch, ["site rules", "ladder feet and angles", "site rules"])
+    embed_index.embed_and_index()
+    ingest_texts(monkeypatch, ["edge protection overview", "site rules", "ladder feet and angles", "site rules"])
+    embed_index.embed_and_index()
+    canonical = {row["id"]: row["canonical_id"] for row in db["chunks"].rows_where("deleted = 0")}
+    assert canonical == {"doc.pdf-0": "doc.pdf-0", "doc.pdf-1": "doc.pdf-1", "doc.pdf-2": "doc.pdf-2", "doc.pdf-3": "doc.pdf-1"}
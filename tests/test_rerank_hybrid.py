@@ -0,0 +1,46 @@
+import threading
+
+from rerank_hybrid import WhooshBM25, build_whoosh_index
+
+def build(texts):
+    build_whoosh_index([{"id": f"doc.pdf-{i}", "chunk_text": text} for i, text in enumerate(texts)])
+
+def test_threads_search_with_their_own_searcher(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    build(["robot cell fencing", "forklift aisle width"])
+    engine = WhooshBM25()
+    barrier = threading.Barrier(3)
+    results = []
+
+    def search():
+        results.append(engine.search("robot", k=3))
+        # Hold the searcher open until every thread has searched
+        barrier.wait()
+    threads = [threading.Thread(target=search) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [list(hits) for hits in results] == [["doc.pdf-0"]] * 3
+    assert len(engine._searchers) == 3
+    engine.close()
+    assert not engine._searchers
+
+def test_generation_is_checked_at_most_every_refresh_interval(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    build(["robot cell fencing"])
+    engine = WhooshBM25(refresh_interval=60)
+    checks = []
+    index_generation = engine._index_generation
+    monkeypatch.setattr(engine, "_index_generation", lambda: checks.append(1) or index_generation())
+    for _ in range(10):
+        assert list(engine.search("robot", k=3)) == ["doc.pdf-0"]
+    assert len(checks) == 1
+
+    # A rebuild is picked up once the interval has passed
+    build(["forklift aisle width", "robot arm guarding"])
+    assert list(engine.search("robot", k=3)) == ["doc.pdf-0"]
+    engine.refresh_interval = 0
+    assert list(engine.search("robot", k=3)) == ["doc.pdf-1"]
+    engine.close()